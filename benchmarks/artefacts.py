@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Compares the plugin/theme artefact formats on a large synthetic theme:
+# the size of the artefact, and the time taken to pack it (as the build
+# stage does) and to unpack it (as the test and deploy stages do).
+#
+#   python benchmarks/artefacts.py [--files 20000] [--format zip:6 ...] [--output results.json]
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_theme_source
+
+DEFAULT_FORMATS = ["zip:0", "zip:1", "zip:6", "zip:9", "tar.zst:1", "tar.zst:3", "tar.zst:9", "tar.zst:19"]
+
+
+def tree_bytes(root):
+    from wordpress_cd.files import scan_tree
+    return sum(entry.stat(follow_symlinks=False).st_size for (relpath, entry) in scan_tree(root) if entry.is_file(follow_symlinks=False))
+
+
+def run_format(src_dir, name, work_dir, spec, threads, repeat):
+    from wordpress_cd.artefact import artefact_filename, pack, unpack
+    format, _, level = spec.partition(":")
+    level = int(level) if level else None
+    if level is None:
+        from wordpress_cd.artefact import FORMATS
+        level = FORMATS[format]['default_level']
+
+    filename = artefact_filename(work_dir, name, format)
+    pack_times = []
+    unpack_times = []
+    for i in range(repeat):
+        start = time.monotonic()
+        pack(src_dir, name, filename, format, level, threads)
+        pack_times.append(time.monotonic() - start)
+
+        dest_dir = tempfile.mkdtemp(dir=work_dir)
+        start = time.monotonic()
+        if unpack(filename, dest_dir) != 0:
+            raise Exception("Unable to unpack '{0}' artefact".format(spec))
+        unpack_times.append(time.monotonic() - start)
+        shutil.rmtree(dest_dir)
+
+    size = os.path.getsize(filename)
+    os.unlink(filename)
+    return {
+        'bytes': size,
+        'pack_seconds': round(statistics.median(pack_times), 3),
+        'unpack_seconds': round(statistics.median(unpack_times), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare artefact formats on a large theme.")
+    parser.add_argument('--files', type=int, default=20000, help="files in the theme")
+    parser.add_argument('--format', action='append', help="format and level to try, e.g. 'tar.zst:3' (can be repeated)")
+    parser.add_argument('--threads', type=int, default=0, help="compression threads for 'tar.zst' (0 for one per core)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per format")
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    parser.add_argument('--keep', action='store_true', help="keep the working folder")
+    args = parser.parse_args()
+
+    formats = args.format or DEFAULT_FORMATS
+    work_dir = tempfile.mkdtemp(prefix="wpcd-bench-artefacts-")
+    results = {
+        'timestamp': time.time(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'parameters': {'files': args.files, 'threads': args.threads, 'repeat': args.repeat},
+        'formats': {},
+    }
+    try:
+        print("Generating a theme of {0} files...".format(args.files), file=sys.stderr)
+        src_dir = os.path.join(work_dir, "src")
+        make_theme_source(os.path.join(src_dir, "benchtheme"), args.files)
+        results['source_bytes'] = tree_bytes(src_dir)
+
+        for spec in formats:
+            result = results['formats'][spec] = run_format(src_dir, "benchtheme", work_dir, spec, args.threads, args.repeat)
+            print("{0:<12} {1:>12} bytes ({2:5.1f}%)  pack {3:7.3f}s  unpack {4:7.3f}s".format(
+                spec, result['bytes'], 100.0 * result['bytes'] / results['source_bytes'],
+                result['pack_seconds'], result['unpack_seconds']), file=sys.stderr)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# Stand-in deploy driver for the test stage benchmarks, whose test site
+# setup and teardown steps just take a while, as they would on a real
+# hosting platform. Each step is noted in the file named by 'WPCD_FAKE_LOG'
+# (if set), so what was done when can be checked.
+#
+# Load with 'WPCD_DRIVERS=fakedriver' (with this folder on the python path)
+# and 'WPCD_PLATFORM=fake'. 'WPCD_FAKE_DELAY' sets how long setting up the
+# host, DNS entry and certificate each take, in seconds.
+
+import os
+import time
+
+from wordpress_cd.drivers import driver
+from wordpress_cd.drivers.base import BaseDriver
+
+
+@driver('fake')
+class FakeDriver(BaseDriver):
+    def __str__(self):
+        return "fake"
+
+    def __init__(self, args):
+        super(FakeDriver, self).__init__(args)
+        self.delay = float(os.getenv("WPCD_FAKE_DELAY", "0.5"))
+
+    def _step(self, name, delay):
+        time.sleep(delay)
+        log_file = os.getenv("WPCD_FAKE_LOG")
+        if log_file is not None:
+            with open(log_file, 'a') as f:
+                f.write("{0} {1} {2}\n".format(time.time(), name, self.test_site_uid))
+
+    def _setup_host(self):
+        self._step("setup_host", self.delay * 1.2)
+
+    def _provision_test_host(self):
+        self._step("provision_host", self.delay)
+
+    def _deploy_test_slot(self):
+        self._step("deploy", self.delay * 0.2)
+
+    def _recycle_test_host(self):
+        self._step("recycle", self.delay * 0.2)
+
+    def _setup_dns(self):
+        self._step("setup_dns", self.delay)
+
+    def _setup_ssl(self):
+        self._step("setup_ssl", self.delay)
+
+    def _teardown_host(self):
+        self._step("teardown_host", self.delay * 0.5)
+
+    def _teardown_dns(self):
+        self._step("teardown_dns", self.delay * 0.5)
+
+    def _teardown_ssl(self):
+        self._step("teardown_ssl", self.delay * 0.5)
+
+    def deploy_site(self):
+        return 0
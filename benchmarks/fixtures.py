@@ -0,0 +1,167 @@
+# Synthetic WordPress-like fixtures for the benchmarks: a core tarball,
+# plugin/theme zips, large theme source trees and multi-build site configs.
+
+import os
+import random
+import tarfile
+import zipfile
+
+import yaml
+
+# Roughly the make-up of a real WordPress/plugin tree, by extension
+FILE_MIX = [
+    ('.php', 6, 8192),
+    ('.js', 2, 16384),
+    ('.css', 1, 8192),
+    ('.png', 1, 4096),
+]
+
+WORDS = [
+    "function", "return", "array", "wp_", "get_option", "apply_filters",
+    "esc_html", "$post", "if", "else", "foreach", "echo", "class", "public",
+]
+
+
+def _content(ext, size, rng):
+    if ext == '.png':
+        # Incompressible, like real image data
+        return bytes(rng.getrandbits(8) for i in range(size))
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words).encode('ascii')
+
+
+def make_tree(root, files, seed = 0, depth = 3):
+    """Create a tree of 'files' text/image files spread over nested folders."""
+    rng = random.Random(seed)
+    weights = [w for (ext, w, size) in FILE_MIX]
+    for i in range(files):
+        ext, weight, max_size = rng.choices(FILE_MIX, weights)[0]
+        folders = ["d{0}".format(rng.randrange(8)) for d in range(rng.randrange(depth + 1))]
+        folder = os.path.join(root, *folders)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, "f{0}{1}".format(i, ext)), 'wb') as f:
+            f.write(_content(ext, rng.randrange(64, max_size), rng))
+
+
+def make_core_tarball(filename, files = 1500, seed = 0):
+    """A 'wordpress-x.y.z.tar.gz' lookalike, with default themes/plugins to be excluded."""
+    tmp_root = filename + ".d"
+    make_tree(os.path.join(tmp_root, "wordpress"), files, seed)
+    for path in ["wp-content/themes/twentynineteen", "wp-content/plugins/akismet"]:
+        make_tree(os.path.join(tmp_root, "wordpress", path), 50, seed + 1)
+    with tarfile.open(filename, "w:gz") as tar:
+        tar.add(os.path.join(tmp_root, "wordpress"), arcname="wordpress")
+    return filename
+
+
+def make_module_zip(filename, name, files = 200, seed = 0):
+    """A plugin/theme zip with a single top-level folder named after it."""
+    tmp_root = filename + ".d"
+    make_tree(os.path.join(tmp_root, name), files, seed)
+    with open(os.path.join(tmp_root, name, name + ".php"), 'w') as f:
+        f.write("<?php\n/*\nPlugin Name: {0}\n*/\n".format(name))
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as z:
+        for dirpath, dirs, names in os.walk(os.path.join(tmp_root, name)):
+            for n in names:
+                path = os.path.join(dirpath, n)
+                z.write(path, os.path.relpath(path, tmp_root))
+    return filename
+
+
+def make_large_module_zip(filename, name, files = 500000, folder_size = 1000):
+    """A plugin zip with a very large number of small files, written without a tree on disk."""
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr("{0}/{0}.php".format(name), "<?php\n/*\nPlugin Name: {0}\n*/\n".format(name))
+        for i in range(files):
+            z.writestr("{0}/data/d{1}/f{2}.json".format(name, i // folder_size, i), '{{"id": {0}}}\n'.format(i))
+    return filename
+
+
+def make_fixtures(www_dir, plugins = 20, plugin_files = 200, core_files = 1500):
+    """Create the files a site build would download, returning their URL paths."""
+    if not os.path.isdir(www_dir):
+        os.makedirs(www_dir)
+    make_core_tarball(os.path.join(www_dir, "wordpress.tar.gz"), core_files)
+    names = []
+    for i in range(plugins):
+        name = "plugin{0}".format(i)
+        make_module_zip(os.path.join(www_dir, name + ".zip"), name, plugin_files, seed=i)
+        names.append(name)
+    make_module_zip(os.path.join(www_dir, "theme.zip"), "theme", plugin_files * 2, seed=1000)
+    return names
+
+
+def make_site(site_dir, base_url, plugin_names, builds = 3):
+    """Write a multi-build 'build.yml', each build sharing most of its plugins."""
+    if not os.path.isdir(site_dir):
+        os.makedirs(site_dir)
+    half = len(plugin_names) // 2
+    config = {
+        'builds': {},
+        'layers': {
+            'common': {
+                'themes': ["{0}/theme.zip".format(base_url)],
+                'plugins': ["{0}/{1}.zip".format(base_url, n) for n in plugin_names[:half]],
+            },
+        },
+    }
+    for b in range(builds):
+        layer = "extra{0}".format(b)
+        config['layers'][layer] = {
+            'plugins': ["{0}/{1}.zip".format(base_url, n) for n in plugin_names[half + b::builds]],
+        }
+        config['builds']["site{0}".format(b)] = {
+            'core': "{0}/wordpress.tar.gz".format(base_url),
+            'layers': ['common', layer],
+        }
+    with open(os.path.join(site_dir, "build.yml"), 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return config
+
+
+def make_wporg_catalog(www_dir, base_url, plugin_names, versions = ("1.0.0", "1.1.0", "2.0.0")):
+    """Publish a few versions of each fixture plugin and the theme, as WordPress.org does.
+
+    Returns the catalog for the API stand-in ('wporgserver.py').
+    """
+    catalog = {'plugin': {}, 'theme': {}}
+    for (type, names) in [('plugin', plugin_names), ('theme', ["theme"])]:
+        type_dir = os.path.join(www_dir, type)
+        if not os.path.isdir(type_dir):
+            os.makedirs(type_dir)
+        catalog[type] = {}
+        for name in names:
+            catalog[type][name] = {}
+            for version in versions:
+                filename = "{0}.{1}.zip".format(name, version)
+                if not os.path.isfile(os.path.join(type_dir, filename)):
+                    os.link(os.path.join(www_dir, name + ".zip"), os.path.join(type_dir, filename))
+                catalog[type][name][version] = "{0}/{1}/{2}".format(base_url, type, filename)
+    return catalog
+
+
+def make_wporg_site(site_dir, base_url, plugin_names, builds = 3):
+    """Like 'make_site', but with the plugins and theme given as WordPress.org references."""
+    config = make_site(site_dir, base_url, plugin_names, builds)
+    for layer in config['layers'].values():
+        for (list_name, constraint) in [('themes', "~1.0"), ('plugins', "^1.0")]:
+            if list_name in layer:
+                layer[list_name] = ["{0}@{1}".format(os.path.basename(url)[:-len(".zip")], constraint) for url in layer[list_name]]
+    # Some left to whatever is the latest
+    config['layers']['extra0']['plugins'] = [ref.split("@")[0] for ref in config['layers']['extra0']['plugins']]
+    with open(os.path.join(site_dir, "build.yml"), 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return config
+
+
+def make_theme_source(theme_dir, files = 5000, seed = 0):
+    """A large theme source tree, to be built with 'build-wp-theme'."""
+    make_tree(theme_dir, files, seed, depth=4)
+    with open(os.path.join(theme_dir, "style.css"), 'w') as f:
+        f.write("/*\nTheme Name: Benchmark\n*/\n")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# Builds a site with a synthetic plugin of a very large number of files
+# (500,000 by default) in a child process with capped memory, reporting
+# the time taken and the peak memory use of the build and the commands it
+# runs. Fails if the build fails or uses more memory than allowed.
+#
+#   python benchmarks/large_tree.py [--files N] [--memory-cap-mb N] [--output results.json]
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_core_tarball, make_large_module_zip
+from server import FixtureServer
+
+BUILD_COMMAND = "import sys; from wordpress_cd.main import main; sys.argv = ['build-wp-site']; sys.exit(main())"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a site with a very large plugin under a memory cap.")
+    parser.add_argument('--files', type=int, default=500000, help="files in the large plugin")
+    parser.add_argument('--memory-cap-mb', type=int, default=1024, help="address space limit for the build (0 for none)")
+    parser.add_argument('--max-rss-mb', type=int, default=256, help="peak memory use above which the benchmark fails")
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    parser.add_argument('--keep', action='store_true', help="keep the working folder")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="wpcd-bench-large-")
+    try:
+        www_dir = os.path.join(work_dir, "www")
+        os.makedirs(www_dir)
+        print("Generating a plugin of {0} files...".format(args.files), file=sys.stderr)
+        make_core_tarball(os.path.join(www_dir, "wordpress.tar.gz"), 100)
+        make_large_module_zip(os.path.join(www_dir, "large.zip"), "large", args.files)
+
+        with FixtureServer(www_dir) as server:
+            site_dir = os.path.join(work_dir, "site")
+            os.makedirs(site_dir)
+            with open(os.path.join(site_dir, "build.yml"), 'w') as f:
+                yaml.safe_dump({
+                    'builds': {'site': {'core': "{0}/wordpress.tar.gz".format(server.url), 'layers': ['common']}},
+                    'layers': {'common': {'plugins': ["{0}/large.zip".format(server.url)]}},
+                }, f, default_flow_style=False)
+
+            env = dict(os.environ,
+                WPCD_CACHE_DIR=os.path.join(work_dir, "cache"),
+                WPCD_CACHE="0",
+                PYTHONPATH=os.pathsep.join([p for p in [sys.path[1], os.getenv("PYTHONPATH")] if p]))
+
+            def limit_memory():
+                if args.memory_cap_mb > 0:
+                    cap = args.memory_cap_mb * 1024 * 1024
+                    resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+
+            print("Building...", file=sys.stderr)
+            start = time.monotonic()
+            with open(os.path.join(work_dir, "build.log"), 'wb') as log:
+                proc = subprocess.Popen([sys.executable, "-c", BUILD_COMMAND], cwd=site_dir, env=env,
+                    stdout=log, stderr=subprocess.STDOUT, preexec_fn=limit_memory)
+                pid, status, rusage = os.wait4(proc.pid, 0)
+            elapsed = time.monotonic() - start
+            exitcode = proc.returncode = os.waitstatus_to_exitcode(status)
+
+            report = {}
+            if exitcode == 0:
+                with open(os.path.join(site_dir, "wpcd-artefacts", "build-report.json")) as f:
+                    report = json.load(f)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # The peak memory use reported covers the build and every command it ran
+    max_rss_mb = round(rusage.ru_maxrss / 1024.0, 1)
+    results = {
+        'timestamp': time.time(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'parameters': {'files': args.files, 'memory_cap_mb': args.memory_cap_mb, 'max_rss_mb': args.max_rss_mb},
+        'exitcode': exitcode,
+        'seconds': round(elapsed, 3),
+        'max_rss_mb': max_rss_mb,
+        'timings': report.get('timings', {}),
+        'processes': report.get('processes', {}),
+        'passed': exitcode == 0 and max_rss_mb <= args.max_rss_mb,
+    }
+    print("Built {0} files in {1:.1f}s, peak memory use {2} MB (exit code {3})".format(
+        args.files, elapsed, max_rss_mb, exitcode), file=sys.stderr)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0 if results['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
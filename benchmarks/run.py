@@ -0,0 +1,582 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the build, package and deploy hot paths, run against
+# synthetic fixtures served from a local HTTP server.
+#
+#   python benchmarks/run.py [--plugins N] [--repeat N] [--output results.json]
+#
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import socket
+import argparse
+import importlib.util
+import platform
+import tempfile
+import statistics
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_fixtures, make_site, make_theme_source, make_wporg_catalog, make_wporg_site
+from server import FixtureServer
+
+# Registered benchmarks, in the order they are run
+benchmarks = []
+
+
+def benchmark(name):
+    def register(fn):
+        benchmarks.append((name, fn))
+        return fn
+    return register
+
+
+class Skip(Exception):
+    pass
+
+
+class Context(object):
+    def __init__(self, args, work_dir, base_url, plugin_names):
+        self.args = args
+        self.work_dir = work_dir
+        self.base_url = base_url
+        self.plugin_names = plugin_names
+
+    def fresh_dir(self, name):
+        path = os.path.join(self.work_dir, name)
+        # Along with the copies of a document root deployed by tarssh
+        for old in [path] + glob.glob(path + ".wpcd-*"):
+            if os.path.islink(old):
+                os.unlink(old)
+            elif os.path.isdir(old):
+                shutil.rmtree(old)
+        os.makedirs(path)
+        return path
+
+    def fresh_cache(self):
+        os.environ['WPCD_CACHE_DIR'] = self.fresh_dir("cache")
+        import wordpress_cd.cache
+        wordpress_cd.cache._cache = None
+
+
+class _Args(object):
+    verbose = False
+    debug = False
+
+
+def _in_dir(path, fn, *args):
+    # The build/deploy entry points work on the current directory
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        return fn(*args)
+    finally:
+        os.chdir(cwd)
+
+
+def _site_dir(ctx):
+    site_dir = os.path.join(ctx.work_dir, "site")
+    if not os.path.isfile(os.path.join(site_dir, "build.yml")):
+        make_site(site_dir, ctx.base_url, ctx.plugin_names, ctx.args.builds)
+    return site_dir
+
+
+def _theme_dir(ctx):
+    theme_dir = os.path.join(ctx.work_dir, "benchtheme")
+    if not os.path.isdir(theme_dir):
+        make_theme_source(theme_dir, ctx.args.theme_files)
+    return theme_dir
+
+
+@benchmark("build-wp-site (cold cache)")
+def bench_build_site_cold(ctx):
+    import wordpress_cd.build
+    site_dir = _site_dir(ctx)
+    ctx.fresh_cache()
+    start = time.monotonic()
+    if _in_dir(site_dir, wordpress_cd.build.build_site, _Args()) != 0:
+        raise Exception("Site build failed")
+    return time.monotonic() - start
+
+
+@benchmark("build-wp-site (warm cache)")
+def bench_build_site_warm(ctx):
+    import wordpress_cd.build
+    site_dir = _site_dir(ctx)
+    if _in_dir(site_dir, wordpress_cd.build.build_site, _Args()) != 0:
+        raise Exception("Site build failed")
+    start = time.monotonic()
+    if _in_dir(site_dir, wordpress_cd.build.build_site, _Args()) != 0:
+        raise Exception("Site build failed")
+    return time.monotonic() - start
+
+
+# A build.yml for many sites sharing a file of layers (as a hosting
+# provider's might), of around 1MB
+CONFIG_LAYERS = 400
+CONFIG_PLUGINS = 25
+
+def _large_config(ctx):
+    config_dir = os.path.join(ctx.work_dir, "config")
+    if not os.path.isdir(config_dir):
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, "shared.yml"), 'w') as f:
+            f.write("layers:\n")
+            for i in range(CONFIG_LAYERS):
+                f.write("  shared{0}:\n    plugins:\n".format(i))
+                for j in range(CONFIG_PLUGINS):
+                    f.write("      - {0}/plugins/plugin{1}-{2}.zip\n".format(ctx.base_url, i, j))
+                    f.write("      - plugin{0}-{1}@^1.{2}\n".format(i, j, j))
+        with open(os.path.join(config_dir, "build.yml"), 'w') as f:
+            f.write("include:\n  - shared.yml\nbuilds:\n")
+            for i in range(CONFIG_LAYERS):
+                f.write("  site{0}:\n    core: {1}/core.tar.gz\n    layers: [shared{0}, shared{2}]\n".format(i, ctx.base_url, (i + 1) % CONFIG_LAYERS))
+    return os.path.join(config_dir, "build.yml")
+
+def _load_config(ctx, loader):
+    from wordpress_cd.config import load_config
+    filename = _large_config(ctx)
+    load_config(filename)
+    start = time.monotonic()
+    config = load_config(filename, loader)
+    elapsed = time.monotonic() - start
+    if len(config['builds']) != CONFIG_LAYERS:
+        raise Exception("Config loading failed")
+    return elapsed
+
+
+@benchmark("load build.yml (pure Python YAML loader)")
+def bench_load_config_python(ctx):
+    import yaml
+    return _load_config(ctx, yaml.SafeLoader)
+
+
+@benchmark("load build.yml (libyaml loader)")
+def bench_load_config_libyaml(ctx):
+    import yaml
+    if not hasattr(yaml, 'CSafeLoader'):
+        raise Skip("PyYAML built without libyaml")
+    return _load_config(ctx, yaml.CSafeLoader)
+
+
+@benchmark("load build.yml (unchanged, cached)")
+def bench_load_config_cached(ctx):
+    return _load_config(ctx, None)
+
+
+# Round trip to the WordPress.org API stand-in
+WPORG_LATENCY = 0.05
+
+def _resolve_wporg(ctx, cache_dir, batch_size = None, ttl = None):
+    from wporgserver import WordPressOrgServer
+    from wordpress_cd.wporg import Resolver, MetadataCache, resolve_config
+    catalog = make_wporg_catalog(os.path.join(ctx.work_dir, "www"), ctx.base_url, ctx.plugin_names)
+    config = make_wporg_site(os.path.join(ctx.work_dir, "wporg-site"), ctx.base_url, ctx.plugin_names, ctx.args.builds)
+    with WordPressOrgServer(catalog, WPORG_LATENCY) as api:
+        resolver = Resolver(api.url, MetadataCache(cache_dir, ttl), batch_size)
+        start = time.monotonic()
+        resolve_config(config, update=True, frozen=False, resolver=resolver)
+        return time.monotonic() - start
+
+
+@benchmark("resolve wporg refs (cold cache, unbatched)")
+def bench_resolve_wporg_unbatched(ctx):
+    return _resolve_wporg(ctx, ctx.fresh_dir("wporg-cache"), batch_size=1)
+
+
+@benchmark("resolve wporg refs (cold cache, batched)")
+def bench_resolve_wporg_cold(ctx):
+    return _resolve_wporg(ctx, ctx.fresh_dir("wporg-cache"))
+
+
+@benchmark("resolve wporg refs (expired cache, ETag revalidation)")
+def bench_resolve_wporg_revalidate(ctx):
+    cache_dir = ctx.fresh_dir("wporg-cache")
+    _resolve_wporg(ctx, cache_dir)
+    return _resolve_wporg(ctx, cache_dir, ttl=0)
+
+
+@benchmark("resolve wporg refs (warm cache)")
+def bench_resolve_wporg_warm(ctx):
+    cache_dir = ctx.fresh_dir("wporg-cache")
+    _resolve_wporg(ctx, cache_dir)
+    return _resolve_wporg(ctx, cache_dir)
+
+
+@benchmark("build-wp-theme (large tree)")
+def bench_build_theme(ctx):
+    import wordpress_cd.build
+    theme_dir = _theme_dir(ctx)
+    # Artefact caching would make every run after the first a no-op
+    os.environ['WPCD_CACHE'] = "0"
+    import wordpress_cd.cache
+    wordpress_cd.cache._cache = None
+    try:
+        start = time.monotonic()
+        if _in_dir(theme_dir, wordpress_cd.build.build_theme, _Args()) != 0:
+            raise Exception("Theme build failed")
+        return time.monotonic() - start
+    finally:
+        del os.environ['WPCD_CACHE']
+        wordpress_cd.cache._cache = None
+
+
+@benchmark("unpack_artefact")
+def bench_unpack_artefact(ctx):
+    import wordpress_cd.job
+    from wordpress_cd.workspace import Workspace
+    theme_dir = _theme_dir(ctx)
+    if not os.path.isfile(os.path.join(theme_dir, "wpcd-artefacts", "benchtheme.zip")):
+        bench_build_theme(ctx)
+    with Workspace(theme_dir) as workspace:
+        start = time.monotonic()
+        tmp_dir = wordpress_cd.job.unpack_artefact(workspace)
+        elapsed = time.monotonic() - start
+        if not isinstance(tmp_dir, str):
+            raise Exception("Unable to unpack artefact")
+    return elapsed
+
+
+def _deploy_site(ctx, target):
+    import wordpress_cd.deploy
+    site_dir = _site_dir(ctx)
+    if not os.path.isdir(os.path.join(site_dir, "build")):
+        bench_build_site_cold(ctx)
+    os.environ['WPCD_BUILD_REF'] = "site0"
+    if target is not None:
+        os.environ['SSH_PATH'] = target
+    start = time.monotonic()
+    if _in_dir(site_dir, wordpress_cd.deploy.deploy_site, _Args()) != 0:
+        raise Exception("Site deploy failed")
+    return time.monotonic() - start
+
+
+@benchmark("deploy-wp-site rsync to local folder (first deploy)")
+def bench_deploy_rsync_cold(ctx):
+    if shutil.which("rsync") is None:
+        raise Skip("rsync not installed")
+    return _deploy_site(ctx, ctx.fresh_dir("docroot"))
+
+
+@benchmark("deploy-wp-site rsync to local folder (no changes)")
+def bench_deploy_rsync_warm(ctx):
+    if shutil.which("rsync") is None:
+        raise Skip("rsync not installed")
+    target = os.path.join(ctx.work_dir, "docroot")
+    if not os.path.isdir(target):
+        _deploy_site(ctx, ctx.fresh_dir("docroot"))
+    return _deploy_site(ctx, target)
+
+
+@benchmark("deploy-wp-site tarssh to local folder (first deploy)")
+def bench_deploy_tarssh_cold(ctx):
+    os.environ['WPCD_PLATFORM'] = "tarssh"
+    try:
+        return _deploy_site(ctx, ctx.fresh_dir("docroot"))
+    finally:
+        del os.environ['WPCD_PLATFORM']
+
+
+@benchmark("deploy-wp-site tarssh to local folder (capped at 10MB/s)")
+def bench_deploy_tarssh_capped(ctx):
+    os.environ.update({'WPCD_PLATFORM': "tarssh", 'WPCD_BWLIMIT': "10240"})
+    try:
+        return _deploy_site(ctx, ctx.fresh_dir("docroot"))
+    finally:
+        for name in ['WPCD_PLATFORM', 'WPCD_BWLIMIT']:
+            del os.environ[name]
+
+
+@benchmark("deploy-wp-site tarssh to local folder (adaptive, site slow for 2s)")
+def bench_deploy_tarssh_adaptive(ctx):
+    import threading
+    from webserver import WebServer
+
+    # The site responds slowly until 2s into the deploy, so the transfer
+    # should be held back until then
+    with WebServer(0.5) as web:
+        os.environ.update({
+            'WPCD_PLATFORM': "tarssh",
+            'WPCD_THROTTLE_URL': web.url + "/",
+            'WPCD_THROTTLE_LATENCY_MS': "200",
+            'WPCD_THROTTLE_INTERVAL': "0.1",
+            'WPCD_THROTTLE_WINDOW': "1",
+        })
+        timer = threading.Timer(2.0, web.set_latency, [0])
+        timer.start()
+        try:
+            return _deploy_site(ctx, ctx.fresh_dir("docroot"))
+        finally:
+            timer.cancel()
+            for name in ['WPCD_PLATFORM', 'WPCD_THROTTLE_URL', 'WPCD_THROTTLE_LATENCY_MS', 'WPCD_THROTTLE_INTERVAL', 'WPCD_THROTTLE_WINDOW']:
+                del os.environ[name]
+
+
+def _change_plugin_file(target):
+    # Change the main file of the first plugin deployed, as a stand-in for an update
+    plugins_dir = os.path.join(target, "wp-content", "plugins")
+    plugin = sorted(name for name in os.listdir(plugins_dir) if not name.endswith(".php"))[0]
+    with open(os.path.join(plugins_dir, plugin, plugin + ".php"), 'a') as f:
+        f.write("// changed\n")
+    return "plugins/{0}".format(plugin)
+
+def _dry_run_site(ctx, target):
+    import io
+    import contextlib
+    os.environ['WPCD_DRY_RUN'] = "1"
+    try:
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            elapsed = _deploy_site(ctx, target)
+    finally:
+        del os.environ['WPCD_DRY_RUN']
+    totals = json.loads(output.getvalue())['totals']
+    if totals['changed'] != 1:
+        raise Exception("Dry run found {0} changed files rather than 1".format(totals['changed']))
+    return elapsed
+
+
+@benchmark("deploy-wp-site rsync dry run (one file changed)")
+def bench_dry_run_rsync(ctx):
+    if shutil.which("rsync") is None:
+        raise Skip("rsync not installed")
+    target = ctx.fresh_dir("docroot")
+    _deploy_site(ctx, target)
+    _change_plugin_file(target)
+    return _dry_run_site(ctx, target)
+
+
+@benchmark("deploy-wp-site tarssh dry run (one file changed)")
+def bench_dry_run_tarssh(ctx):
+    os.environ['WPCD_PLATFORM'] = "tarssh"
+    try:
+        target = ctx.fresh_dir("docroot")
+        _deploy_site(ctx, target)
+        _change_plugin_file(target)
+        return _dry_run_site(ctx, target)
+    finally:
+        del os.environ['WPCD_PLATFORM']
+
+
+def _deploy_objectstore(ctx, s3, prefix):
+    os.environ['WPCD_PLATFORM'] = "objectstore"
+    os.environ['WPCD_OBJECTSTORE_URL'] = "s3://benchmark/{0}".format(prefix)
+    os.environ['WPCD_S3_ENDPOINT_URL'] = s3.url
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        os.environ.setdefault(name, "benchmark")
+    os.environ.setdefault('AWS_DEFAULT_REGION', "us-east-1")
+    try:
+        return _deploy_site(ctx, None)
+    finally:
+        for name in ['WPCD_PLATFORM', 'WPCD_OBJECTSTORE_URL', 'WPCD_S3_ENDPOINT_URL']:
+            del os.environ[name]
+
+
+def _s3_server(ctx):
+    if importlib.util.find_spec("boto3") is None:
+        raise Skip("boto3 not installed")
+    from s3server import S3Server
+    s3 = S3Server(ctx.fresh_dir("s3"))
+    s3.create_bucket("benchmark")
+    return s3
+
+
+@benchmark("deploy-wp-site objectstore to local S3 stand-in (first deploy)")
+def bench_deploy_objectstore_cold(ctx):
+    with _s3_server(ctx) as s3:
+        return _deploy_objectstore(ctx, s3, "site")
+
+
+@benchmark("deploy-wp-site objectstore to local S3 stand-in (no changes)")
+def bench_deploy_objectstore_warm(ctx):
+    with _s3_server(ctx) as s3:
+        _deploy_objectstore(ctx, s3, "site")
+        return _deploy_objectstore(ctx, s3, "site")
+
+
+def _post_deploy_hooks(ctx, concurrent):
+    from contextlib import ExitStack
+    from wordpress_cd.postdeploy import load_hooks, run_hooks
+    from wordpress_cd.workspace import Workspace
+    from webserver import WebServer
+    import fakedriver
+
+    # Health checks of a site's web servers, each taking 50ms a page
+    os.environ.update({
+        'WPCD_HEALTH_URL': "http://{host}/",
+        'WPCD_HEALTH_REQUESTS': "5",
+    })
+    try:
+        with ExitStack() as stack:
+            hosts = [stack.enter_context(WebServer(0.05)).host for i in range(ctx.args.hosts)]
+            driver = fakedriver.FakeDriver(_Args())
+            driver.workspace = Workspace(ctx.work_dir)
+            hooks = load_hooks(driver, ["health"])
+            start = time.monotonic()
+            if concurrent:
+                results = [run_hooks(hooks, hosts)]
+            else:
+                results = [run_hooks(hooks, [host]) for host in hosts]
+            elapsed = time.monotonic() - start
+            if any(len(stats['failures']) > 0 for stats in results):
+                raise Exception("Health check failed")
+            return elapsed
+    finally:
+        for name in ['WPCD_HEALTH_URL', 'WPCD_HEALTH_REQUESTS']:
+            del os.environ[name]
+
+
+@benchmark("post-deploy health checks (one host at a time)")
+def bench_post_deploy_sequential(ctx):
+    return _post_deploy_hooks(ctx, False)
+
+
+@benchmark("post-deploy health checks (all hosts at once)")
+def bench_post_deploy_concurrent(ctx):
+    return _post_deploy_hooks(ctx, True)
+
+
+def _test_site(ctx, pool_size):
+    import wordpress_cd.test
+    from wordpress_cd.workspace import Workspace
+    os.environ.update({
+        'WPCD_DRIVERS': "fakedriver",
+        'WPCD_PLATFORM': "fake",
+        'WPCD_TEST_POOL_SIZE': str(pool_size),
+        'WPCD_TEST_POOL_DIR': os.path.join(ctx.work_dir, "test-pool"),
+        'WPCD_TEST_POOL_REPLENISH': "0",
+    })
+    try:
+        start = time.monotonic()
+        if wordpress_cd.test.test_site(_Args(), Workspace(_site_dir(ctx))) != 0:
+            raise Exception("Site test failed")
+        return time.monotonic() - start
+    finally:
+        for name in ['WPCD_DRIVERS', 'WPCD_PLATFORM', 'WPCD_TEST_POOL_SIZE', 'WPCD_TEST_POOL_DIR', 'WPCD_TEST_POOL_REPLENISH']:
+            del os.environ[name]
+
+
+@benchmark("test-wp-site fake driver (fresh test site)")
+def bench_test_site_fresh(ctx):
+    return _test_site(ctx, 0)
+
+
+@benchmark("test-wp-site fake driver (warm pool)")
+def bench_test_site_pool(ctx):
+    from wordpress_cd.drivers.pool import TestSlotPool
+    import fakedriver
+    pool = TestSlotPool(fakedriver.FakeDriver(_Args()), 2, os.path.join(ctx.work_dir, "test-pool", "fake"))
+
+    # Recycling and replenishing happen in the background between jobs
+    pool.replenish()
+    elapsed = _test_site(ctx, 2)
+    pool.replenish()
+    return elapsed
+
+
+# A command writing progress lines to stdout and a flood of errors to
+# stderr, which would deadlock if either pipe were left unread
+CHATTY_COMMAND = """
+import sys
+for i in range(100000):
+    sys.stdout.write("{0:>14,}  {1:>3}%    1.00MB/s    0:00:01 (xfr#{2}, to-chk=1/100000)\\r".format(i * 100, i // 1000, i))
+    sys.stderr.write("warning: chatty output line {0} {1}\\n".format(i, "x" * 40))
+"""
+
+@benchmark("stream output of a chatty command")
+def bench_stream_output(ctx):
+    from wordpress_cd import process
+    from wordpress_cd.drivers.rsync import RsyncProgress
+    progress = RsyncProgress()
+    start = time.monotonic()
+    exitcode, output, errors = process.stream([sys.executable, "-c", CHATTY_COMMAND], on_stdout=progress)
+    elapsed = time.monotonic() - start
+    if exitcode != 0 or progress.files != 99999:
+        raise Exception("Streaming output failed")
+    return elapsed
+
+
+def summarise(runs):
+    return {
+        'runs': runs,
+        'min': min(runs),
+        'median': statistics.median(runs),
+        'mean': statistics.mean(runs),
+        'stdev': statistics.stdev(runs) if len(runs) > 1 else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the build, package and deploy hot paths.")
+    parser.add_argument('--plugins', type=int, default=20, help="number of plugin zips to generate")
+    parser.add_argument('--plugin-files', type=int, default=200, help="files per plugin")
+    parser.add_argument('--core-files', type=int, default=1500, help="files in the core tarball")
+    parser.add_argument('--theme-files', type=int, default=5000, help="files in the large theme tree")
+    parser.add_argument('--builds', type=int, default=3, help="number of builds in build.yml")
+    parser.add_argument('--hosts', type=int, default=8, help="web servers for the post-deploy hooks")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark")
+    parser.add_argument('--only', action='append', help="only run benchmarks whose names contain this")
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    parser.add_argument('--keep', action='store_true', help="keep the working folder")
+    parser.add_argument('-v', dest='verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    # The deploy driver expects CI-independent job details
+    os.environ.setdefault('WPCD_GIT_BRANCH', "benchmark")
+    os.environ.setdefault('WPCD_JOB_NAME', "benchmark")
+    os.environ.setdefault('WPCD_JOB_ID', "benchmark")
+    os.environ.pop('SSH_HOST', None)
+
+    # Keep the chatter of the tools run (zip, unzip etc) out of the results
+    real_stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    work_dir = tempfile.mkdtemp(prefix="wpcd-bench-")
+    results = {
+        'timestamp': time.time(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'parameters': dict((k, v) for (k, v) in vars(args).items() if k not in ['output', 'keep', 'verbose']),
+        'benchmarks': {},
+    }
+    try:
+        www_dir = os.path.join(work_dir, "www")
+        plugin_names = make_fixtures(www_dir, args.plugins, args.plugin_files, args.core_files)
+        with FixtureServer(www_dir) as server:
+            ctx = Context(args, work_dir, server.url, plugin_names)
+            for name, fn in benchmarks:
+                if args.only and not any(o in name for o in args.only):
+                    continue
+                try:
+                    runs = [fn(ctx) for i in range(args.repeat)]
+                    results['benchmarks'][name] = summarise(runs)
+                    print("{0:<55} median {1:8.3f}s".format(name, results['benchmarks'][name]['median']), file=sys.stderr)
+                except Skip as e:
+                    results['benchmarks'][name] = {'skipped': str(e)}
+                    print("{0:<55} skipped ({1})".format(name, str(e)), file=sys.stderr)
+    finally:
+        sys.stdout.flush()
+        os.dup2(real_stdout, 1)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
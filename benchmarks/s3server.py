@@ -0,0 +1,179 @@
+# Minimal local stand-in for an S3-compatible service, just capable enough
+# for the object storage deploy driver and S3 build cache: path-style
+# bucket/object PUT, GET, HEAD and DELETE, batch deletes and multipart
+# uploads. Requests are not authenticated.
+
+import os
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    from urllib.parse import urlparse, parse_qs, unquote
+except Exception:
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse(self.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        query = parse_qs(url.query, keep_blank_values=True)
+        return bucket, key, query
+
+    def _object_path(self, bucket, key):
+        return os.path.join(self.server.root, bucket, "objects", hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def _read_body(self):
+        # Uploads may arrive chunked (with 'aws-chunked' signatures/trailers)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked' or 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            while self.rfile.readline().strip() != b"":
+                pass
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status, body = b"", headers = {}):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_xml(self, status, element):
+        self._send(status, ET.tostring(element), {'Content-Type': "application/xml"})
+
+    def _send_error(self, status, code):
+        error = ET.Element("Error")
+        ET.SubElement(error, "Code").text = code
+        self._send_xml(status, error)
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if key == "":
+            os.makedirs(os.path.join(self.server.root, bucket, "objects"), exist_ok=True)
+            return self._send(200)
+        if 'uploadId' in query:
+            part_file = os.path.join(self.server.root, "uploads", query['uploadId'][0], "{0:05d}".format(int(query['partNumber'][0])))
+            with open(part_file, 'wb') as f:
+                f.write(body)
+            return self._send(200, headers={'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest())})
+        self._store(bucket, key, body)
+        self._send(200, headers={'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest())})
+
+    def _store(self, bucket, key, body):
+        path = self._object_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{0}.{1}".format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        path = self._object_path(bucket, key)
+        if not os.path.isfile(path):
+            return self._send_error(404, "NoSuchKey")
+        with open(path, 'rb') as f:
+            body = f.read()
+        self._send(200, body, {
+            'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest()),
+            'Content-Type': "application/octet-stream",
+        })
+
+    def do_HEAD(self):
+        bucket, key, query = self._parse()
+        path = self._object_path(bucket, key)
+        if not os.path.isfile(path):
+            return self._send(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        path = self._object_path(bucket, key)
+        if os.path.isfile(path):
+            os.unlink(path)
+        self._send(204)
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        body = self._read_body()
+        if 'delete' in query:
+            result = ET.Element("DeleteResult", xmlns=XMLNS)
+            for element in ET.fromstring(body).iter("{{{0}}}Key".format(XMLNS)):
+                path = self._object_path(bucket, element.text)
+                if os.path.isfile(path):
+                    os.unlink(path)
+            return self._send_xml(200, result)
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.server.root, "uploads", upload_id))
+            result = ET.Element("InitiateMultipartUploadResult", xmlns=XMLNS)
+            ET.SubElement(result, "Bucket").text = bucket
+            ET.SubElement(result, "Key").text = key
+            ET.SubElement(result, "UploadId").text = upload_id
+            return self._send_xml(200, result)
+        if 'uploadId' in query:
+            upload_dir = os.path.join(self.server.root, "uploads", query['uploadId'][0])
+            parts = []
+            for part in sorted(os.listdir(upload_dir)):
+                with open(os.path.join(upload_dir, part), 'rb') as f:
+                    parts.append(f.read())
+            self._store(bucket, key, b"".join(parts))
+            shutil.rmtree(upload_dir)
+            result = ET.Element("CompleteMultipartUploadResult", xmlns=XMLNS)
+            ET.SubElement(result, "Bucket").text = bucket
+            ET.SubElement(result, "Key").text = key
+            ET.SubElement(result, "ETag").text = '"{0}"'.format(uuid.uuid4().hex)
+            return self._send_xml(200, result)
+        self._send_error(400, "InvalidRequest")
+
+
+class S3Server(object):
+    """Serve a local S3 stand-in on a free local port, in a background thread."""
+
+    def __init__(self, root = None):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), S3RequestHandler)
+        self.httpd.root = root or tempfile.mkdtemp(prefix="wpcd-s3-")
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+
+    def create_bucket(self, bucket):
+        os.makedirs(os.path.join(self.httpd.root, bucket, "objects"), exist_ok=True)
+
+    def count_objects(self, bucket):
+        return len([f for f in os.listdir(os.path.join(self.httpd.root, bucket, "objects")) if "." not in f])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,58 @@
+# Local HTTP server for benchmark fixtures, with range request support so
+# resumed downloads behave as they would against a real web server.
+
+import os
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if range_header is None or not range_header.startswith("bytes=") or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        size = os.path.getsize(path)
+        start, end = range_header[len("bytes="):].split("-", 1)
+        start = int(start)
+        end = int(end) if end else size - 1
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{0}".format(size))
+            self.end_headers()
+            return None
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified", self.date_time_string(os.stat(path).st_mtime))
+        self.end_headers()
+        return f
+
+
+class FixtureServer(object):
+    """Serve a folder over HTTP on a free local port, in a background thread."""
+
+    def __init__(self, root):
+        handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=root, **kwargs)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
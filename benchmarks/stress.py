@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Runs a number of site builds (8 by default) at once on this host, all
+# fetching the same components, then checks every build came out the same.
+# Builds run as separate 'build-wp-site' processes, as concurrent CI jobs
+# on a shared runner would, or with '--in-process' as threads of this one.
+#
+#   python benchmarks/stress.py [--builds 8] [--in-process] [--output results.json]
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import make_fixtures, make_site
+from server import FixtureServer
+
+BUILD_COMMAND = "import sys; from wordpress_cd.main import main; sys.argv = ['build-wp-site']; sys.exit(main())"
+
+
+class _Args(object):
+    verbose = False
+    debug = False
+
+
+def build_in_process(site_dir):
+    from wordpress_cd.build import build_site
+    from wordpress_cd.workspace import Workspace
+    start = time.monotonic()
+    exitcode = build_site(_Args(), Workspace(site_dir))
+    return exitcode, time.monotonic() - start
+
+def build_in_subprocess(site_dir):
+    start = time.monotonic()
+    with open(os.path.join(site_dir, "build.log"), 'wb') as log:
+        exitcode = subprocess.call([sys.executable, "-c", BUILD_COMMAND], cwd=site_dir,
+            stdout=log, stderr=subprocess.STDOUT)
+    return exitcode, time.monotonic() - start
+
+
+def build_hashes(site_dir):
+    """Return the hash of each build's document root."""
+    from wordpress_cd.cache import hash_tree
+    build_dir = os.path.join(site_dir, "build")
+    return dict((build_ref, hash_tree(os.path.join(build_dir, build_ref, "wordpress")))
+        for build_ref in sorted(os.listdir(build_dir)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several site builds at once and check they all agree.")
+    parser.add_argument('--builds', type=int, default=8, help="number of builds to run at once")
+    parser.add_argument('--plugins', type=int, default=20, help="number of plugin zips to generate")
+    parser.add_argument('--plugin-files', type=int, default=200, help="files per plugin")
+    parser.add_argument('--core-files', type=int, default=1500, help="files in the core tarball")
+    parser.add_argument('--in-process', action='store_true', help="run the builds as threads of this process")
+    parser.add_argument('--no-cache', action='store_true', help="disable the (shared) build cache")
+    parser.add_argument('--output', help="write results as JSON to this file (default: stdout)")
+    parser.add_argument('--keep', action='store_true', help="keep the working folder")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    os.environ['WPCD_CACHE'] = "0" if args.no_cache else "1"
+
+    work_dir = tempfile.mkdtemp(prefix="wpcd-stress-")
+    os.environ['WPCD_CACHE_DIR'] = os.path.join(work_dir, "cache")
+    try:
+        www_dir = os.path.join(work_dir, "www")
+        plugin_names = make_fixtures(www_dir, args.plugins, args.plugin_files, args.core_files)
+        with FixtureServer(www_dir) as server:
+            site_dirs = []
+            for i in range(args.builds):
+                site_dir = os.path.join(work_dir, "site{0}".format(i))
+                make_site(site_dir, server.url, plugin_names)
+                site_dirs.append(site_dir)
+
+            build = build_in_process if args.in_process else build_in_subprocess
+            print("Running {0} builds at once...".format(args.builds), file=sys.stderr)
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=args.builds) as executor:
+                outcomes = list(executor.map(build, site_dirs))
+            elapsed = time.monotonic() - start
+
+        # Every build of every site should be identical
+        hashes = [build_hashes(site_dir) if exitcode == 0 else None
+            for (site_dir, (exitcode, duration)) in zip(site_dirs, outcomes)]
+        expected = next((h for h in hashes if h is not None), None)
+        mismatched = [os.path.basename(site_dir) for (site_dir, h) in zip(site_dirs, hashes) if h is not None and h != expected]
+        failed = [os.path.basename(site_dir) for (site_dir, (exitcode, duration)) in zip(site_dirs, outcomes) if exitcode != 0]
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'timestamp': time.time(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'parameters': dict((k, v) for (k, v) in vars(args).items() if k not in ['output', 'keep']),
+        'seconds': round(elapsed, 3),
+        'build_seconds': [round(duration, 3) for (exitcode, duration) in outcomes],
+        'failed': failed,
+        'mismatched': mismatched,
+        'passed': len(failed) == 0 and len(mismatched) == 0,
+    }
+    print("{0} builds in {1:.1f}s: {2} failed, {3} differed".format(
+        args.builds, elapsed, len(failed), len(mismatched)), file=sys.stderr)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0 if results['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
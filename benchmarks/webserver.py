@@ -0,0 +1,72 @@
+# Stand-in for the web servers of a deployed site: answers every GET with
+# a small page after a delay, as a PHP-rendered page would, so post-deploy
+# health checks have something realistic to time. The status returned and
+# the delay can be changed on the fly, to stand in for a broken deploy or a
+# site struggling under load.
+
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PAGE = b"<!DOCTYPE html><html><head><title>Benchmark</title></head><body>Hello</body></html>\n"
+
+
+class PageRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, body):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(PAGE)
+
+    def do_PURGE(self):
+        self._respond(b"")
+
+
+class WebServer(object):
+    """Serve a page on a free local port, in a background thread."""
+
+    def __init__(self, latency = 0, status = 200):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), PageRequestHandler)
+        self.httpd.latency = latency
+        self.httpd.status = status
+        self.httpd.requests = 0
+        self.httpd.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        return "127.0.0.1:{0}".format(self.httpd.server_address[1])
+
+    @property
+    def url(self):
+        return "http://{0}".format(self.host)
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def set_status(self, status):
+        self.httpd.status = status
+
+    def set_latency(self, latency):
+        self.httpd.latency = latency
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
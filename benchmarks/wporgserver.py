@@ -0,0 +1,113 @@
+# Minimal local stand-in for the WordPress.org plugin and theme info APIs
+# (version 1.2), just capable enough for the build stage's resolver: batched
+# 'plugin_information'/'theme_information' lookups by slug, with an ETag
+# for conditional requests. Each request can be delayed, to stand in for
+# the round trip to the real thing.
+
+import json
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except Exception:
+    from urlparse import urlparse, parse_qs
+
+ACTIONS = {
+    '/plugins/info/1.2/': ('plugin', 'plugin_information'),
+    '/themes/info/1.2/': ('theme', 'theme_information'),
+}
+
+
+class APIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body = b"", headers = {}):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        try:
+            type, action = ACTIONS[url.path]
+        except KeyError:
+            return self._send(404)
+        if query.get('action') != [action]:
+            return self._send(400, json.dumps({'error': "Action not implemented."}).encode('utf-8'))
+
+        slugs = [slug for value in query.get('request[slugs]', []) for slug in value.split(",") if slug]
+        results = {}
+        for slug in slugs:
+            versions = self.server.catalog.get(type, {}).get(slug)
+            if versions is None:
+                results[slug] = {'error': "{0} not found.".format(type.capitalize())}
+                continue
+            latest = max(versions.keys(), key=lambda v: tuple(int(p) for p in v.split(".")))
+            results[slug] = {
+                'name': slug,
+                'slug': slug,
+                'version': latest,
+                'download_link': versions[latest],
+                'versions': dict(versions, trunk=versions[latest]),
+            }
+        body = json.dumps(results, sort_keys=True).encode('utf-8')
+
+        etag = '"{0}"'.format(hashlib.sha256(body).hexdigest()[:16])
+        if self.headers.get('If-None-Match') == etag:
+            with self.server.lock:
+                self.server.not_modified += 1
+            return self._send(304, headers={'ETag': etag})
+        self._send(200, body, {'Content-Type': "application/json", 'ETag': etag})
+
+
+class WordPressOrgServer(object):
+    """Serve plugin/theme details on a free local port, in a background thread.
+
+    The catalog maps 'plugin'/'theme' to slugs, and each slug to a mapping
+    of its versions to their download URLs.
+    """
+
+    def __init__(self, catalog, latency = 0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), APIRequestHandler)
+        self.httpd.catalog = catalog
+        self.httpd.latency = latency
+        self.httpd.lock = threading.Lock()
+        self.reset()
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def not_modified(self):
+        return self.httpd.not_modified
+
+    def reset(self):
+        self.httpd.requests = 0
+        self.httpd.not_modified = 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
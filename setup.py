@@ -8,13 +8,11 @@ setup(name = 'wordpress-cd',
     url = 'https://github.com/rossigee/wordpress-cd',
     packages = [
       'wordpress_cd',
+      'wordpress_cd.cache',
       'wordpress_cd.drivers',
       'wordpress_cd.datasets',
       'wordpress_cd.notifications',
     ],
-    data_files = [
-      ('extras', ['extras/mu-autoloader.php'])
-    ],
     entry_points = {
         'console_scripts': [
             'build-wp-site = wordpress_cd.main:main',
@@ -29,10 +27,17 @@ setup(name = 'wordpress-cd',
             'build-wp-theme = wordpress_cd.main:main',
             'test-wp-theme = wordpress_cd.main:main',
             'deploy-wp-theme = wordpress_cd.main:main',
+            'build-wp-sites = wordpress_cd.batch:main',
+            'resolve-wp-site = wordpress_cd.wporg:main',
+            'wpcd-daemon = wordpress_cd.daemon:main',
         ]
     },
     install_requires = [
         'pyyaml',
         'requests'
-    ]
+    ],
+    extras_require = {
+        # S3 build cache, 'objectstore' driver, asset offloading and S3 datasets
+        's3': ['boto3'],
+    }
 )
@@ -0,0 +1,104 @@
+# Packing and unpacking the build artefacts of plugins and themes.
+#
+# An artefact is the module's folder packed either as a zip file (with
+# 'zip', at a chosen deflate level, or just stored) or as a tarball
+# compressed with 'zstd' using every core. The format is chosen per build
+# job, and recognised from the file itself when unpacking, so test and
+# deploy stages work with whatever the build produced.
+
+import os
+import shutil
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from . import process
+
+FORMATS = {
+    'zip': {'extension': ".zip", 'levels': (0, 9), 'default_level': 6},
+    'tar.zst': {'extension': ".tar.zst", 'levels': (1, 19), 'default_level': 3},
+}
+
+# Leading bytes of each format (the second zip signature is an empty archive)
+MAGIC = [
+    (b"PK\x03\x04", 'zip'),
+    (b"PK\x05\x06", 'zip'),
+    (b"\x28\xb5\x2f\xfd", 'tar.zst'),
+]
+
+
+class ArtefactException(Exception):
+    pass
+
+
+def get_artefact_format():
+    """Return the artefact format, compression level and threads to use for this job."""
+    format = os.getenv("WPCD_ARTEFACT_FORMAT", "zip")
+    if format not in FORMATS:
+        raise ArtefactException("Unknown artefact format '{0}' (expected one of: {1}).".format(
+            format, ", ".join(sorted(FORMATS.keys()))))
+    low, high = FORMATS[format]['levels']
+    try:
+        level = int(os.getenv("WPCD_ARTEFACT_LEVEL", str(FORMATS[format]['default_level'])))
+        threads = int(os.getenv("WPCD_ARTEFACT_THREADS", "0"))
+    except ValueError as e:
+        raise ArtefactException("Invalid artefact setting: {0}".format(str(e)))
+    if level < low or level > high:
+        raise ArtefactException("Compression level for '{0}' artefacts must be from {1} to {2}.".format(format, low, high))
+    return format, level, threads
+
+
+def artefact_filename(artefact_dir, name, format):
+    return "{0}/{1}{2}".format(artefact_dir, name, FORMATS[format]['extension'])
+
+def find_artefact(artefact_dir, name):
+    """Return the (most recently built) artefact of a module, in whatever format, if any."""
+    candidates = [artefact_filename(artefact_dir, name, format) for format in FORMATS.keys()]
+    candidates = [filename for filename in candidates if os.path.isfile(filename)]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+def detect_format(filename):
+    """Recognise an artefact's format from its first few bytes."""
+    with open(filename, 'rb') as f:
+        head = f.read(4)
+    for (magic, format) in MAGIC:
+        if head.startswith(magic):
+            return format
+    raise ArtefactException("Unable to recognise the format of artefact '{0}'.".format(os.path.basename(filename)))
+
+
+def _check_zstd():
+    if shutil.which("zstd") is None:
+        raise ArtefactException("The 'zstd' command is needed for 'tar.zst' artefacts.")
+
+
+def pack(src_dir, name, filename, format, level, threads = 0):
+    """Pack the folder 'name' within 'src_dir' into an artefact, skipping 'node_modules'."""
+    if format == 'zip':
+        args = ["zip", "-q", "-r", "-{0}".format(level), filename, name, "-x", "*/node_modules/*"]
+    else:
+        _check_zstd()
+        args = ["tar", "--sort=name", "--exclude=node_modules",
+            "--use-compress-program", "zstd -q -{0} -T{1}".format(level, threads),
+            "-cf", filename, name]
+    if os.path.isfile(filename):
+        os.unlink(filename)
+    exitcode = process.call(args, cwd=src_dir)
+    if exitcode > 0:
+        raise ArtefactException("Unable to pack '{0}' artefact. Exit code: {1}".format(format, exitcode))
+    return filename
+
+
+def unpack(filename, dest_dir):
+    """Unpack an artefact (of any format) into a folder, returning the exit code."""
+    format = detect_format(filename)
+    _logger.debug("Unpacking '{0}' artefact '{1}'...".format(format, filename))
+    if format == 'zip':
+        args = ["unzip", "-q", filename]
+    else:
+        # tar adds '-d' when unpacking
+        _check_zstd()
+        args = ["tar", "--use-compress-program", "zstd -q", "-xf", filename]
+    return process.call(args, cwd=dest_dir)
@@ -0,0 +1,284 @@
+# Batch mode, for building (and optionally deploying) many sites at once.
+#
+#   build-wp-sites [-v] [-d] [--deploy] [-j N] <site dir or glob> ...
+#
+# The 'build.yml' of every site is read up front into one combined plan, so
+# components shared between sites are downloaded and unpacked once for the
+# whole batch. Each site is then built (and deployed) in its own worker
+# process, as each site's settings are read from the environment.
+
+import os
+import sys
+import glob
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .build import BuildSiteJobHandler, BuildException, read_build_config
+from .config import ConfigException
+from .wporg import Lockfile, ResolveException, LOCKFILE
+from .workspace import Workspace
+
+# Settings for deploying each site are read from this file in its folder
+DEPLOY_ENV_FILE = "deploy.env"
+
+# These identify the CI project rather than any one site in it, so are
+# dropped while building each site to keep their performance baselines apart
+PROJECT_ENV = ['CI_PROJECT_PATH', 'JOB_NAME', 'JOB_BASE_NAME']
+
+
+def find_sites(patterns):
+    """Expand the given folders/globs into a list of site folders."""
+    sites = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for site_dir in matches:
+            site_dir = os.path.abspath(site_dir)
+            if not os.path.isfile("{0}/build.yml".format(site_dir)):
+                raise BuildException("No 'build.yml' found in '{0}'.".format(site_dir))
+            if site_dir in sites:
+                continue
+            if site_name(site_dir) in [site_name(s) for s in sites]:
+                raise BuildException("More than one site named '{0}'.".format(site_name(site_dir)))
+            sites.append(site_dir)
+    return sites
+
+def site_name(site_dir):
+    return os.path.basename(site_dir)
+
+def read_env_file(filename):
+    """Read 'KEY=value' lines from a file, ignoring blank lines and comments."""
+    env = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if line.startswith("export "):
+                line = line[7:]
+            try:
+                key, value = line.split("=", 1)
+            except ValueError:
+                raise BuildException("Invalid line in '{0}': {1}".format(filename, line))
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] and value[0] in ['"', "'"]:
+                value = value[1:-1]
+            env[key.strip()] = value
+    return env
+
+
+def _build_site(site_dir, args, unpacked, deploy):
+    # Runs in a worker process, one site at a time
+    env = dict(os.environ)
+    result = {'build': None, 'deploy': None}
+    start = time.monotonic()
+    try:
+        for name in PROJECT_ENV:
+            os.environ.pop(name, None)
+
+        workspace = Workspace(site_dir, name="site")
+        config = read_build_config(workspace.path("build.yml"))
+        job = BuildSiteJobHandler(config, args, unpacked, workspace)
+        result['build'] = job._build_handling_exceptions()
+        result['build_statistics'] = job.statistics
+        if result['build'] != 0 or not deploy:
+            return result
+
+        env_file = "{0}/{1}".format(site_dir, DEPLOY_ENV_FILE)
+        if os.path.isfile(env_file):
+            os.environ.update(read_env_file(env_file))
+        from .deploy import DeploySiteJobHandler
+        job = DeploySiteJobHandler(args, workspace)
+        result['deploy'] = job._deploy_handling_exceptions()
+        result['deploy_statistics'] = job.statistics
+        return result
+    except Exception as e:
+        _logger.exception(str(e))
+        result['error'] = str(e)
+        return result
+    finally:
+        result['duration'] = round(time.monotonic() - start, 3)
+        os.environ.clear()
+        os.environ.update(env)
+
+
+class BatchBuildJobHandler(BuildSiteJobHandler):
+    """Plans, fetches and unpacks components for a batch of sites, then builds each site."""
+
+    # Each site keeps its own lockfile, which it updates when built
+    use_lockfile = False
+
+    def __init__(self, sites, args, deploy = False, jobs = None):
+        self.sites = sites
+        self.deploy = deploy
+        self.jobs = jobs or os.cpu_count()
+        BuildSiteJobHandler.__init__(self, self.combine_configs(), args)
+        self.name = "batch"
+
+    def combine_configs(self):
+        """Merge the builds and layers of all sites into one config, keyed by site."""
+        config = {'builds': {}, 'layers': {}}
+        for site_dir in self.sites:
+            site = site_name(site_dir)
+            try:
+                site_config = read_build_config("{0}/build.yml".format(site_dir))
+            except ConfigException as e:
+                raise BuildException("Unable to read 'build.yml' for site '{0}': {1}".format(site, str(e)))
+
+            # Fetch what the site has locked, resolving the rest for all sites at once
+            try:
+                Lockfile("{0}/{1}".format(site_dir, LOCKFILE)).apply(site_config)
+            except ResolveException as e:
+                raise BuildException("Unable to read lockfile for site '{0}': {1}".format(site, str(e)))
+            for (build_ref, build_spec) in site_config['builds'].items():
+                build_spec = dict(build_spec)
+                build_spec['layers'] = ["{0}/{1}".format(site, layer_ref) for layer_ref in build_spec['layers']]
+                config['builds']["{0}/{1}".format(site, build_ref)] = build_spec
+            for (layer_ref, layer) in site_config.get('layers', {}).items():
+                config['layers']["{0}/{1}".format(site, layer_ref)] = dict(layer)
+        return config
+
+    def _fetch_and_unpack(self, type, url):
+        url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]
+        dest_dir = "{0}/{1}".format(self.unpack_dir, url_hash)
+        os.mkdir(dest_dir)
+
+        # A component that can't be fetched or unpacked only fails the sites
+        # using it, when they try to fetch it themselves
+        try:
+            if type == "core":
+                self.fetch_core(url)
+                self.unpack_core(url, dest_dir)
+                return dest_dir
+            self._fetch_thing(type, url)
+            return self.unpack_thing(url, dest_dir)
+        except BuildException as e:
+            _logger.warning("Leaving '{0}' to the sites using it: {1}".format(url, str(e)))
+            return None
+
+    def fetch_and_unpack_all(self, core_urls, theme_urls, plugin_urls):
+        """Fetch and unpack each component once, in parallel."""
+        tasks = [("core", url) for url in core_urls]
+        tasks += [("theme", url) for url in theme_urls]
+        tasks += [("plugin", url) for url in plugin_urls]
+
+        threads = int(os.getenv("WPCD_DOWNLOAD_THREADS", "4"))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = dict((executor.submit(self._fetch_and_unpack, *task), task[1]) for task in tasks)
+            for (future, url) in futures.items():
+                unpacked_dir = future.result()
+                if unpacked_dir is not None:
+                    self.unpacked[url] = unpacked_dir
+
+    def build(self):
+        _logger.info("Building {0} sites [job id: {1}]".format(len(self.sites), self.job_id))
+        self.normalise_components()
+
+        dl_core, dl_themes, dl_plugins = self.plan_components()
+        _logger.info("Identified {0} core versions, {1} unique themes and {2} unique plugins across all sites...".format(
+            len(dl_core),
+            len(dl_themes),
+            len(dl_plugins),
+        ))
+        self.statistics['components'] = {
+            'core': len(dl_core),
+            'themes': len(dl_themes),
+            'plugins': len(dl_plugins),
+        }
+
+        self.unpack_dir = self.workspace.mkdtemp("unpacked-")
+        with self.timed("fetch"):
+            self.prefetch(dl_core.union(dl_themes, dl_plugins))
+            self.fetch_and_unpack_all(dl_core, dl_themes, dl_plugins)
+        self.cache.put_many(self.cache_uploads)
+        self.statistics['unpacked'] = len(self.unpacked)
+
+        with self.timed("sites"):
+            self.build_sites()
+
+    def build_sites(self):
+        """Build (and deploy) each site in its own worker process."""
+        results = self.statistics['sites'] = {}
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = dict((executor.submit(_build_site, site_dir, self.args, self.unpacked, self.deploy), site_dir) for site_dir in self.sites)
+            for (future, site_dir) in futures.items():
+                result = future.result()
+                results[site_name(site_dir)] = result
+                if result['build'] != 0:
+                    _logger.error("Site '{0}' failed to build.".format(site_name(site_dir)))
+                elif self.deploy and result['deploy'] != 0:
+                    _logger.error("Site '{0}' failed to deploy.".format(site_name(site_dir)))
+                else:
+                    _logger.info("Site '{0}' done in {1}s.".format(site_name(site_dir), result['duration']))
+
+        self.statistics['failed'] = sorted(site for (site, result) in results.items()
+            if result['build'] != 0 or (self.deploy and result['deploy'] != 0))
+        self.statistics['succeeded'] = len(results) - len(self.statistics['failed'])
+
+    def run(self):
+        """Run the batch, writing a consolidated report. Returns non-zero if any site failed."""
+        try:
+            with self.timed("batch"):
+                self.build()
+        except Exception as e:
+            _logger.exception(str(e))
+            self._handle_exception(e)
+            self.statistics['error'] = str(e)
+            self.write_report("batch")
+            return 1
+        finally:
+            self.workspace.cleanup()
+        self.write_report("batch")
+        if len(self.statistics['failed']) > 0:
+            _logger.error("{0} of {1} sites failed: {2}".format(
+                len(self.statistics['failed']), len(self.sites), ", ".join(self.statistics['failed'])))
+            return 1
+        return 0
+
+
+def build_sites(args):
+    try:
+        sites = find_sites(args.sites)
+    except BuildException as e:
+        _logger.error(str(e))
+        return 1
+    if len(sites) == 0:
+        _logger.error("No sites to build.")
+        return 1
+
+    jobs = args.jobs or int(os.getenv("WPCD_BATCH_JOBS", "0"))
+    job = BatchBuildJobHandler(sites, args, deploy=args.deploy, jobs=jobs)
+    return job.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build (and optionally deploy) many sites at once.")
+    parser.add_argument('-v', dest='verbose', action='store_true')
+    parser.add_argument('-d', dest='debug', action='store_true')
+    parser.add_argument('-j', dest='jobs', type=int, default=0,
+        help='number of sites to build at once (default: number of CPUs)')
+    parser.add_argument('--deploy', dest='deploy', action='store_true',
+        help='deploy each site once built')
+    parser.add_argument('sites', metavar='site', nargs='+',
+        help='site folder (or glob matching site folders) containing a build.yml')
+    args = parser.parse_args()
+
+    log_level = logging.WARNING
+    if args.debug:
+        log_level = logging.DEBUG
+    elif args.verbose:
+        log_level = logging.INFO
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=log_level,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    return build_sites(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
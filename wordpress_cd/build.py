@@ -1,19 +1,31 @@
 #
-# Requires 'curl', 'tar' and 'unzip' O/S binaries installed and available.
+# Requires 'tar' and 'unzip' O/S binaries installed and available.
 #
 
-import sys, os
-import tempfile
-import subprocess
-import yaml
+import os
+import hashlib
 import logging
 import shutil
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import logging
 _logger = logging.getLogger(__name__)
 
-from .job import JobHandler, get_artefact_dir
+from .job import JobHandler, get_artefact_dir, get_module_id
+from .workspace import Workspace
 from .notifications import *
+from .cache import load_cache, cache_key, hash_files, hash_tree
+from .download import download, verify, parse_pin, DownloadException
+from .compress import precompress_trees
+from .images import optimise_images
+from .preload import generate_preload
+from .metrics import component_metrics
+from .config import ConfigException, load_config
+from .wporg import Lockfile, ResolveException, resolve_config, LOCKFILE
+from .files import copy_tree, first_entry, reset_permissions
+from .artefact import ArtefactException, get_artefact_format, artefact_filename, pack
+from . import process
 
 
 def get_branch():
@@ -35,43 +47,93 @@ class BuildException(Exception):
 
 
 class BuildJobHandler(JobHandler):
+    def __init__(self, type, name, args, job_id = None, workspace = None):
+        JobHandler.__init__(self, type, name, args, job_id, workspace)
+        self.cache = load_cache()
+
     def _build_handling_exceptions(self):
         try:
             notify_start("build")
-            self.build()
-            notify_success("build")
+            with self.timed("build"):
+                self.build()
+            self.check_baseline("build")
+            self.write_report("build")
+            notify_success("build", self.statistics)
             return 0
         except Exception as e:
             _logger.exception(str(e))
             self._handle_exception(e)
-            notify_failure("build", str(e))
+            notify_failure("build", str(e), self.statistics)
             return 1
+        finally:
+            self.workspace.cleanup()
+
+    def npm_install(self, src_dir):
+        """Run 'npm install', restoring 'node_modules' from the build cache if we can."""
+
+        # Only locked dependency trees are reproducible enough to be cached
+        key = None
+        lock_files = ["package-lock.json", "npm-shrinkwrap.json"]
+        if self.cache.enabled and any(os.path.isfile("{0}/{1}".format(src_dir, f)) for f in lock_files):
+            key = cache_key("npm", hash_files(["{0}/{1}".format(src_dir, f) for f in ["package.json"] + lock_files]))
+        modules_dir = "{0}/node_modules".format(src_dir)
+        if key is not None and self.cache.get_tree(key, modules_dir):
+            _logger.info("Restored NodeJS packages from build cache.")
+            return
+
+        _logger.info("Found 'package.json', running 'npm install'...")
+        with self.timed("npm"):
+            exitcode = process.call(["npm", "install"], cwd=src_dir)
+        if exitcode > 0:
+            raise BuildException("Unable to install NodeJS packages. Exit code: {0}".format(exitcode))
+
+        if key is not None and os.path.isdir(modules_dir):
+            self.cache.put_tree(key, modules_dir)
 
     def check_and_run_gulpfile(self, src_dir):
         # If there is a 'package.json' present, run 'npm install'
         if os.path.isfile("{0}/package.json".format(src_dir)):
-            _logger.info("Found 'package.json', running 'npm install'...")
-            os.chdir(src_dir)
-            exitcode = subprocess.call(["npm", "install"])
-            if exitcode > 0:
-                raise BuildException("Unable to install NodeJS packages. Exit code: {1}".format(exitcode))
+            self.npm_install(src_dir)
 
         # If there is a gulpfile present, run 'gulp'
         if os.path.isfile("{0}/gulpfile.js".format(src_dir)):
             _logger.info("Found 'gulpfile.js', running 'gulp'...")
-            os.chdir(src_dir)
-            exitcode = subprocess.call(["gulp"])
+            with self.timed("gulp"):
+                exitcode = process.call(["gulp"], cwd=src_dir)
             if exitcode > 0:
-                raise BuildException("Unable to generate CSS/JS. Exit code: {1}".format(exitcode))
+                raise BuildException("Unable to generate CSS/JS. Exit code: {0}".format(exitcode))
  
     def check_and_run_composer(self, src_dir):
-        # If there is a 'package.json' present, run 'npm install'
-        if os.path.isfile("{0}/composer.json".format(src_dir)):
-            _logger.info("Found 'composer.json', running 'composer update'...")
-            os.chdir(src_dir)
-            exitcode = subprocess.call(["composer", "update", "--prefer-dist"])
+        # If there is a 'composer.json' present, run 'composer update'
+        if not os.path.isfile("{0}/composer.json".format(src_dir)):
+            return
+
+        # Reuse a cached 'vendor' tree when the dependencies are locked
+        key = None
+        if self.cache.enabled and os.path.isfile("{0}/composer.lock".format(src_dir)):
+            key = cache_key("composer", hash_files(["{0}/composer.json".format(src_dir), "{0}/composer.lock".format(src_dir)]))
+        vendor_dir = "{0}/vendor".format(src_dir)
+        if key is not None and self.cache.get_tree(key, vendor_dir):
+            _logger.info("Restored composer packages from build cache.")
+            return
+
+        _logger.info("Found 'composer.json', running 'composer update'...")
+        with self.timed("composer"):
+            exitcode = process.call(["composer", "update", "--prefer-dist"], cwd=src_dir)
+        if exitcode > 0:
+            raise BuildException("Unable to update composer packages. Exit code: {0}".format(exitcode))
+
+        # Generate an authoritative classmap so the autoloader never has to
+        # search the filesystem at runtime
+        if os.getenv("WPCD_COMPOSER_OPTIMISE_AUTOLOAD", "1") == "1":
+            _logger.info("Optimising composer autoloader...")
+            with self.timed("composer"):
+                exitcode = process.call(["composer", "dump-autoload", "--optimize", "--classmap-authoritative"], cwd=src_dir)
             if exitcode > 0:
-                raise BuildException("Unable to update composer packages. Exit code: {1}".format(exitcode))
+                raise BuildException("Unable to optimise composer autoloader. Exit code: {0}".format(exitcode))
+
+        if key is not None and os.path.isdir(vendor_dir):
+            self.cache.put_tree(key, vendor_dir)
 
 
 
@@ -79,9 +141,9 @@ class BuildModuleJobHandler(BuildJobHandler):
     def build(self):
         _logger.info("Building {0} '{1}' [job id: {2}]".format(self.type, self.name, self.job_id))
 
-        # Remember our main working space and create a new temporary working space
-        work_dir = os.getcwd()
-        tmp_dir = tempfile.mkdtemp()
+        # Build in a temporary copy of the source, within our scratch folder
+        work_dir = self.work_dir
+        tmp_dir = self.workspace.mkdtemp("build-")
 
         # Clear down artefact folder
         artefact_dir = get_artefact_dir(work_dir)
@@ -90,13 +152,32 @@ class BuildModuleJobHandler(BuildJobHandler):
             shutil.rmtree(artefact_dir)
         os.makedirs(artefact_dir)
 
+        # Work out what kind of artefact this job wants
+        try:
+            format, level, threads = get_artefact_format()
+        except ArtefactException as e:
+            raise BuildException(str(e))
+        artefact_file = artefact_filename(artefact_dir, self.name, format)
+        self.statistics['artefact_format'] = "{0}:{1}".format(format, level)
+
+        # If this exact source tree has been built before, reuse that artefact
+        artefact_key = None
+        if self.cache.enabled:
+            artefact_key = cache_key("artefact", self.type, self.name,
+                hash_tree(work_dir, [os.path.basename(artefact_dir), ".git*", "node_modules"]),
+                os.getenv("WPCD_OPTIMISE_IMAGES", "0"), os.getenv("WPCD_IMAGES_WEBP", "0"), format, level)
+            if self.cache.get(artefact_key, artefact_file):
+                _logger.info("Restored {0} artefact from build cache.".format(self.type))
+                self.statistics['artefact_cached'] = True
+                return
+
         # Copy everything to be deployed into a folder in the tmpdir
         # (uses tar to leverage exclude patterns)
         tmp_build_dir = "{0}/{1}".format(tmp_dir, self.name)
         tar_file = "{0}/{1}.tar".format(tmp_dir, self.name)
         _logger.info("Reading from source with non-distribution files excluded ({0})...".format(work_dir))
         os.makedirs(tmp_build_dir)
-        exitcode = subprocess.call([
+        exitcode = process.call([
             "tar", "cf", tar_file,
             "--exclude={0}".format(os.path.basename(artefact_dir)),
             "--exclude=Jenkinsfile",
@@ -104,14 +185,13 @@ class BuildModuleJobHandler(BuildJobHandler):
             "--exclude=.git*",
             "--exclude=*-env",
             "."
-        ])
+        ], cwd=work_dir)
         if exitcode > 0:
-            raise BuildException("Unable to create tar file for build copy. Exit code: {1}".format(exitcode))
-        os.chdir(tmp_build_dir)
+            raise BuildException("Unable to create tar file for build copy. Exit code: {0}".format(exitcode))
         _logger.info("Deploying copy to temporary build folder ({0})...".format(tmp_build_dir))
-        exitcode = subprocess.call(["tar", "xf", tar_file])
+        exitcode = process.call(["tar", "xf", tar_file], cwd=tmp_build_dir)
         if exitcode > 0:
-            raise BuildException("Unable to extract files from tar file into place. Exit code: {1}".format(exitcode))
+            raise BuildException("Unable to extract files from tar file into place. Exit code: {0}".format(exitcode))
         os.unlink(tar_file)
 
         # If there is a composer.json present, run 'composer'
@@ -120,39 +200,110 @@ class BuildModuleJobHandler(BuildJobHandler):
         # If there is a gulpfile present, run 'gulp'
         self.check_and_run_gulpfile(tmp_build_dir)
 
-        # Zip it on up
-        zip_file = "{0}/{1}.zip".format(get_artefact_dir(work_dir), self.name)
-        _logger.info("Zipping up build folder to '{0}'...".format(zip_file))
-        os.chdir(tmp_dir)
-        exitcode = subprocess.call(["zip", "-r", zip_file, self.name,
-            "-x", "*/node_modules/*"])
-        if exitcode > 0:
-            raise BuildException("Unable to move {0} into place. Exit code: {1}".format(self.type, exitcode))
+        # Optionally optimise images
+        with self.timed("images"):
+            self.check_and_optimise_images(tmp_build_dir)
 
-        # Clear down temporary file amd folder
-        os.chdir(work_dir)
+        # Pack it on up
+        _logger.info("Packing up build folder to '{0}'...".format(artefact_file))
+        with self.timed("package"):
+            try:
+                pack(tmp_dir, self.name, artefact_file, format, level, threads)
+            except ArtefactException as e:
+                raise BuildException("Unable to move {0} into place: {1}".format(self.type, str(e)))
+        self.statistics['artefact_bytes'] = os.path.getsize(artefact_file)
+        if artefact_key is not None:
+            self.cache.put(artefact_key, artefact_file)
+
+        # Clear down temporary folder
         shutil.rmtree(tmp_dir)
 
         _logger.info("Done")
 
+    def check_and_optimise_images(self, build_dir):
+        """Losslessly recompress images in the build if enabled for this job."""
+        if os.getenv("WPCD_OPTIMISE_IMAGES", "0") != "1":
+            return
+
+        _logger.info("Optimising images...")
+        stats = optimise_images(build_dir, webp=os.getenv("WPCD_IMAGES_WEBP", "0") == "1")
+        self.statistics['images'] = stats
+        _logger.info("Optimised {0} of {1} images ({2} already cached), saving {3} of {4} bytes.".format(
+            stats['optimised_files'], stats['files'], stats['cached'],
+            stats['saved_bytes'], stats['original_bytes']))
+        if stats['webp_files'] > 0:
+            _logger.info("Generated {0} WebP variants ({1} bytes).".format(stats['webp_files'], stats['webp_bytes']))
+
 
 class BuildSiteJobHandler(BuildJobHandler):
-    def __init__(self, config, args):
+    # Whether WordPress.org references are locked in the project's 'build.lock'
+    use_lockfile = True
+
+    def __init__(self, config, args, unpacked = None, workspace = None):
         self.config = config
         self.args = args
-        BuildJobHandler.__init__(self, "site", None, args)
 
-    def build(self):
-        _logger.info("Building site '{0}' [job id: {1}]".format(self.name, self.job_id))
+        # Components already unpacked elsewhere (i.e. by a batch build),
+        # mapped to the folder they were unpacked to
+        self.unpacked = unpacked or {}
 
-        # Clear down root build directory
-        src_dir = os.getcwd()
-        root_build_dir = "{0}/build".format(src_dir)
-        if os.path.isdir(root_build_dir):
-            shutil.rmtree(root_build_dir)
+        BuildJobHandler.__init__(self, "site", None, args, workspace=workspace)
 
-        # First, make lists of unique core, theme and plugins to be downloaded
-        # so we only download them once each
+    def _component_url(self, entry):
+        # Components are either a plain URL, or a mapping with a 'url' and
+        # an optional 'sha256' pin
+        if not isinstance(entry, dict):
+            return entry
+        try:
+            url = entry['url']
+        except KeyError:
+            raise BuildException("Component entry is missing a 'url': {0}".format(entry))
+        if entry.get('sha256') is not None:
+            try:
+                pin = parse_pin(entry['sha256'])
+            except DownloadException as e:
+                raise BuildException("Invalid pin for '{0}': {1}".format(url, str(e)))
+            if self.pins.get(url, pin) != pin:
+                raise BuildException("Conflicting sha256 pins for '{0}'.".format(url))
+            self.pins[url] = pin
+        return url
+
+    def resolve_components(self):
+        """Resolve WordPress.org references ('slug@constraint') in the config to downloads."""
+        self.lockfile = None
+        if self.use_lockfile:
+            self.lockfile = Lockfile(self.workspace.path(LOCKFILE))
+        try:
+            resolved = resolve_config(self.config, self.lockfile)
+        except ResolveException as e:
+            raise BuildException(str(e))
+        if len(resolved) > 0:
+            self.statistics['resolved'] = dict((Lockfile.key(type, ref), resolution['version'])
+                for ((type, ref), resolution) in resolved.items())
+
+    def update_lockfile(self):
+        """Record resolutions, and the checksums of their downloads, in the lockfile."""
+        if self.lockfile is None:
+            return
+        for (url, sha256) in self.checksums.items():
+            self.lockfile.record_checksum(url, sha256)
+        if self.lockfile.save():
+            _logger.info("Updated lockfile '{0}'.".format(self.lockfile.filename))
+
+    def normalise_components(self):
+        """Reduce component entries in the config to URLs, noting any checksum pins."""
+        self.resolve_components()
+        self.pins = {}
+        self.checksums = {}
+        for build_spec in self.config['builds'].values():
+            build_spec['core'] = self._component_url(build_spec['core'])
+        for layer in self.config['layers'].values():
+            for type in ['themes', 'plugins', 'mu-plugins']:
+                if type in layer:
+                    layer[type] = [self._component_url(entry) for entry in layer[type]]
+
+    def plan_components(self):
+        """Return the sets of unique core, theme and plugin URLs used by the builds."""
         dl_core = set()
         dl_themes = set()
         dl_plugins = set()
@@ -166,6 +317,21 @@ class BuildSiteJobHandler(BuildJobHandler):
                     dl_plugins = dl_plugins.union(self.config['layers'][layer_ref]['plugins'])
                 if 'mu-plugins' in self.config['layers'][layer_ref]:
                     dl_plugins = dl_plugins.union(self.config['layers'][layer_ref]['mu-plugins'])
+        return dl_core, dl_themes, dl_plugins
+
+    def build(self):
+        _logger.info("Building site '{0}' [job id: {1}]".format(self.name, self.job_id))
+        self.normalise_components()
+
+        # Clear down root build directory
+        src_dir = self.work_dir
+        root_build_dir = "{0}/build".format(src_dir)
+        if os.path.isdir(root_build_dir):
+            shutil.rmtree(root_build_dir)
+
+        # First, make lists of unique core, theme and plugins to be downloaded
+        # so we only download them once each
+        dl_core, dl_themes, dl_plugins = self.plan_components()
         _logger.info("Identified {0} core versions, {1} unique themes and {2} unique plugins...".format(
             len(dl_core),
             len(dl_themes),
@@ -177,23 +343,27 @@ class BuildSiteJobHandler(BuildJobHandler):
             build_dir = "{0}/build/{1}".format(src_dir, build_ref)
             os.makedirs(build_dir)
 
-        # Download and deploy WordPess core version(s)
-        for core_url in dl_core:
-            # Download core
-            self.fetch_core(core_url)
+        # Pull down whatever we can from the build cache, then fetch the rest
+        # before installing anything so a bad download fails the build early
+        # (skipping any components that have already been unpacked for us)
+        unpacked = set(self.unpacked.keys())
+        with self.timed("fetch"):
+            self.prefetch(dl_core.union(dl_themes, dl_plugins) - unpacked)
+            self.fetch_all(dl_core - unpacked, dl_themes - unpacked, dl_plugins - unpacked)
+        self.update_lockfile()
 
+        # Deploy WordPess core version(s)
+        for core_url in dl_core:
             # Identify which builds use this core
             for build_ref in self.config['builds'].keys():
                 build_spec = self.config['builds'][build_ref]
                 if build_spec['core'] == core_url:
                     build_dir = "{0}/build/{1}".format(src_dir, build_ref)
-                    self.install_core(core_url, build_dir)
+                    with self.timed("install"):
+                        self.install_core(core_url, build_dir)
 
-        # Download and deploy themes
+        # Deploy themes
         for theme_url in dl_themes:
-            # Download theme
-            self.fetch_theme(theme_url)
-
             # Identify which builds use this theme
             build_dirs = []
             for build_ref in self.config['builds'].keys():
@@ -204,14 +374,12 @@ class BuildSiteJobHandler(BuildJobHandler):
                         if theme_url in layer_themes:
                             build_dirs.append("{0}/build/{1}/wordpress/wp-content/themes".format(src_dir, build_ref))
             if len(build_dirs) > 0:
-                self.install_theme(theme_url, build_dirs)
+                with self.timed("install"):
+                    self.install_theme(theme_url, build_dirs)
 
-        # Download and deploy plugins
+        # Deploy plugins
         mu_plugin_build_refs = []
         for plugin_url in dl_plugins:
-            # Download plugin
-            self.fetch_plugin(plugin_url)
-
             # Identify which builds use this (ordinary/must-use) plugin
             build_dirs = []
             for build_ref in self.config['builds'].keys():
@@ -227,7 +395,11 @@ class BuildSiteJobHandler(BuildJobHandler):
                             build_dirs.append("{0}/build/{1}/wordpress/wp-content/mu-plugins".format(src_dir, build_ref))
                             mu_plugin_build_refs.append(build_ref)
             if len(build_dirs) > 0:
-                self.install_plugin(plugin_url, build_dirs)
+                with self.timed("install"):
+                    self.install_plugin(plugin_url, build_dirs)
+
+        # Share any fresh downloads with other runners
+        self.cache.put_many(self.cache_uploads)
 
         # If there are 'must-use' plugins in builds...
         if len(mu_plugin_build_refs) > 0:
@@ -236,29 +408,27 @@ class BuildSiteJobHandler(BuildJobHandler):
                 # Adding must-use plugin autoloader
                 # (see https://codex.wordpress.org/Must_Use_Plugins)
                 _logger.debug("Deploying must-use plugin autoloader for '{0}' build...".format(build_ref))
-                src_file = "{0}/extras/mu-autoloader.php".format(sys.prefix)
-                dst_file = "{0}/build/{1}/wordpress/wp-content/mu-plugins/mu-autoloader.php".format(src_dir, build_ref)
+                mu_plugins_dir = "{0}/build/{1}/wordpress/wp-content/mu-plugins".format(src_dir, build_ref)
                 try:
-                    shutil.copyfile(src_file, dst_file)
+                    self.write_mu_autoloader(mu_plugins_dir)
                 except IOError as e:
                     raise BuildException("Unable to copy must-use plugin autoloader into place: {0}".format(str(e)))
 
         # Copy in various other optional files that should also be deployed
         # (TODO: to be replaced by simpler 'deploy-files' folder approach)
-        os.chdir(src_dir)
         extra_files = [
             'wp-config.php', 'favicon.ico', '.htaccess', 'robots.txt',
         ]
         if 'extra-files' in self.config:
             extra_files = self.config['extra-files']
         for filename in extra_files:
-            if not os.path.isfile(filename):
+            if not os.path.isfile(os.path.join(src_dir, filename)):
                 continue
             _logger.info("Deploying custom '{}' file to temporary build folder...".format(filename))
             for build_ref in self.config['builds'].keys():
                 dst_filename = "{0}/build/{1}/wordpress/{2}".format(src_dir, build_ref, filename)
                 try:
-                    shutil.copyfile(filename, dst_filename)
+                    shutil.copyfile(os.path.join(src_dir, filename), dst_filename)
                 except IOError as e:
                     raise BuildException("Unable to copy '{}' into place: {}".format(filename, str(e)))
 
@@ -276,74 +446,241 @@ class BuildSiteJobHandler(BuildJobHandler):
 
         # If there is a 'package.json' present, run 'npm install' (prep for 'gulp')
         if os.path.isfile("{0}/package.json".format(src_dir)):
-            _logger.info("Found 'package.json', running 'npm install'...")
-            os.chdir(src_dir)
-            exitcode = subprocess.call(["npm", "install"])
-            if exitcode > 0:
-                raise BuildException("Unable to install NodeJS packages. Exit code: {1}".format(exitcode))
+            self.npm_install(src_dir)
 
         # If there is a gulpfile present, run 'gulp' for each build
         if os.path.isfile("{0}/gulpfile.js".format(src_dir)):
             _logger.info("Found 'gulpfile.js', running 'gulp'...")
-            os.chdir(src_dir)
             for build_ref in self.config['builds'].keys():
-                exitcode = subprocess.call(["gulp"], env={'BUILD_REF': build_ref})
+                with self.timed("gulp"):
+                    exitcode = process.call(["gulp"], cwd=src_dir, env=dict(os.environ, BUILD_REF=build_ref))
                 if exitcode > 0:
-                    raise BuildException("Unable to generate CSS/JS with gulp. Exit code: {1}".format(exitcode))
+                    raise BuildException("Unable to generate CSS/JS with gulp. Exit code: {0}".format(exitcode))
+
+        # Optionally generate opcache preload scripts
+        with self.timed("preload"):
+            self.check_and_generate_preload(src_dir)
+
+        # Optionally generate pre-compressed copies of static assets
+        with self.timed("precompress"):
+            self.check_and_precompress(src_dir)
 
         # Set our file/directory permissions to be readable, to avoid perms issues later
         _logger.info("Resetting file/directory permissions in build folder...")
-        for root, dirs, files in os.walk(build_dir):
-            for d in dirs:
-                os.chmod(os.path.join(root, d), 0o755)
-            for f in files:
-                os.chmod(os.path.join(root, f), 0o644)
+        reset_permissions(root_build_dir)
+
+        # Record the make-up of each build, to spot unexpectedly heavy builds
+        for build_ref in self.config['builds'].keys():
+            build_root = "{0}/build/{1}/wordpress".format(src_dir, build_ref)
+            self.statistics.setdefault('components', {})[build_ref] = component_metrics(build_root)
 
         _logger.info("Done")
 
+    def write_mu_autoloader(self, mu_plugins_dir):
+        """Write an autoloader requiring the must-use plugins present at build time.
+
+        The list is worked out here, so the folder isn't scanned on every request.
+        """
+        plugins = []
+        for name in sorted(os.listdir(mu_plugins_dir)):
+            if os.path.isfile("{0}/{1}/{1}.php".format(mu_plugins_dir, name)):
+                plugins.append("{0}/{0}.php".format(name))
+        with open("{0}/mu-autoloader.php".format(mu_plugins_dir), 'w') as f:
+            f.write("<?php\n")
+            f.write("/**\n")
+            f.write(" * Loads the must-use plugins within subfolders, where the PHP file name\n")
+            f.write(" * is exactly like the directory name + .php.\n")
+            f.write(" *\n")
+            f.write(" * Generated by wordpress-cd at build time.\n")
+            f.write(" */\n\n")
+            for plugin in plugins:
+                f.write("require __DIR__ . '/{0}';\n".format(plugin))
+
+    def check_and_generate_preload(self, src_dir):
+        """Write an opcache 'preload.php' next to the document root of each build if enabled in the config."""
+        options = self.config.get('opcache-preload', False)
+        if not options:
+            return
+        if not isinstance(options, dict):
+            options = {}
+
+        access_log = options.get('access-log')
+        if access_log is not None:
+            access_log = os.path.join(src_dir, access_log)
+        if access_log is not None and not os.path.isfile(access_log):
+            raise BuildException("Unable to find access log '{0}' for opcache preload ranking.".format(access_log))
+        for build_ref in self.config['builds'].keys():
+            _logger.info("Generating opcache preload script for build '{0}'...".format(build_ref))
+            build_root = "{0}/build/{1}/wordpress".format(src_dir, build_ref)
+            count = generate_preload(build_root, int(options.get('limit', 1000)), access_log)
+            self.statistics.setdefault('preload', {})[build_ref] = count
+
+    def check_and_precompress(self, src_dir):
+        """Write '.gz'/'.br' siblings of static assets if enabled in the config."""
+        options = self.config.get('precompress', os.getenv("WPCD_PRECOMPRESS", "0") == "1")
+        if not options:
+            return
+        if not isinstance(options, dict):
+            options = {}
+
+        _logger.info("Pre-compressing static assets...")
+        roots = ["{0}/build/{1}/wordpress".format(src_dir, build_ref) for build_ref in self.config['builds'].keys()]
+        try:
+            stats = precompress_trees(roots,
+                formats=options.get('formats', ['gzip', 'brotli']),
+                min_size=int(options.get('min-size', 1024)))
+        except ValueError as e:
+            raise BuildException("Unable to pre-compress static assets: {0}".format(str(e)))
+        self.statistics['precompress'] = stats
+        _logger.info("Pre-compressed {0} static assets ({1} unique, {2} already cached).".format(
+            stats['files'], stats['unique_files'], stats['cached']))
+        for format in ['gzip', 'brotli']:
+            if '{0}_saved_bytes'.format(format) in stats:
+                _logger.info("Serving {0} variants saves {1} of {2} bytes.".format(
+                    format, stats['{0}_saved_bytes'.format(format)], stats['original_bytes']))
+
+    def download_path(self, url):
+        # Different URLs may well share a basename (i.e. 'archive.zip')
+        url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]
+        return "{0}/{1}-{2}".format(self.workspace.scratch("downloads"), url_hash, os.path.basename(url))
+
+    def _download_cache_key(self, url):
+        # Pinned downloads are identified by their content alone
+        if url in self.pins:
+            return "sha256/{0}".format(self.pins[url])
+
+        # Only downloads the server can identify by content (via validators)
+        # are cached, so 'latest' URLs are refetched once they change
+        try:
+            r = requests.head(url, allow_redirects=True, timeout=30)
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            _logger.debug("Unable to check '{0}' for caching: {1}".format(url, str(e)))
+            return None
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return None
+        return cache_key("download", r.url, etag, last_modified, r.headers.get('Content-Length'))
+
+    def prefetch(self, urls):
+        """Restore downloads from the build cache, in parallel where possible."""
+        self.cached_downloads = set()
+        self.cache_uploads = []
+        self.download_keys = {}
+        if not self.cache.enabled:
+            return
+
+        urls = list(urls)
+        with ThreadPoolExecutor(max_workers=self.cache.threads) as executor:
+            keys = executor.map(self._download_cache_key, urls)
+            self.download_keys = dict((url, key) for (url, key) in zip(urls, keys) if key is not None)
+
+        found = self.cache.get_many([(key, self.download_path(url)) for (url, key) in self.download_keys.items()])
+        self.cached_downloads = set(url for (url, key) in self.download_keys.items() if key in found)
+        _logger.info("Restored {0} of {1} downloads from build cache ({2}).".format(
+            len(self.cached_downloads), len(urls), self.cache))
+
+    def _fetched(self, url):
+        # Queue a fresh download for upload to the build cache
+        if url in self.download_keys:
+            self.cache_uploads.append((self.download_keys[url], self.download_path(url)))
+
+    def _download(self, url):
+        """Download a component, verifying it against its pin (if any)."""
+        filename = self.download_path(url)
+        pin = self.pins.get(url)
+
+        # Don't trust a cached copy any more than a fresh one
+        if url in self.cached_downloads:
+            try:
+                self.checksums[url] = verify(filename, pin)
+                return False
+            except DownloadException as e:
+                _logger.warning("Discarding cached download: {0}".format(str(e)))
+                os.unlink(filename)
+
+        sha256 = self.checksums[url] = download(url, filename, pin)
+        _logger.debug("Fetched '{0}' (sha256:{1})".format(url, sha256))
+        self._fetched(url)
+        return True
+
+    def fetch_all(self, core_urls, theme_urls, plugin_urls):
+        """Fetch all components in parallel, aborting on the first failure."""
+        fetches = [(self.fetch_core, url) for url in core_urls]
+        fetches += [(self.fetch_theme, url) for url in theme_urls]
+        fetches += [(self.fetch_plugin, url) for url in plugin_urls]
+        if len(fetches) == 0:
+            return
+
+        threads = int(os.getenv("WPCD_DOWNLOAD_THREADS", "4"))
+        executor = ThreadPoolExecutor(max_workers=threads)
+        try:
+            futures = [executor.submit(fetch, url) for (fetch, url) in fetches]
+            for future in as_completed(futures):
+                future.result()
+        finally:
+            # Abandon any fetches not yet started if one has failed
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def fetch_core(self, core_url):
-        """Download and deploy a copy of WordPress to the build folder."""
+        """Download a copy of WordPress to a temporary area."""
 
         # Fetch core
-        filename = "/tmp/{0}".format(os.path.basename(core_url))
         _logger.info("Fetching WordPress core from '{0}'...".format(core_url))
-        exitcode = subprocess.call(["curl", "--retry", "3", "-sSL", "-o", filename, core_url])
-        if exitcode > 0:
-            raise BuildException("Unable to download Wordpress. Exit code from curl: {0}".format(exitcode))
-
-    def install_core(self, core_url, build_dir):
-        """Deploy a copy of the specific WordPress version to the given build folder."""
-
-        # Unpack core, except for default themes and plugins
-        _logger.debug("Unpacking WordPress core '{0}' to build '{1}'...".format(
+        try:
+            if not self._download(core_url):
+                _logger.info("Using cached WordPress core from '{0}'.".format(core_url))
+        except DownloadException as e:
+            raise BuildException("Unable to download Wordpress: {0}".format(str(e)))
+
+    def unpack_core(self, core_url, dest_dir):
+        """Unpack a downloaded WordPress core, except for default themes and plugins."""
+        _logger.debug("Unpacking WordPress core '{0}' to '{1}'...".format(
             os.path.basename(core_url),
-            os.path.basename(build_dir)
+            dest_dir
         ))
-        os.chdir(build_dir)
-        zipfilename = "/tmp/{0}".format(os.path.basename(core_url))
-        exitcode = subprocess.call(["tar", "-xzf", zipfilename,
+        zipfilename = self.download_path(core_url)
+        exitcode = process.call(["tar", "-xzf", zipfilename, "-C", dest_dir,
             "--exclude=wordpress/wp-content/plugins/*",
             "--exclude=wordpress/wp-content/themes/*"
         ])
         if exitcode > 0:
             raise BuildException("Unable to unpack Wordpress. Exit code from 'tar': {0}".format(exitcode))
 
+    def install_core(self, core_url, build_dir):
+        """Deploy a copy of the specific WordPress version to the given build folder."""
+
+        if core_url in self.unpacked:
+            _logger.debug("Copying unpacked WordPress core '{0}' to build '{1}'...".format(
+                os.path.basename(core_url),
+                os.path.basename(build_dir)
+            ))
+            try:
+                copy_tree("{0}/wordpress".format(self.unpacked[core_url]), "{0}/wordpress".format(build_dir))
+            except OSError as e:
+                raise BuildException("Unable to copy Wordpress into place: {0}".format(str(e)))
+        else:
+            self.unpack_core(core_url, build_dir)
+
         # If themes/plugins folders are now missing, create empty ones.
-        for dir in ['plugins', 'themes']:
-            if not os.path.isdir('wordpress/wp-content/' + dir):
-                os.mkdir('wordpress/wp-content/' + dir)
+        for dir in ['plugins', 'themes', 'mu-plugins']:
+            content_dir = "{0}/wordpress/wp-content/{1}".format(build_dir, dir)
+            if not os.path.isdir(content_dir):
+                os.mkdir(content_dir)
 
 
     def _fetch_thing(self, type, url):
         """Download a copy of a WordPress theme or plugin to a temporary area."""
 
         # Fetch thing
-        zipfilename = "/tmp/{0}".format(os.path.basename(url))
         name = os.path.basename(url).replace(".zip", "")
         _logger.info("Fetching WordPress {0} '{1}' from '{2}'...".format(type, name, url))
-        exitcode = subprocess.call(["curl", "--retry", "3", "-sSL", "-o", zipfilename, url])
-        if exitcode > 0:
-            raise BuildException("Unable to download {0} '{1}'. Exit code: {2}".format(type, name, exitcode))
+        try:
+            if not self._download(url):
+                _logger.info("Using cached WordPress {0} '{1}'.".format(type, name))
+        except DownloadException as e:
+            raise BuildException("Unable to download {0} '{1}': {2}".format(type, name, str(e)))
 
     def fetch_plugin(self, url):
         self._fetch_thing("plugin", url)
@@ -351,40 +688,44 @@ class BuildSiteJobHandler(BuildJobHandler):
     def fetch_theme(self, url):
         self._fetch_thing("theme", url)
 
-    def _install_thing(self, url, dest_dirs):
-        """Deploy a copy of a WordPress theme or plugin to the given folders."""
-
-        # Create a temporary working space
-        tmp_dir = tempfile.mkdtemp()
-        os.chdir(tmp_dir)
-
-        # Unpack thing
+    def unpack_thing(self, url, dest_dir):
+        """Unpack a downloaded theme or plugin, returning its main folder."""
         name = os.path.basename(url).replace(".zip", "")
         _logger.debug("Unpacking '{0}'...".format(name))
-        zipfilename = "/tmp/{0}".format(os.path.basename(url))
-        exitcode = subprocess.call(["unzip", "-qo", zipfilename])
+        zipfilename = self.download_path(url)
+        exitcode = process.call(["unzip", "-qo", zipfilename, "-d", dest_dir])
         if exitcode > 0:
             raise BuildException("Unable to unpack '{0}'. Exit code: {1}".format(name, exitcode))
 
         # Ignore various directories that are included in some distros (e.g. seedprod)
-        unpacked_dir = None
-        folders = os.listdir(tmp_dir)
-        for folder in folders:
-            if folder not in ['__MACOSX', '.DS_Store']:
-                unpacked_dir = tmp_dir + "/" + folder
-                break
-        if unpacked_dir is None:
-            raise BuildException("Unable to identify main folder in '{0}' download.".format(name))
+        folder = first_entry(dest_dir, ['__MACOSX', '.DS_Store'])
+        if folder is not None:
+            return dest_dir + "/" + folder
+        raise BuildException("Unable to identify main folder in '{0}' download.".format(name))
+
+    def _install_thing(self, url, dest_dirs):
+        """Deploy a copy of a WordPress theme or plugin to the given folders."""
+        name = os.path.basename(url).replace(".zip", "")
+
+        # Unpack thing to a temporary working space, unless already unpacked
+        tmp_dir = None
+        if url in self.unpacked:
+            unpacked_dir = self.unpacked[url]
+        else:
+            tmp_dir = self.workspace.mkdtemp("unpack-")
+            unpacked_dir = self.unpack_thing(url, tmp_dir)
 
         # Copy thing into place for each dest dir
         for dest_dir in dest_dirs:
             _logger.debug("Copying '{0}' to {1}...".format(name, dest_dir))
-            exitcode = subprocess.call(["cp", "-r", unpacked_dir, dest_dir])
-            if exitcode > 0:
-                raise BuildException("Unable to copy '{0}' into place. Exit code: {1}".format(name, exitcode))
+            try:
+                copy_tree(unpacked_dir, os.path.join(dest_dir, os.path.basename(unpacked_dir)))
+            except OSError as e:
+                raise BuildException("Unable to copy '{0}' into place: {1}".format(name, str(e)))
 
         # Clear down temporary file amd folder
-        shutil.rmtree(tmp_dir)
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
 
     def install_plugin(self, url, dir):
         self._install_thing(url, dir)
@@ -393,24 +734,27 @@ class BuildSiteJobHandler(BuildJobHandler):
         self._install_thing(url, dir)
 
 
-def build_plugin(args):
-    module_id = os.getenv("JOB_BASE_NAME", os.path.basename(os.getcwd()))
-    job = BuildModuleJobHandler("plugin", module_id, args)
+def build_plugin(args, workspace = None):
+    workspace = workspace or Workspace(name="plugin")
+    job = BuildModuleJobHandler("plugin", get_module_id(workspace), args, workspace=workspace)
     return job._build_handling_exceptions()
 
-def build_theme(args):
-    module_id = os.getenv("JOB_BASE_NAME", os.path.basename(os.getcwd()))
-    job = BuildModuleJobHandler("theme", module_id, args)
+def build_theme(args, workspace = None):
+    workspace = workspace or Workspace(name="theme")
+    job = BuildModuleJobHandler("theme", get_module_id(workspace), args, workspace=workspace)
     return job._build_handling_exceptions()
 
-def build_site(args):
-    # Read build configuration file
-    with open("build.yml", 'r') as s:
-        try:
-            config = yaml.safe_load(s)
-        except yaml.YAMLError as e:
-            _logger.error(e)
-            return 1
+def read_build_config(filename = "build.yml"):
+    return load_config(filename)
 
-    job = BuildSiteJobHandler(config, args)
+def build_site(args, workspace = None):
+    # Read build configuration file
+    workspace = workspace or Workspace(name="site")
+    try:
+        config = read_build_config(workspace.path("build.yml"))
+    except ConfigException as e:
+        _logger.error(str(e))
+        return 1
+
+    job = BuildSiteJobHandler(config, args, workspace=workspace)
     return job._build_handling_exceptions()
@@ -0,0 +1,81 @@
+import os
+
+import logging
+_logger = logging.getLogger(__name__ + ".init")
+
+try:
+    from urllib.parse import urlparse
+except Exception:
+    from urlparse import urlparse
+
+from .base import BaseCache, cache_key, hash_file, hash_files, hash_tree
+from .directory import DirectoryCache
+from .layered import LayeredCache
+
+# Registry of remote cache backends, keyed by URL scheme
+cache_backends = {}
+
+# The cache instance shared by all jobs run in this process
+_cache = None
+
+
+# Decorator for registering remote cache backends
+def cache_backend(scheme):
+    def register(handler_class):
+        _logger.debug("Registering cache backend '%s' for '%s://' URLs" % (handler_class, scheme))
+        cache_backends[scheme] = handler_class
+        return handler_class
+
+    return register
+
+
+cache_backend('file')(DirectoryCache)
+
+
+def get_local_cache_dir():
+    # Where the local (L1) cache lives on this runner
+    try:
+        return os.environ['WPCD_CACHE_DIR']
+    except KeyError:
+        return os.path.join(os.path.expanduser("~"), ".cache", "wordpress-cd")
+
+
+def load_remote_cache(url):
+    urlbits = urlparse(url)
+    scheme = urlbits.scheme or 'file'
+
+    # Backends needing optional libraries are only imported on demand
+    if scheme == 's3':
+        from . import s3
+
+    try:
+        backend = cache_backends[scheme]
+    except KeyError:
+        _logger.error("Missing cache backend for '{0}' URLs.".format(scheme))
+        raise Exception("Configuration error.")
+
+    return backend.from_url(url)
+
+
+def load_cache():
+    """Return the build cache, a local cache with an optional remote one behind it."""
+    global _cache
+    if _cache is not None:
+        return _cache
+
+    if os.getenv("WPCD_CACHE", "1") == "0":
+        _logger.info("Build cache disabled.")
+        _cache = BaseCache()
+        return _cache
+
+    local = DirectoryCache(get_local_cache_dir())
+    remote = None
+    try:
+        remote_url = os.environ['WPCD_CACHE_URL']
+        remote = load_remote_cache(remote_url)
+        _logger.info("Using remote build cache at '{0}'.".format(remote_url))
+    except KeyError:
+        _logger.debug("No remote build cache configured.")
+
+    _cache = LayeredCache(local, remote)
+    return _cache
@@ -0,0 +1,165 @@
+import os
+import fnmatch
+import hashlib
+import tarfile
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(filename, algorithm = "sha256"):
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def safe_extract(tar, dest_dir):
+    """Extract a tar archive from a (shared) cache, refusing anything that would land outside 'dest_dir'."""
+    if hasattr(tarfile, 'data_filter'):
+        tar.extractall(dest_dir, filter='data')
+        return
+
+    # Older Pythons without extraction filters
+    root = os.path.realpath(dest_dir)
+    for member in tar.getmembers():
+        path = os.path.realpath(os.path.join(root, member.name))
+        if not (member.isfile() or member.isdir() or member.issym()):
+            raise tarfile.TarError("Refusing to extract special file '{0}'".format(member.name))
+        if member.issym():
+            target = os.path.realpath(os.path.join(os.path.dirname(path), member.linkname))
+            if os.path.isabs(member.linkname) or os.path.commonpath([root, target]) != root:
+                raise tarfile.TarError("Refusing to extract link '{0}' pointing outside the tree".format(member.name))
+        if os.path.commonpath([root, path]) != root:
+            raise tarfile.TarError("Refusing to extract '{0}' outside the tree".format(member.name))
+    tar.extractall(dest_dir)
+
+
+def hash_files(filenames):
+    """Hash the names and content of the given files, skipping missing ones."""
+    h = hashlib.sha256()
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            continue
+        h.update(os.path.basename(filename).encode('utf-8') + b'\0')
+        h.update(hash_file(filename).encode('ascii') + b'\0')
+    return h.hexdigest()
+
+
+def _is_excluded(name, excludes):
+    for pattern in excludes:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def hash_tree(root, excludes = []):
+    """Hash the relative paths, permissions and content of a folder tree.
+
+    Exclusion patterns are matched against each file/folder name, in the same
+    way as tar's '--exclude' patterns are used by the build stage.
+    """
+    h = hashlib.sha256()
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not _is_excluded(d, excludes))
+        for name in sorted(files):
+            if _is_excluded(name, excludes):
+                continue
+            filename = os.path.join(dirpath, name)
+            relpath = os.path.relpath(filename, root)
+            if os.path.islink(filename):
+                digest = os.readlink(filename)
+            else:
+                digest = hash_file(filename)
+            mode = os.lstat(filename).st_mode & 0o777
+            h.update("{0}\0{1:o}\0{2}\0".format(relpath, mode, digest).encode('utf-8'))
+    return h.hexdigest()
+
+
+def cache_key(namespace, *parts):
+    """Build a cache key from a namespace and the parts that identify an item."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode('utf-8') + b'\0')
+    return "{0}/{1}".format(namespace, h.hexdigest())
+
+
+# Superclass for build caches. On its own it behaves as an always-empty
+# cache, which is what is used when caching is disabled.
+class BaseCache(object):
+    enabled = False
+
+    def __init__(self, threads = None):
+        if threads is None:
+            threads = int(os.getenv("WPCD_CACHE_THREADS", "8"))
+        self.threads = threads
+
+    def __str__(self):
+        return "none"
+
+    def contains(self, key):
+        return False
+
+    # Copy the cached item into place at 'filename', returning whether it
+    # was found.
+    def get(self, key, filename):
+        return False
+
+    # Store the given file in the cache under 'key'.
+    def put(self, key, filename):
+        pass
+
+    def _map(self, fn, items):
+        items = list(items)
+        if len(items) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.threads, len(items))) as executor:
+            return list(executor.map(lambda item: fn(*item), items))
+
+    def get_many(self, items):
+        """Fetch (key, filename) pairs in parallel, returning the keys found."""
+        items = list(items)
+        found = self._map(self.get, items)
+        return [key for ((key, filename), hit) in zip(items, found) if hit]
+
+    def put_many(self, items):
+        """Store (key, filename) pairs in parallel."""
+        self._map(self.put, items)
+
+    def get_tree(self, key, dest_dir):
+        """Restore a cached folder tree (i.e. 'node_modules') into 'dest_dir'."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tar_file = os.path.join(tmp_dir, "tree.tar.gz")
+            if not self.get(key, tar_file):
+                return False
+            if os.path.isdir(dest_dir):
+                shutil.rmtree(dest_dir)
+            os.makedirs(dest_dir)
+            try:
+                with tarfile.open(tar_file, "r:gz") as tar:
+                    safe_extract(tar, dest_dir)
+            except tarfile.TarError as e:
+                _logger.warning("Ignoring bad cached tree '{0}': {1}".format(key, str(e)))
+                shutil.rmtree(dest_dir)
+                return False
+            return True
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def put_tree(self, key, src_dir):
+        """Store a folder tree in the cache as a single compressed archive."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tar_file = os.path.join(tmp_dir, "tree.tar.gz")
+            with tarfile.open(tar_file, "w:gz") as tar:
+                tar.add(src_dir, arcname=".")
+            self.put(key, tar_file)
+        finally:
+            shutil.rmtree(tmp_dir)
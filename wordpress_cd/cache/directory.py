@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .base import BaseCache
+
+
+# Cache backend storing items as files in a plain directory, which may be
+# local to the runner or a shared (i.e. NFS) mount.
+class DirectoryCache(BaseCache):
+    enabled = True
+
+    def __init__(self, root, threads = None):
+        super(DirectoryCache, self).__init__(threads)
+        self.root = root
+
+    def __str__(self):
+        return "directory:{0}".format(self.root)
+
+    @classmethod
+    def from_url(cls, url):
+        if url.startswith("file://"):
+            url = url[len("file://"):]
+        return cls(url)
+
+    def _path(self, key):
+        namespace, digest = key.split("/", 1)
+        return os.path.join(self.root, namespace, digest[:2], digest)
+
+    def contains(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key, filename):
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return False
+        _logger.debug("Cache hit for '{0}' in {1}".format(key, self))
+        self._copy_atomic(path, filename)
+        return True
+
+    def put(self, key, filename):
+        path = self._path(key)
+        if os.path.isfile(path):
+            return
+        _logger.debug("Storing '{0}' in {1}".format(key, self))
+        self._copy_atomic(filename, path)
+
+    def _copy_atomic(self, src, dst):
+        # Copy via a temporary file alongside the destination, so concurrent
+        # readers never see a partially written item
+        dst_dir = os.path.dirname(dst) or "."
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=dst_dir, prefix=".wpcd-")
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_file)
+            os.chmod(tmp_file, 0o644)
+            os.replace(tmp_file, dst)
+        except Exception:
+            os.unlink(tmp_file)
+            raise
@@ -0,0 +1,51 @@
+import logging
+_logger = logging.getLogger(__name__)
+
+from .base import BaseCache
+
+
+# A fast local (L1) cache in front of an optional shared remote cache.
+# Items found remotely are copied into the local cache on the way through,
+# and items stored are written to both.
+class LayeredCache(BaseCache):
+    enabled = True
+
+    def __init__(self, local, remote = None):
+        super(LayeredCache, self).__init__()
+        self.local = local
+        self.remote = remote
+
+    def __str__(self):
+        if self.remote is None:
+            return str(self.local)
+        return "{0} -> {1}".format(self.local, self.remote)
+
+    def contains(self, key):
+        if self.local.contains(key):
+            return True
+        return self.remote is not None and self.remote.contains(key)
+
+    def get(self, key, filename):
+        if self.local.get(key, filename):
+            return True
+        if self.remote is None:
+            return False
+        try:
+            if not self.remote.get(key, filename):
+                return False
+        except Exception as e:
+            _logger.warning("Unable to read '{0}' from remote cache: {1}".format(key, str(e)))
+            return False
+        self.local.put(key, filename)
+        return True
+
+    def put(self, key, filename):
+        self.local.put(key, filename)
+        if self.remote is None:
+            return
+        try:
+            if not self.remote.contains(key):
+                self.remote.put(key, filename)
+        except Exception as e:
+            # A remote cache failure should never fail the build itself
+            _logger.warning("Unable to write '{0}' to remote cache: {1}".format(key, str(e)))
@@ -0,0 +1,74 @@
+import os
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from . import cache_backend
+from .base import BaseCache
+from wordpress_cd.s3 import get_s3_client, parse_s3_url
+
+
+# Cache backend storing items in an S3-compatible bucket. Set
+# 'WPCD_S3_ENDPOINT_URL' to point it at a non-AWS (or local) S3 service.
+@cache_backend('s3')
+class S3Cache(BaseCache):
+    enabled = True
+
+    def __init__(self, bucket, prefix = "", threads = None):
+        super(S3Cache, self).__init__(threads)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = get_s3_client()
+
+        # Large items (i.e. dependency trees) are transferred as parallel
+        # multipart uploads/downloads
+        self.transfer_config = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            max_concurrency=self.threads,
+        )
+
+    def __str__(self):
+        return "s3://{0}/{1}".format(self.bucket, self.prefix)
+
+    @classmethod
+    def from_url(cls, url):
+        bucket, prefix = parse_s3_url(url)
+        return cls(bucket, prefix)
+
+    def _key(self, key):
+        if self.prefix == "":
+            return key
+        return "{0}/{1}".format(self.prefix, key)
+
+    def contains(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return False
+            raise
+
+    def get(self, key, filename):
+        tmp_file = filename + ".wpcd-part"
+        try:
+            self.client.download_file(self.bucket, self._key(key), tmp_file,
+                Config=self.transfer_config)
+            os.replace(tmp_file, filename)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return False
+            raise
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        _logger.debug("Cache hit for '{0}' in {1}".format(key, self))
+        return True
+
+    def put(self, key, filename):
+        _logger.debug("Storing '{0}' in {1}".format(key, self))
+        self.client.upload_file(filename, self.bucket, self._key(key),
+            Config=self.transfer_config)
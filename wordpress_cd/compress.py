@@ -0,0 +1,168 @@
+# Generates pre-compressed ('.gz' and '.br') siblings of static assets, so
+# web servers (i.e. nginx with 'gzip_static'/'brotli_static') can serve them
+# without compressing on the fly.
+
+import os
+import gzip
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .cache import load_cache, hash_file
+from . import process
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = [
+    '.css', '.js', '.mjs', '.map', '.json', '.xml', '.svg', '.txt',
+    '.html', '.htm', '.ico', '.ttf', '.otf', '.eot',
+]
+
+SUFFIXES = {
+    'gzip': '.gz',
+    'brotli': '.br',
+}
+
+
+def brotli_available():
+    return brotli is not None or shutil.which("brotli") is not None
+
+
+def _compress(data, format):
+    if format == 'gzip':
+        # A fixed mtime keeps the output reproducible between builds
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        return brotli.compress(data, quality=11)
+    proc = process.run(["brotli", "-c", "-q", "11"], input=data,
+        stdout=subprocess.PIPE, check=True)
+    return proc.stdout
+
+
+def _hash(filename):
+    return filename, hash_file(filename)
+
+
+def _cache_key(format, sha256):
+    return "precompress-{0}/{1}".format(format, sha256)
+
+
+def _compress_file(item):
+    # Runs in a worker process. Compresses one unique piece of content into
+    # a file per format in 'out_dir', returning the resulting sizes.
+    filename, sha256, formats, out_dir = item
+    with open(filename, 'rb') as f:
+        data = f.read()
+    sizes = {}
+    for format in formats:
+        compressed = _compress(data, format)
+        with open(os.path.join(out_dir, _cache_key(format, sha256)), 'wb') as f:
+            f.write(compressed)
+        sizes[format] = len(compressed)
+    return sha256, sizes
+
+
+def _find_assets(root, extensions, min_size):
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in extensions:
+                continue
+            filename = os.path.join(dirpath, name)
+            if os.path.islink(filename) or os.path.getsize(filename) < min_size:
+                continue
+            yield filename
+
+
+def precompress_trees(roots, formats = ['gzip', 'brotli'], min_size = 1024,
+        extensions = COMPRESSIBLE_EXTENSIONS, workers = None):
+    """Write compressed siblings for the static assets in each of the given trees.
+
+    Files with identical content (i.e. the same plugin in several builds) are
+    only compressed once, and results are kept in the build cache keyed
+    by the content hash, so unchanged assets are never compressed again. A
+    sibling is only written where it is actually smaller than the original.
+    Returns statistics for the build report.
+    """
+    if 'brotli' in formats and not brotli_available():
+        _logger.warning("No 'brotli' module or command available, skipping '.br' files.")
+        formats = [f for f in formats if f != 'brotli']
+    for format in formats:
+        if format not in SUFFIXES:
+            raise ValueError("Unknown compression format '{0}'.".format(format))
+
+    filenames = []
+    for root in roots:
+        filenames.extend(_find_assets(root, extensions, min_size))
+
+    stats = {
+        'files': len(filenames),
+        'unique_files': 0,
+        'cached': 0,
+        'original_bytes': 0,
+    }
+    for format in formats:
+        stats['{0}_files'.format(format)] = 0
+        stats['{0}_bytes'.format(format)] = 0
+    if len(filenames) == 0 or len(formats) == 0:
+        return stats
+
+    if workers is None:
+        workers = int(os.getenv("WPCD_PRECOMPRESS_WORKERS", "0")) or os.cpu_count()
+    cache = load_cache()
+    out_dir = tempfile.mkdtemp(prefix="wpcd-precompress-")
+    try:
+        for format in formats:
+            os.makedirs(os.path.join(out_dir, "precompress-{0}".format(format)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Identify unique content first, then compress each just once
+            hashes = dict(executor.map(_hash, filenames, chunksize=64))
+            unique = {}
+            for filename in filenames:
+                unique.setdefault(hashes[filename], filename)
+            stats['unique_files'] = len(unique)
+
+            # Anything compressed by an earlier build comes from the cache
+            results = dict((sha256, {}) for sha256 in unique)
+            found = cache.get_many((_cache_key(format, sha256), os.path.join(out_dir, _cache_key(format, sha256)))
+                for sha256 in unique for format in formats)
+            for key in found:
+                format, sha256 = key[len("precompress-"):].split("/")
+                results[sha256][format] = os.path.getsize(os.path.join(out_dir, key))
+            stats['cached'] = len(found)
+
+            items = [(filename, sha256, [format for format in formats if format not in results[sha256]], out_dir)
+                for (sha256, filename) in unique.items() if len(results[sha256]) < len(formats)]
+            compressed = []
+            for sha256, sizes in executor.map(_compress_file, items, chunksize=16):
+                results[sha256].update(sizes)
+                compressed += [_cache_key(format, sha256) for format in sizes]
+            cache.put_many((key, os.path.join(out_dir, key)) for key in compressed)
+
+        # Copy the compressed variants alongside every copy of the original
+        for filename in filenames:
+            sha256 = hashes[filename]
+            original_size = os.path.getsize(filename)
+            stats['original_bytes'] += original_size
+            for format in formats:
+                size = results[sha256][format]
+                if size >= original_size:
+                    stats['{0}_bytes'.format(format)] += original_size
+                    continue
+                sibling = filename + SUFFIXES[format]
+                shutil.copyfile(os.path.join(out_dir, _cache_key(format, sha256)), sibling)
+                shutil.copystat(filename, sibling)
+                stats['{0}_files'.format(format)] += 1
+                stats['{0}_bytes'.format(format)] += size
+    finally:
+        shutil.rmtree(out_dir)
+
+    for format in formats:
+        stats['{0}_saved_bytes'.format(format)] = stats['original_bytes'] - stats['{0}_bytes'.format(format)]
+    return stats
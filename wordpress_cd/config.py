@@ -0,0 +1,330 @@
+# Loading and checking site build configs ('build.yml').
+#
+# Configs are parsed with libyaml's C loader where PyYAML was built with
+# it, and checked as a whole against the schema below before anything else
+# happens, so a mistake (e.g. a build using a layer that isn't defined)
+# fails the build straight away, with every problem listed. Layers can be
+# shared between sites by listing files defining them under 'include'.
+#
+# Checked configs are kept in memory, keyed by the hashes of the files they
+# were read from, so the daemon's workers and batch builds only parse and
+# check each config again once it (or a file it includes) has changed.
+
+import os
+import copy
+import hashlib
+import threading
+import yaml
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .download import parse_pin, DownloadException
+from .wporg import COMPONENT_TYPES, Constraint, ResolveException, is_reference, parse_reference
+
+# The fastest loader available
+try:
+    Loader = yaml.CSafeLoader
+except AttributeError:
+    Loader = yaml.SafeLoader
+
+_lock = threading.Lock()
+_cache = {}
+
+
+class ConfigException(Exception):
+    pass
+
+
+# The schema is made of the following checks, each returning the value
+# (normalised where need be) and adding any problems to 'errors'
+
+class Check(object):
+    description = "a value"
+    types = (object,)
+
+    def check(self, value, path, errors):
+        return value
+
+
+class Str(Check):
+    description = "a string"
+
+    def check(self, value, path, errors):
+        if not isinstance(value, str):
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+        return value
+
+
+class Bool(Check):
+    description = "true or false"
+    types = (bool,)
+
+    def check(self, value, path, errors):
+        if not isinstance(value, bool):
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+        return value
+
+
+class Int(Check):
+    description = "a whole number"
+
+    def check(self, value, path, errors):
+        if isinstance(value, bool) or not isinstance(value, int):
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+        return value
+
+
+class Choice(Str):
+    def __init__(self, *choices):
+        self.choices = choices
+        self.description = "one of: {0}".format(", ".join(choices))
+
+    def check(self, value, path, errors):
+        if value not in self.choices:
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+        return value
+
+
+class List(Check):
+    """A list of items (an empty entry being an empty list)."""
+
+    def __init__(self, item):
+        self.item = item
+        self.description = "a list"
+
+    def check(self, value, path, errors):
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+            return value
+        return [self.item.check(item, "{0}[{1}]".format(path, i), errors) for (i, item) in enumerate(value)]
+
+
+class Map(Check):
+    """A mapping with the given keys. Keys starting 'x-' are ignored, i.e. for YAML anchors."""
+
+    description = "a mapping"
+    types = (dict,)
+
+    def __init__(self, fields, required = ()):
+        self.fields = fields
+        self.required = required
+
+    def check(self, value, path, errors):
+        if value is None and len(self.required) == 0:
+            return {}
+        if not isinstance(value, dict):
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+            return value
+        result = {}
+        for (key, item) in value.items():
+            key_path = _join(path, key)
+            if str(key).startswith("x-"):
+                continue
+            if key not in self.fields:
+                errors.append("{0}: unknown setting (expected one of: {1})".format(key_path, ", ".join(sorted(self.fields.keys()))))
+                continue
+            result[key] = self.fields[key].check(item, key_path, errors)
+        for key in self.required:
+            if key not in value:
+                errors.append("{0}: missing '{1}'".format(path or "(top level)", key))
+        return result
+
+
+class MapOf(Check):
+    """A mapping of names to values."""
+
+    description = "a mapping of names"
+
+    def __init__(self, item):
+        self.item = item
+
+    def check(self, value, path, errors):
+        if value is None:
+            return {}
+        if not isinstance(value, dict):
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+            return value
+        return dict((str(key), self.item.check(item, _join(path, key), errors)) for (key, item) in value.items())
+
+
+class Either(Check):
+    """One of the given checks, chosen by the type of the value."""
+
+    def __init__(self, *checks):
+        self.checks = checks
+        self.description = " or ".join(check.description for check in checks)
+
+    def check(self, value, path, errors):
+        for check in self.checks:
+            if isinstance(value, check.types):
+                return check.check(value, path, errors)
+        errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+        return value
+
+
+class Component(Check):
+    """A download URL, a WordPress.org reference or a mapping with a 'url' and 'sha256' pin."""
+
+    description = "a URL, a 'slug@constraint' reference or a mapping with a 'url'"
+
+    def __init__(self):
+        self.pinned = Map({'url': Str(), 'sha256': Str()}, required=('url',))
+
+    def check(self, value, path, errors):
+        if isinstance(value, dict):
+            value = self.pinned.check(value, path, errors)
+            if isinstance(value.get('sha256'), str):
+                try:
+                    parse_pin(value['sha256'])
+                except DownloadException as e:
+                    errors.append("{0}.sha256: {1}".format(path, str(e)))
+            return value
+        if not isinstance(value, str) or value.strip() == "":
+            errors.append("{0}: expected {1}, found {2}".format(path, self.description, _describe(value)))
+            return value
+        if "://" not in value:
+            if not is_reference(value):
+                errors.append("{0}: '{1}' is neither a URL nor a 'slug@constraint' reference".format(path, value))
+                return value
+            try:
+                Constraint(parse_reference(value)[1])
+            except ResolveException as e:
+                errors.append("{0}: {1}".format(path, str(e)))
+        return value
+
+
+LAYER = Map(dict((name, List(Component())) for name in COMPONENT_TYPES.keys()))
+
+SCHEMA = Map({
+    'include': List(Str()),
+    'builds': MapOf(Map({
+        'core': Component(),
+        'layers': List(Str()),
+    }, required=('core', 'layers'))),
+    'layers': MapOf(LAYER),
+    'extra-files': List(Str()),
+    'precompress': Either(Bool(), Map({
+        'formats': List(Choice('gzip', 'brotli')),
+        'min-size': Int(),
+    })),
+    'opcache-preload': Either(Bool(), Map({
+        'access-log': Str(),
+        'limit': Int(),
+    })),
+}, required=('builds',))
+
+# Included files only share layers (and may include others in turn)
+INCLUDE_SCHEMA = Map({
+    'include': List(Str()),
+    'layers': MapOf(LAYER),
+})
+
+
+def _join(path, key):
+    return "{0}.{1}".format(path, key) if path else str(key)
+
+def _describe(value):
+    if value is None:
+        return "nothing"
+    if isinstance(value, bool):
+        return "'{0}'".format(str(value).lower())
+    if isinstance(value, (dict, list)):
+        return "a mapping" if isinstance(value, dict) else "a list"
+    return "'{0}'".format(value)
+
+
+def parse_yaml(data, loader = None):
+    return yaml.load(data, Loader=loader or Loader)
+
+
+def _read(filename, loader, schema, errors, files, stack):
+    """Read and check a config file, and those it includes, returning it with the included layers merged in."""
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        raise ConfigException("Unable to read '{0}': {1}".format(filename, e.strerror))
+    files[filename] = hashlib.sha256(data).hexdigest()
+    try:
+        config = parse_yaml(data, loader)
+    except yaml.YAMLError as e:
+        raise ConfigException("Unable to parse '{0}': {1}".format(filename, str(e)))
+
+    # Problems in included files are prefixed with the file they're in
+    file_errors = []
+    config = schema.check(config, "", file_errors)
+    if len(stack) > 0:
+        file_errors = ["{0}: {1}".format(os.path.relpath(filename), error) for error in file_errors]
+    errors += file_errors
+    if not isinstance(config, dict) or not isinstance(config.get('layers', {}), dict):
+        return config
+
+    # The site's own layers take precedence over included ones
+    layers = {}
+    includes = config.get('include', [])
+    for include in includes if isinstance(includes, list) else []:
+        if not isinstance(include, str):
+            continue
+        include_file = os.path.normpath(os.path.join(os.path.dirname(filename), include))
+        if include_file in stack:
+            raise ConfigException("'{0}' includes itself (via '{1}').".format(include_file, filename))
+        included = _read(include_file, loader, INCLUDE_SCHEMA, errors, files, stack + [filename])
+        if isinstance(included, dict):
+            layers.update(included.get('layers', {}))
+    if len(layers) > 0 or 'layers' in config:
+        layers.update(config.get('layers', {}))
+        config['layers'] = layers
+    return config
+
+
+def check_references(config, errors):
+    """Check that the layers each build uses are defined."""
+    layers = config.get('layers', {})
+    builds = config.get('builds', {})
+    for (build_ref, build_spec) in builds.items() if isinstance(builds, dict) else []:
+        build_layers = build_spec.get('layers', []) if isinstance(build_spec, dict) else []
+        for (i, layer_ref) in enumerate(build_layers if isinstance(build_layers, list) else []):
+            if layer_ref not in layers:
+                errors.append("builds.{0}.layers[{1}]: unknown layer '{2}' (expected one of: {3})".format(
+                    build_ref, i, layer_ref, ", ".join(sorted(layers.keys())) or "none defined"))
+
+
+def _unchanged(files):
+    for (filename, digest) in files.items():
+        try:
+            with open(filename, 'rb') as f:
+                if hashlib.sha256(f.read()).hexdigest() != digest:
+                    return False
+        except IOError:
+            return False
+    return True
+
+
+def load_config(filename = "build.yml", loader = None):
+    """Read, check and return a site build config, raising 'ConfigException' with any problems found.
+
+    The config returned is the caller's own to change. Giving a YAML
+    'loader' to parse with (rather than the fastest) skips the cache.
+    """
+    filename = os.path.abspath(filename)
+    with _lock:
+        entry = _cache.get(filename)
+    if entry is not None and loader is None and _unchanged(entry[0]):
+        _logger.debug("Using checked config from '{0}'".format(filename))
+        return copy.deepcopy(entry[1])
+
+    errors = []
+    files = {}
+    config = _read(filename, loader, SCHEMA, errors, files, [])
+    if isinstance(config, dict):
+        config.setdefault('layers', {})
+        check_references(config, errors)
+    if len(errors) > 0:
+        raise ConfigException("Invalid build config '{0}':\n  {1}".format(os.path.basename(filename), "\n  ".join(errors)))
+
+    with _lock:
+        _cache[filename] = (files, config)
+    return copy.deepcopy(config)
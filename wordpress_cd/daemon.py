@@ -0,0 +1,475 @@
+# Long-running build daemon. Accepts build/test/deploy jobs over a local
+# HTTP API and runs them on a pool of warm worker processes, so each job
+# avoids the start-up cost of a fresh process and shares the caches built
+# up by earlier ones. Clients need the daemon's token, which it writes to a
+# file only its user can read.
+#
+#   wpcd-daemon [-v] [-d]
+#
+# With 'WPCD_DAEMON_URL' set, the usual console scripts ('build-wp-site'
+# etc) submit their job to the daemon and wait for the result, instead of
+# running it themselves.
+
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import secrets
+import argparse
+import threading
+import collections
+import requests
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import logging
+_logger = logging.getLogger(__name__)
+
+COMMANDS = [
+    'build-wp-site', 'test-wp-site', 'deploy-wp-site',
+    'build-wp-plugin', 'test-wp-plugin', 'deploy-wp-plugin',
+    'build-wp-theme', 'test-wp-theme', 'deploy-wp-theme',
+]
+
+# Environment variables identifying the target a deploy/test job affects,
+# so two jobs for the same target are never run at once
+TARGET_ENV = ['WPCD_PLATFORM', 'SSH_HOST', 'SSH_PATH', 'WPCD_SITE_URL']
+
+# Environment variables that differ between otherwise identical CI jobs
+VOLATILE_ENV = [
+    'CI_JOB_ID', 'CI_JOB_URL', 'CI_JOB_STARTED_AT', 'CI_JOB_TOKEN',
+    'CI_PIPELINE_ID', 'CI_PIPELINE_IID', 'CI_PIPELINE_URL',
+    'BUILD_ID', 'BUILD_NUMBER', 'BUILD_TAG', 'BUILD_URL', 'EXECUTOR_NUMBER',
+    'WPCD_JOB_ID', 'PWD', 'OLDPWD', 'SHLVL', '_',
+]
+
+# Environment variables passed on from a client to its job: the settings
+# of wordpress-cd and its drivers, and those identifying the CI job.
+# Anything else (i.e. 'PATH' or 'LD_PRELOAD') is the daemon's own.
+JOB_ENV_PREFIXES = ('WPCD_', 'SSH_', 'WP_', 'AWS_', 'TEST_DATASET_', 'CI_', 'GIT_', 'JOB_', 'BUILD_')
+JOB_ENV = ['CI', 'GITLAB_CI', 'JENKINS_URL', 'EXECUTOR_NUMBER']
+
+# ...except for these, which name code for the workers to load, so are only
+# ever taken from the daemon's environment (as are its own settings)
+DAEMON_ENV = ['WPCD_DRIVERS', 'WPCD_NOTIFICATIONS']
+
+DEFAULT_LISTEN = "127.0.0.1:8765"
+
+# The daemon's environment, kept by each worker to start each job from
+_daemon_env = {}
+
+
+class DaemonException(Exception):
+    pass
+
+
+class JobArgs(object):
+    """Stands in for the parsed command line arguments of a submitted job."""
+
+    def __init__(self, verbose = False, debug = False):
+        self.verbose = verbose
+        self.debug = debug
+
+
+def is_job_env(name):
+    """Whether an environment variable is passed on from a client to its job."""
+    if name in DAEMON_ENV or name.startswith("WPCD_DAEMON_"):
+        return False
+    return name in JOB_ENV or name.startswith(JOB_ENV_PREFIXES)
+
+def job_env(env):
+    return dict((name, value) for (name, value) in env.items() if is_job_env(name))
+
+
+def _init_worker(workers):
+    global _daemon_env
+    _daemon_env = dict((name, value) for (name, value) in os.environ.items()
+        if not is_job_env(name) and not name.startswith("WPCD_DAEMON_"))
+
+    # Import everything a job might need up front, so jobs start warm
+    import wordpress_cd.build
+    import wordpress_cd.test
+    import wordpress_cd.deploy
+
+    # Every worker may be deploying at once, so each gets a share of the
+    # bandwidth caps
+    from wordpress_cd.throttle import set_processes
+    set_processes(workers)
+
+
+def _run_job(command, cwd, env, verbose, debug, log_file):
+    # Runs in a worker process, one job at a time. Returns the exit code
+    # and anything the job would have printed to stdout for its client.
+    os.environ.clear()
+    os.environ.update(_daemon_env)
+    os.environ.update(job_env(env))
+
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s', '%Y-%m-%d %H:%M:%S'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG if debug else logging.INFO if verbose else logging.WARNING)
+    import wordpress_cd.dryrun
+    wordpress_cd.dryrun._collected = []
+    try:
+        # Caches are configured from the environment, which is the job's own
+        import wordpress_cd.cache
+        wordpress_cd.cache._cache = None
+
+        from wordpress_cd.main import run_command
+        from wordpress_cd.workspace import Workspace
+        exitcode = run_command(command, JobArgs(verbose, debug), Workspace(cwd))
+        exitcode = exitcode if isinstance(exitcode, int) else 1
+    except Exception as e:
+        logging.getLogger(__name__).exception(str(e))
+        exitcode = 1
+    finally:
+        root.removeHandler(handler)
+        handler.close()
+    output = "".join(text + "\n" for text in wordpress_cd.dryrun._collected)
+    wordpress_cd.dryrun._collected = None
+    return exitcode, output
+
+
+class DaemonJob(object):
+    def __init__(self, command, cwd, env, verbose, debug, log_dir):
+        self.id = uuid.uuid4().hex[:12]
+        self.command = command
+        self.cwd = cwd
+        self.env = env
+        self.verbose = verbose
+        self.debug = debug
+        self.state = "queued"
+        self.exitcode = None
+        self.output = ""
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.log_file = os.path.join(log_dir, "{0}.log".format(self.id))
+        self.done = threading.Event()
+
+        # Identical jobs (same command, folder and environment) are deduped
+        h = hashlib.sha256()
+        stable_env = sorted((k, v) for (k, v) in env.items() if k not in VOLATILE_ENV)
+        h.update(json.dumps([command, cwd, stable_env]).encode('utf-8'))
+        self.key = h.hexdigest()
+
+        # Jobs working in the same project folder take turns, as do those
+        # affecting the same target
+        self.lock_keys = ["dir:" + cwd]
+        if not command.startswith("build-"):
+            self.lock_keys.append("target:" + json.dumps([env.get(e) for e in TARGET_ENV] + [env.get('WPCD_BUILD_REF'), cwd if command.endswith("-site") else command]))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'command': self.command,
+            'cwd': self.cwd,
+            'state': self.state,
+            'exitcode': self.exitcode,
+            'output': self.output,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class Scheduler(object):
+    """Queues jobs and runs them on a worker pool, one at a time per site/target."""
+
+    def __init__(self, workers, log_dir, retention = 86400):
+        self.workers = workers
+        self.log_dir = log_dir
+        self.retention = retention
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(workers,))
+        self.jobs = {}
+        self.queue = []
+
+        # Jobs queued or running, by key, for merging identical ones, and
+        # those finished, oldest first, to forget once the retention is up
+        self.active = {}
+        self.finished = collections.deque()
+        self.locks = set()
+        self.running = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._dispatch, daemon=True)
+        self.thread.start()
+
+    def submit(self, command, cwd, env, verbose = False, debug = False):
+        if command not in COMMANDS:
+            raise DaemonException("Unknown command '{0}'.".format(command))
+        job = DaemonJob(command, cwd, job_env(env), verbose, debug, self.log_dir)
+        with self.condition:
+            existing = self.active.get(job.key)
+            if existing is not None:
+                _logger.info("Job {0} ({1} in '{2}') matches job {3} in progress.".format(job.id, command, cwd, existing.id))
+                return existing
+            self.jobs[job.id] = job
+            self.active[job.key] = job
+            self.queue.append(job)
+            self.condition.notify_all()
+        _logger.info("Queued job {0} ({1} in '{2}').".format(job.id, command, cwd))
+        return job
+
+    def _next_job(self):
+        # The oldest queued job whose folder and target aren't busy
+        for job in self.queue:
+            if self.locks.isdisjoint(job.lock_keys):
+                return job
+        return None
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                job = None
+                while job is None:
+                    if self.running < self.workers:
+                        job = self._next_job()
+                    if job is None:
+                        self.condition.wait()
+                self.queue.remove(job)
+                self.locks.update(job.lock_keys)
+                self.running += 1
+                job.state = "running"
+                job.started = time.time()
+            _logger.info("Starting job {0} ({1} in '{2}').".format(job.id, job.command, job.cwd))
+            future = self.pool.submit(_run_job, job.command, job.cwd, job.env,
+                job.verbose, job.debug, job.log_file)
+            future.add_done_callback(lambda f, job=job: self._finished(job, f))
+
+    def _finished(self, job, future):
+        try:
+            job.exitcode, job.output = future.result()
+        except Exception as e:
+            _logger.error("Job {0} crashed: {1}".format(job.id, str(e)))
+            job.exitcode = 1
+        with self.condition:
+            job.state = "succeeded" if job.exitcode == 0 else "failed"
+            job.finished = time.time()
+            self.locks.difference_update(job.lock_keys)
+            self.running -= 1
+            del self.active[job.key]
+            self.finished.append(job)
+            expired = self._expire(job.finished - self.retention)
+            self.condition.notify_all()
+        job.done.set()
+        _logger.info("Job {0} {1} (exit code {2}).".format(job.id, job.state, job.exitcode))
+        for old in expired:
+            try:
+                os.remove(old.log_file)
+            except OSError:
+                pass
+
+    def _expire(self, before):
+        # Forget jobs that finished before a time, returning them
+        expired = []
+        while len(self.finished) > 0 and self.finished[0].finished < before:
+            old = self.finished.popleft()
+            del self.jobs[old.id]
+            expired.append(old)
+        return expired
+
+    def status(self):
+        with self.condition:
+            return {
+                'workers': self.workers,
+                'running': self.running,
+                'queued': len(self.queue),
+                'jobs': len(self.jobs),
+            }
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    scheduler = None
+    token = None
+
+    def log_message(self, format, *args):
+        _logger.debug(format % args)
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorised(self):
+        # Every request needs the daemon's token, as jobs run as its user
+        header = self.headers.get('Authorization', "")
+        if hmac.compare_digest(header.encode('utf-8'), "Bearer {0}".format(self.token).encode('utf-8')):
+            return True
+        self._reply(401, {'error': "Missing or wrong daemon token."})
+        return False
+
+    def _job(self, job_id):
+        job = self.scheduler.jobs.get(job_id)
+        if job is None:
+            self._reply(404, {'error': "No such job '{0}'.".format(job_id)})
+        return job
+
+    def do_GET(self):
+        if not self._authorised():
+            return
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["status"]:
+            return self._reply(200, self.scheduler.status())
+        if parts == ["jobs"]:
+            return self._reply(200, [job.to_dict() for job in self.scheduler.jobs.values()])
+        if len(parts) >= 2 and parts[0] == "jobs":
+            job = self._job(parts[1])
+            if job is None:
+                return
+            if len(parts) == 2:
+                return self._reply(200, job.to_dict())
+            if parts[2] == "wait":
+                # Long poll, so clients needn't poll rapidly
+                job.done.wait(30)
+                return self._reply(200, job.to_dict())
+            if parts[2] == "log":
+                log = ""
+                if os.path.isfile(job.log_file):
+                    with open(job.log_file, 'r', errors='replace') as f:
+                        log = f.read()
+                return self._reply(200, {'id': job.id, 'log': log})
+        self._reply(404, {'error': "Not found."})
+
+    def do_POST(self):
+        if not self._authorised():
+            return
+        if self.path.strip("/") != "jobs":
+            return self._reply(404, {'error': "Not found."})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = self.scheduler.submit(request['command'], request['cwd'],
+                request.get('env', {}), request.get('verbose', False), request.get('debug', False))
+        except (ValueError, KeyError) as e:
+            return self._reply(400, {'error': "Invalid request: {0}".format(str(e))})
+        except DaemonException as e:
+            return self._reply(400, {'error': str(e)})
+        self._reply(202, job.to_dict())
+
+
+def get_daemon_url():
+    return os.getenv("WPCD_DAEMON_URL", "http://{0}".format(DEFAULT_LISTEN)).rstrip("/")
+
+def get_token_file():
+    return os.getenv("WPCD_DAEMON_TOKEN_FILE", os.path.join(os.path.expanduser("~"), ".cache", "wordpress-cd", "daemon-token"))
+
+def get_daemon_token():
+    """The token for talking to the daemon, from 'WPCD_DAEMON_TOKEN' or the daemon's token file."""
+    token = os.getenv("WPCD_DAEMON_TOKEN")
+    if token is None:
+        try:
+            with open(get_token_file(), 'r') as f:
+                token = f.read().strip()
+        except IOError as e:
+            raise DaemonException("Unable to read the daemon's token from '{0}': {1}".format(get_token_file(), e.strerror))
+    return token
+
+def write_token_file(token):
+    """Write the daemon's token to a file only its user can read."""
+    filename = get_token_file()
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token + "\n")
+    return filename
+
+
+def submit(command_run, args):
+    """Run a job via the daemon and wait for it, returning its exit code."""
+    url = get_daemon_url()
+    try:
+        headers = {'Authorization': "Bearer {0}".format(get_daemon_token())}
+    except DaemonException as e:
+        _logger.error(str(e))
+        return 1
+    try:
+        r = requests.post(url + "/jobs", json={
+            'command': command_run,
+            'cwd': os.getcwd(),
+            'env': job_env(os.environ),
+            'verbose': args.verbose,
+            'debug': args.debug,
+        }, headers=headers, timeout=30)
+        r.raise_for_status()
+        job = r.json()
+        _logger.info("Submitted job {0} to build daemon at '{1}'.".format(job['id'], url))
+        while job['state'] in ["queued", "running"]:
+            r = requests.get("{0}/jobs/{1}/wait".format(url, job['id']), headers=headers, timeout=60)
+            r.raise_for_status()
+            job = r.json()
+        r = requests.get("{0}/jobs/{1}/log".format(url, job['id']), headers=headers, timeout=30)
+        r.raise_for_status()
+        sys.stderr.write(r.json()['log'])
+        sys.stdout.write(job.get('output', ""))
+    except requests.exceptions.RequestException as e:
+        _logger.error("Unable to run job via build daemon at '{0}': {1}".format(url, str(e)))
+        return 1
+    return job['exitcode']
+
+
+def expire_logs(log_dir, before):
+    """Remove the logs of jobs (i.e. of an earlier run of the daemon) last written before a time."""
+    for name in os.listdir(log_dir):
+        filename = os.path.join(log_dir, name)
+        if name.endswith(".log") and os.path.getmtime(filename) < before:
+            os.remove(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the wordpress-cd build daemon.")
+    parser.add_argument('-v', dest='verbose', action='store_true')
+    parser.add_argument('-d', dest='debug', action='store_true')
+    args = parser.parse_args()
+
+    log_level = logging.WARNING
+    if args.debug:
+        log_level = logging.DEBUG
+    elif args.verbose:
+        log_level = logging.INFO
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=log_level,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    listen = os.getenv("WPCD_DAEMON_LISTEN", DEFAULT_LISTEN)
+    host, port = listen.rsplit(":", 1)
+    workers = int(os.getenv("WPCD_DAEMON_WORKERS", "0")) or os.cpu_count()
+    log_dir = os.getenv("WPCD_DAEMON_LOG_DIR", os.path.join(os.path.expanduser("~"), ".cache", "wordpress-cd", "jobs"))
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    # Finished jobs and their logs are kept for a while, for clients to fetch
+    retention = int(os.getenv("WPCD_DAEMON_JOB_RETENTION", "86400"))
+    expire_logs(log_dir, time.time() - retention)
+
+    # Use the given token, or make one up and leave it for clients
+    token = os.getenv("WPCD_DAEMON_TOKEN")
+    if token is None:
+        token = secrets.token_hex(32)
+        _logger.info("Wrote daemon token to '{0}'.".format(write_token_file(token)))
+
+    DaemonRequestHandler.scheduler = Scheduler(workers, log_dir, retention)
+    DaemonRequestHandler.token = token
+    httpd = ThreadingHTTPServer((host, int(port)), DaemonRequestHandler)
+    _logger.info("Build daemon listening on {0} with {1} workers.".format(listen, workers))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        DaemonRequestHandler.scheduler.pool.shutdown(wait=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
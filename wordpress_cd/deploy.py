@@ -5,11 +5,18 @@ import subprocess
 import logging
 _logger = logging.getLogger(__name__)
 
-from .job import JobHandler, get_artefact_dir
+from .job import JobHandler, get_artefact_dir, get_module_id
+from .workspace import Workspace
 from .notifications import *
 
 import wordpress_cd.drivers as drivers
 from wordpress_cd.build import get_artefact_dir
+from wordpress_cd.warmup import warm_up_enabled, warm_up_from_env
+from wordpress_cd.offload import offload_enabled, offload_from_env
+from wordpress_cd.postdeploy import load_hooks, run_hooks
+from wordpress_cd.ssh import close_sessions
+from wordpress_cd.throttle import adaptive_throttle_from_env
+from wordpress_cd.dryrun import dry_run_enabled, emit_report
 
 
 class DeployException(Exception):
@@ -18,49 +25,164 @@ class DeployException(Exception):
 
 class DeployJobHandler(JobHandler):
     def _deploy_handling_exceptions(self):
+        if dry_run_enabled():
+            return self._dry_run_handling_exceptions()
         try:
             notify_start("deploy")
-            exitcode = self.deploy()
-            notify_success("deploy")
+            with self.timed("deploy"):
+                exitcode = self.deploy()
+            if exitcode == 0:
+                self.check_baseline("deploy")
+            self.write_report("deploy")
+            if exitcode == 0:
+                notify_success("deploy", self.statistics)
+            else:
+                notify_failure("deploy", "Deploy failed with exit code {0}.".format(exitcode), self.statistics)
             return exitcode
         except Exception as e:
             _logger.exception(str(e))
             self._handle_exception(e)
-            notify_failure("deploy", str(e))
+            notify_failure("deploy", str(e), self.statistics)
             return 1
+        finally:
+            close_sessions(self.workspace)
+            self.workspace.cleanup()
+
+    def _dry_run_handling_exceptions(self):
+        # Nothing is changed, so there is nothing to notify anyone of
+        try:
+            with self.timed("dry-run"):
+                exitcode = self.dry_run()
+            self.write_report("dry-run")
+            return exitcode
+        except Exception as e:
+            _logger.exception(str(e))
+            return 1
+        finally:
+            close_sessions(self.workspace)
+            self.workspace.cleanup()
+
+    def dry_run(self):
+        _logger.error("Dry runs are only available for site deploys.")
+        return 1
+
+    def throttled(self, driver, deploy, *args):
+        """Run a driver's deploy method, pausing its transfers whenever the site is slow (if enabled)."""
+        throttle = adaptive_throttle_from_env()
+        if throttle is None:
+            return deploy(*args)
+        driver.throttle = throttle
+        throttle.start()
+        try:
+            return deploy(*args)
+        finally:
+            throttle.stop()
+            driver.throttle = None
+            self.statistics['throttle'] = throttle.statistics()
+
+    def post_deploy(self, driver, hooks):
+        """Run the post-deploy hooks, rolling the deploy back if the site turns out unhealthy."""
+        stats = self.statistics['postdeploy'] = run_hooks(hooks)
+        if len(stats['failures']) == 0:
+            driver.finish_deploy()
+            return 0
+        if stats['healthy'] or not driver.keep_rollback:
+            if not stats['healthy']:
+                _logger.error("Site failed its health check, but the deploy can't be rolled back.")
+            driver.finish_deploy()
+            return 1
+
+        _logger.error("Site failed its health check, rolling back the deploy...")
+        exitcode = driver.rollback_site()
+        stats['rolled_back'] = exitcode == 0
+        if exitcode == 0:
+            # Clear the failed deploy's code and pages out of the caches too
+            hooks = [hook for hook in hooks if not hook.checks_health]
+            if len(hooks) > 0:
+                stats['after_rollback'] = run_hooks(hooks)
+        return 1
 
 
 class DeployModuleJobHandler(DeployJobHandler):
     def deploy(self):
-        driver = drivers.load_driver(self.args)
+        driver = drivers.load_driver(self.args, self.workspace)
         _logger.debug("Deploying '{0}' {1} using {2} driver".format(self.name, self.type, driver))
 
+        hooks = load_hooks(driver)
+
         # Invoke the driver's deploy method
-        return driver._deploy_module(self.type)
+        exitcode = self.throttled(driver, driver._deploy_module, self.type)
+        if exitcode != 0 or len(hooks) == 0:
+            return exitcode
+        return self.post_deploy(driver, hooks)
 
 
 class DeploySiteJobHandler(DeployJobHandler):
-    def __init__(self, args):
-        super(DeploySiteJobHandler, self).__init__("site", None, args)
+    def __init__(self, args, workspace = None):
+        super(DeploySiteJobHandler, self).__init__("site", None, args, workspace=workspace)
 
     def deploy(self):
-        driver = drivers.load_driver(self.args)
+        driver = drivers.load_driver(self.args, self.workspace)
         _logger.debug("Deploying site using {0} driver.".format(driver))
 
+        # Put static assets in place on the CDN origin before the pages
+        # referring to them. They're only left out of the deploy itself if
+        # asked, as anything not going through the must-use plugin's
+        # filters still loads them from the web servers.
+        if offload_enabled():
+            stats, assets = offload_from_env(driver.get_site_build_dir())
+            self.statistics['offload'] = stats
+            if os.getenv("WPCD_OFFLOAD_EXCLUDE", "0") == "1":
+                driver.excludes += assets
+
+        # Keep what the deploy replaces, in case the hooks find the new
+        # site unhealthy
+        hooks = load_hooks(driver)
+        if len(hooks) > 0 and driver.supports_rollback:
+            driver.keep_rollback = os.getenv("WPCD_ROLLBACK", "1") == "1"
+
         # Invoke the driver's deploy method
-        return driver.deploy_site()
+        exitcode = self.throttled(driver, driver.deploy_site)
+        self.statistics.update(driver.statistics)
+        if exitcode != 0:
+            return exitcode
+
+        # Reset caches and check the site over before calling it done
+        if len(hooks) > 0:
+            exitcode = self.post_deploy(driver, hooks)
+            if exitcode != 0:
+                return exitcode
+
+        # Warm up the freshly deployed site's caches
+        site_url = os.getenv("WPCD_SITE_URL")
+        if warm_up_enabled() and site_url is not None:
+            self.statistics['warmup'] = warm_up_from_env(site_url)
+        return 0
+
+
+    def dry_run(self):
+        driver = drivers.load_driver(self.args, self.workspace)
+        _logger.debug("Comparing site with target using {0} driver.".format(driver))
+
+        report = driver.diff_site().report()
+        self.statistics['dry_run'] = report
+        totals = report['totals']
+        _logger.info("Deploy would add {0}, change {1} and delete {2} files, sending {3} bytes.".format(
+            totals['added'], totals['changed'], totals['deleted'], totals['bytes']))
+        emit_report(report)
+        return 0
 
 
-def deploy_site(args):
-    job = DeploySiteJobHandler(args)
+def deploy_site(args, workspace = None):
+    job = DeploySiteJobHandler(args, workspace)
     return job._deploy_handling_exceptions()
 
-def deploy_plugin(args):
-    module_id = os.getenv("JOB_BASE_NAME", os.path.basename(os.getcwd()))
-    job = DeployModuleJobHandler("plugin", module_id, args)
+def deploy_plugin(args, workspace = None):
+    workspace = workspace or Workspace(name="plugin")
+    job = DeployModuleJobHandler("plugin", get_module_id(workspace), args, workspace=workspace)
     return job._deploy_handling_exceptions()
 
-def deploy_theme(args):
-    module_id = os.getenv("JOB_BASE_NAME", os.path.basename(os.getcwd()))
-    job = DeployModuleJobHandler("theme", module_id, args)
+def deploy_theme(args, workspace = None):
+    workspace = workspace or Workspace(name="theme")
+    job = DeployModuleJobHandler("theme", get_module_id(workspace), args, workspace=workspace)
     return job._deploy_handling_exceptions()
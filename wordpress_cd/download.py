@@ -0,0 +1,175 @@
+# Resumable, integrity-checked HTTP(S) downloads for the build stage
+
+import os
+import time
+import fcntl
+import hashlib
+import requests
+import urllib3
+
+import logging
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+
+class DownloadException(Exception):
+    pass
+
+
+def parse_pin(pin):
+    """Split a 'sha256:<hex>' (or bare hex) pin into its lowercase digest."""
+    if pin is None:
+        return None
+    pin = str(pin).strip().lower()
+    if pin.startswith("sha256:"):
+        pin = pin[len("sha256:"):]
+    if len(pin) != 64 or any(c not in "0123456789abcdef" for c in pin):
+        raise DownloadException("Invalid sha256 checksum '{0}'.".format(pin))
+    return pin
+
+
+def _sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def verify(filename, sha256, name = None):
+    """Check a file against an expected sha256 digest, raising if it differs."""
+    actual = _sha256(filename)
+    if sha256 is not None and actual != sha256:
+        raise DownloadException("Checksum mismatch for '{0}' (expected sha256:{1}, got sha256:{2}).".format(
+            name or os.path.basename(filename), sha256, actual))
+    return actual
+
+
+def _validator(r):
+    # What identifies the version of a file a response is part of
+    return r.headers.get('ETag') or r.headers.get('Last-Modified')
+
+
+def _raw_chunks(r):
+    # The bytes as sent, with errors reported as 'iter_content' would
+    try:
+        for chunk in r.raw.stream(CHUNK_SIZE, decode_content=False):
+            yield chunk
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+
+
+def _discard(part_file):
+    for filename in [part_file, part_file + ".validator"]:
+        if os.path.isfile(filename):
+            os.unlink(filename)
+
+
+def _fetch_part(session, url, part_file, timeout):
+    # Resume from whatever an earlier attempt left behind, as long as it's
+    # known which version of the file that was (or the server may append
+    # the tail of a newer one)
+    offset = 0
+    validator = None
+    if os.path.isfile(part_file) and os.path.isfile(part_file + ".validator"):
+        offset = os.path.getsize(part_file)
+        with open(part_file + ".validator", 'r') as f:
+            validator = f.read()
+    # Byte offsets only line up with the server's without content encoding
+    headers = {'Accept-Encoding': "identity"}
+    if offset > 0:
+        headers['Range'] = "bytes={0}-".format(offset)
+        headers['If-Range'] = validator
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 416 and offset > 0:
+            # Whatever is there can't be trusted to be complete, start afresh
+            _logger.debug("Server rejected range request for '{0}', restarting.".format(url))
+            _discard(part_file)
+            return _fetch_part(session, url, part_file, timeout)
+        r.raise_for_status()
+        encoded = r.headers.get('Content-Encoding', "identity") != "identity"
+        if offset > 0 and (r.status_code != 206 or encoded or
+                not r.headers.get('Content-Range', "").startswith("bytes {0}-".format(offset))):
+            _logger.debug("Server didn't resume '{0}' where it left off, restarting.".format(url))
+            offset = 0
+
+        # Note the version being fetched, for resuming later
+        _discard(part_file + ".validator")
+        if offset == 0:
+            _discard(part_file)
+            if _validator(r) is not None and not encoded:
+                with open(part_file + ".validator", 'w') as f:
+                    f.write(_validator(r))
+
+        expected = r.headers.get('Content-Length')
+        received = 0
+        with open(part_file, 'ab' if offset > 0 else 'wb') as f:
+            chunks = r.iter_content(CHUNK_SIZE) if encoded else _raw_chunks(r)
+            for chunk in chunks:
+                f.write(chunk)
+                received += len(chunk)
+        if expected is not None and not encoded and received < int(expected):
+            raise requests.exceptions.ChunkedEncodingError(
+                "Connection closed after {0} of {1} bytes".format(received, expected))
+
+
+def download(url, filename, sha256 = None, retries = 3, timeout = 60, session = None):
+    """Download 'url' to 'filename', returning the sha256 of the result.
+
+    The transfer is written to a '.part' file alongside 'filename' and
+    resumed with HTTP range requests if interrupted. The complete file is
+    verified against the optional 'sha256' pin before being moved into
+    place, so 'filename' never contains a truncated or unexpected download.
+    """
+    sha256 = parse_pin(sha256)
+
+    # Jobs running side by side may want the same file, so take turns
+    with open(filename + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return _download(url, filename, sha256, retries, timeout, session)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _download(url, filename, sha256, retries, timeout, session):
+    # Don't fetch what we already have
+    if sha256 is not None and os.path.isfile(filename):
+        try:
+            return verify(filename, sha256)
+        except DownloadException:
+            os.unlink(filename)
+
+    if session is None:
+        session = requests.Session()
+    part_file = filename + ".part"
+    attempt = 0
+    while True:
+        try:
+            _fetch_part(session, url, part_file, timeout)
+            break
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            attempt += 1
+            if attempt > retries:
+                raise DownloadException("Unable to download '{0}': {1}".format(url, str(e)))
+            _logger.warning("Download of '{0}' interrupted ({1}), resuming...".format(url, str(e)))
+            time.sleep(min(2 ** attempt, 30))
+        except requests.exceptions.HTTPError as e:
+            # Start afresh next time, the server rejected this request
+            _discard(part_file)
+            raise DownloadException("Unable to download '{0}': {1}".format(url, str(e)))
+
+    try:
+        actual = verify(part_file, sha256, url)
+    except DownloadException:
+        _discard(part_file)
+        raise
+    _discard(part_file + ".validator")
+    os.replace(part_file, filename)
+    return actual
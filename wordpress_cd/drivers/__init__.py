@@ -7,12 +7,12 @@ _logger = logging.getLogger(__name__ + ".init")
 drivers = {}
 
 
-def load_driver(args):
+def load_driver(args, workspace = None):
     # Load specified modules (or sane/current defaults)
     try:
         drivers_to_load = os.environ["WPCD_DRIVERS"]
     except KeyError:
-        drivers_to_load = "wordpress_cd.drivers.rsync"
+        drivers_to_load = "wordpress_cd.drivers.rsync,wordpress_cd.drivers.tarssh,wordpress_cd.drivers.objectstore"
     for modulename in drivers_to_load.split(","):
         _logger.debug("Importing module '%s'" % modulename)
         try:
@@ -31,7 +31,12 @@ def load_driver(args):
         _logger.error("Missing driver for platform '{0}'.".format(platform))
         raise Exception("Configuration error.")
 
-    return driver(args)
+    instance = driver(args)
+
+    # Drivers work within the job's workspace (the current directory, unless given)
+    if workspace is not None:
+        instance.workspace = workspace
+    return instance
 
 
 def driver(id):
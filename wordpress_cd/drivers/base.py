@@ -1,7 +1,13 @@
 import os
+import time
 import logging
 _logger = logging.getLogger(__name__)
 
+from wordpress_cd.warmup import warm_up_enabled, warm_up_from_env
+from wordpress_cd.loadtest import load_test_enabled, load_config, run_load_test, LoadTestException
+from wordpress_cd.files import scan_tree
+from wordpress_cd.workspace import Workspace
+
 import random, string
 
 def randomword(length):
@@ -9,6 +15,27 @@ def randomword(length):
    return ''.join(random.choice(letters) for i in range(length))
 
 
+# Paths within a site's document root that belong to the target, so are
+# never overwritten or removed by a site deploy
+SITE_EXCLUDES = ['wp-config.php', 'wp-salt.php', 'wp-content/uploads']
+
+def iter_site_files(root, excludes = SITE_EXCLUDES, include_dirs = False):
+    """Yield the (relative path, size) of each file in a site build to be deployed.
+
+    With 'include_dirs', folders are included too (with a size of zero), so
+    empty ones can be recreated.
+    """
+    for relpath, entry in scan_tree(root, excludes):
+        if entry.is_dir(follow_symlinks=False):
+            if include_dirs:
+                yield relpath, 0
+        else:
+            yield relpath, entry.stat(follow_symlinks=False).st_size
+
+def list_site_files(root, excludes = SITE_EXCLUDES, include_dirs = False):
+    return list(iter_site_files(root, excludes, include_dirs))
+
+
 # Abstract superclass for deployment drivers
 class BaseDriver(object):
     def __init__(self, args, test_dataset = None):
@@ -41,18 +68,55 @@ class BaseDriver(object):
         self.wp_plugin_dir = os.getenv("WP_PLUGIN_DIR", "/wp-content/plugins")
 
         # For test stage, select a random uid to use in hostname
-        self.test_site_uid = randomword(10)
         self.test_site_domain = os.getenv("WPCD_TEST_DOMAIN", "test.yourdomain.com")
-        self.test_site_fqdn = "wpcd-{}.{}".format(self.test_site_uid, self.test_site_domain)
-        self.test_site_url = "https://" + self.test_site_fqdn
+        self.use_test_slot(randomword(10))
+
+        # The warm test site leased for the test stage, if any
+        self.test_pool = None
+        self.test_slot = None
 
         # Flags for setup and teardown of test sites
         self.is_site_set_up = False
         self.is_dns_set_up = False
         self.is_ssl_set_up = False
 
+        # Results gathered by the driver, for reports and notifications
+        self.statistics = {}
+
+        # Paths within the site build not to deploy (i.e. offloaded assets)
+        self.excludes = list(SITE_EXCLUDES)
+
+        # Whether a site deploy should keep what it replaces, so it can be
+        # rolled back if the site turns out unhealthy (see 'rollback_site')
+        self.keep_rollback = False
+
+        # Pauses the deploy's transfers while the site is slow, if enabled
+        # (see 'throttle.py'). Drivers add the processes they start to it.
+        self.throttle = None
+
+        # Where the job's build/artefacts are (replaced by 'load_driver')
+        self.workspace = Workspace()
+
     def get_module_name(self):
-        return os.path.basename(os.getcwd())
+        return os.path.basename(self.workspace.root)
+
+    def get_site_build_dir(self):
+        """Locate the document root of the site build to be deployed."""
+        build_dir = self.workspace.path("build")
+        build_ref = os.getenv("WPCD_BUILD_REF")
+        if build_ref is not None:
+            return "{0}/{1}/wordpress".format(build_dir, build_ref)
+        if os.path.isdir("{0}/wordpress".format(build_dir)):
+            return "{0}/wordpress".format(build_dir)
+
+        # Otherwise there had better be only one build to choose from
+        build_refs = []
+        if os.path.isdir(build_dir):
+            build_refs = [d for d in sorted(os.listdir(build_dir)) if os.path.isdir("{0}/{1}/wordpress".format(build_dir, d))]
+        if len(build_refs) != 1:
+            _logger.error("Found {0} site builds, set 'WPCD_BUILD_REF' to choose which to deploy.".format(len(build_refs)))
+            raise Exception("Configuration error.")
+        return "{0}/{1}/wordpress".format(build_dir, build_refs[0])
 
     def deploy_theme(self):
         return self._deploy_module("theme")
@@ -69,6 +133,26 @@ class BaseDriver(object):
     def deploy_site(self):
         raise NotImplementedError()
 
+    def diff_site(self):
+        """Work out what 'deploy_site' would change on the target (as a 'DeployDiff'), without changing it."""
+        raise NotImplementedError()
+
+    def new_diff(self):
+        from wordpress_cd.dryrun import DeployDiff
+        return DeployDiff(str(self), self.wp_content_dir, self.wp_plugin_dir)
+
+    # Drivers able to undo a site deploy set this, and implement
+    # 'rollback_site' and 'finish_deploy'
+    supports_rollback = False
+
+    def rollback_site(self):
+        """Put the site back as it was before 'deploy_site' (run with 'keep_rollback' set)."""
+        raise NotImplementedError()
+
+    def finish_deploy(self):
+        """Discard anything kept for a rollback, once the deploy is known to be good."""
+        pass
+
     def deploy_host(self):
         _logger.warn("Use of 'deploy_host' deprecated. Use 'deploy_site' instead.")
         self.deploy_site()
@@ -76,7 +160,32 @@ class BaseDriver(object):
     def test_site(self):
         raise NotImplementedError()
 
+    def use_test_slot(self, uid, data = None):
+        """Point the driver at the test site with the given uid."""
+        self.test_site_uid = uid
+        self.test_site_fqdn = "wpcd-{}.{}".format(self.test_site_uid, self.test_site_domain)
+        self.test_site_url = "https://" + self.test_site_fqdn
+
+        # Anything the driver noted about the test site when setting it up
+        self.test_slot_data = data if data is not None else {}
+
     def test_site_setup(self):
+        # Take a warm test site from the pool, if there is one
+        from wordpress_cd.drivers.pool import TestSlotPool, pool_enabled
+        if pool_enabled():
+            start = time.monotonic()
+            self.test_pool = TestSlotPool(self)
+            self.test_slot, warm = self.test_pool.lease("{0}-{1}".format(self.job_id, os.getpid()))
+            self.use_test_slot(self.test_slot['uid'], self.test_slot['data'])
+            _logger.info("Deploying to {0} test environment with hostname '{1}'".format("warm" if warm else "fresh", self.test_site_fqdn))
+            self._deploy_test_slot()
+            self.statistics['test_slot'] = {
+                'uid': self.test_site_uid,
+                'warm': warm,
+                'setup_seconds': round(time.monotonic() - start, 3),
+            }
+            return
+
         _logger.info("Firing up transient test environment with hostname '{}'".format(self.test_site_fqdn))
 
         # Set up virtualhost, deploy document root and initialise db etc
@@ -100,9 +209,29 @@ class BaseDriver(object):
 
         # TODO: Ensure that at least the homepage is returning an expected response...
 
+        # Warm up the test site's caches (which also exercises every page)
+        if warm_up_enabled():
+            self.statistics['warmup'] = warm_up_from_env(self.test_site_url)
+
+        # Check the site performs within the configured latency/error thresholds
+        if load_test_enabled():
+            stats = run_load_test(self.test_site_url, load_config(workspace=self.workspace))
+            self.statistics['loadtest'] = stats
+            _logger.info("Load test: {0} requests, {1:.1f} req/s, error rate {2:.2%}.".format(
+                stats['requests'], stats['requests_per_second'], stats['error_rate']))
+            if not stats['passed']:
+                raise LoadTestException("Load test failed: {0}".format("; ".join(stats['failures'])))
+
         # Intended to be a placefolder for real tests to be run against the host.
 
     def test_site_teardown(self):
+        # Hand a leased test site back, to be recycled in the background
+        if self.test_slot is not None:
+            self.test_pool.release(self.test_slot)
+            self.test_pool.replenish_in_background()
+            self.test_slot = None
+            return
+
         _logger.info("Tearing down transient test environment with hostname '{}'".format(self.test_site_fqdn))
 
         # Remove Beanstalk virtualhost and database
@@ -119,6 +248,42 @@ class BaseDriver(object):
 
         # Notification/webhook with details of the test host that has now been released?
 
+    # Warm test site pool (see 'pool.py'). Drivers supporting it implement
+    # '_provision_test_host', '_deploy_test_slot' and '_recycle_test_host'.
+
+    def provision_test_slot(self, uid):
+        """Set up a test site for the pool, returning anything noted about it for later."""
+        self.use_test_slot(uid)
+        _logger.info("Provisioning pooled test environment with hostname '{}'".format(self.test_site_fqdn))
+        self._provision_test_host()
+        self._setup_dns()
+        self._setup_ssl()
+        return self.test_slot_data
+
+    def recycle_test_slot(self, uid, data):
+        """Reset a test site returned to the pool to a clean state."""
+        self.use_test_slot(uid, data)
+        _logger.info("Recycling pooled test environment with hostname '{}'".format(self.test_site_fqdn))
+        self._recycle_test_host()
+
+    def teardown_test_slot(self, uid, data):
+        """Release everything set up for a test site in the pool."""
+        self.use_test_slot(uid, data)
+        self.is_site_set_up = self.is_dns_set_up = self.is_ssl_set_up = True
+        self.test_site_teardown()
+
+    def _provision_test_host(self):
+        # Set up a virtualhost (and empty db etc) without deploying to it
+        raise NotImplementedError()
+
+    def _deploy_test_slot(self):
+        # Deploy the build and test dataset to a provisioned test site
+        raise NotImplementedError()
+
+    def _recycle_test_host(self):
+        # Clear out the deployed build and test data
+        raise NotImplementedError()
+
     def _setup_db(self):
         _logger.info("Creating database and user ('{}')...".format(self.test_dataset.mysql_db))
         cnx = self._get_db_connection()
@@ -0,0 +1,204 @@
+# Driver uploading builds to an S3-compatible bucket, for hosting platforms
+# that serve (or pull) sites from object storage.
+#
+# A manifest of the content hash of each object uploaded is kept alongside
+# them, so later deploys only upload what has changed (and remove what has
+# gone). Uploads run in parallel, with large files split into multipart
+# uploads. Set 'WPCD_S3_ENDPOINT_URL' to use a non-AWS (or local) service.
+
+import os
+import json
+import time
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+import logging
+_logging = logging.getLogger(__name__)
+
+from wordpress_cd.drivers import driver
+from wordpress_cd.drivers.base import BaseDriver, SITE_EXCLUDES, list_site_files
+from wordpress_cd.cache import hash_file
+from wordpress_cd.job import unpack_artefact
+from wordpress_cd.s3 import get_s3_client, parse_s3_url
+from wordpress_cd.throttle import bandwidth_share
+
+MANIFEST_NAME = ".wpcd-manifest.json"
+
+
+@driver('objectstore')
+class ObjectStoreDriver(BaseDriver):
+    def __str__(self):
+        return "objectstore"
+
+    def __init__(self, args):
+        _logging.debug("Initialising object storage driver")
+        super(ObjectStoreDriver, self).__init__(args)
+
+        url = os.getenv("WPCD_OBJECTSTORE_URL")
+        if url is None or not url.startswith("s3://"):
+            _logging.error("No bucket to deploy to, set 'WPCD_OBJECTSTORE_URL' to an 's3://bucket/prefix' URL.")
+            raise Exception("Configuration error.")
+        self.bucket, self.prefix = parse_s3_url(url)
+        self.prefix = self.prefix.strip("/")
+        self.threads = int(os.getenv("WPCD_OBJECTSTORE_THREADS", "16"))
+        self.delete = os.getenv("WPCD_OBJECTSTORE_DELETE", "1") == "1"
+        self.client = get_s3_client(max_pool_connections=self.threads)
+
+    def _key(self, prefix, path):
+        if prefix == "":
+            return path
+        return "{0}/{1}".format(prefix, path)
+
+    def read_manifest(self, prefix):
+        """Return the content hashes of the objects last uploaded under a prefix."""
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(prefix, MANIFEST_NAME))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return {}
+            raise
+        return json.loads(response['Body'].read().decode('utf-8'))['files']
+
+    def write_manifest(self, prefix, hashes):
+        manifest = {
+            'files': hashes,
+            'branch': self.git_branch,
+            'job_id': self.job_id,
+        }
+        self.client.put_object(Bucket=self.bucket, Key=self._key(prefix, MANIFEST_NAME),
+            Body=json.dumps(manifest, sort_keys=True).encode('utf-8'),
+            ContentType="application/json")
+
+    def _extra_args(self, path, sha256):
+        extra_args = {'Metadata': {'sha256': sha256}}
+        content_type, encoding = mimetypes.guess_type(path)
+        if content_type is not None and encoding is None:
+            extra_args['ContentType'] = content_type
+        return extra_args
+
+    def hash_tree(self, root, excludes = SITE_EXCLUDES):
+        """Return the content hash and size of each file under 'root' to be uploaded, by path."""
+        files = list_site_files(root, excludes)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            hashes = dict(zip(
+                [path for (path, size) in files],
+                executor.map(hash_file, [os.path.join(root, path) for (path, size) in files])
+            ))
+        return hashes, dict(files)
+
+    def sync_tree(self, root, prefix, excludes = SITE_EXCLUDES):
+        """Upload new/changed files under 'root' to the bucket, removing those gone."""
+        from boto3.s3.transfer import TransferConfig, create_transfer_manager
+        from s3transfer.subscribers import BaseSubscriber
+
+        class ThrottleSubscriber(BaseSubscriber):
+            # Holds up the thread sending an upload's data while the
+            # adaptive throttle has transfers paused
+            def __init__(self, throttle):
+                self.throttle = throttle
+
+            def on_progress(self, future, bytes_transferred, **kwargs):
+                self.throttle.wait()
+
+        start = time.monotonic()
+        hashes, sizes = self.hash_tree(root, excludes)
+
+        old_hashes = self.read_manifest(prefix)
+        changed = sorted(path for path in hashes if old_hashes.get(path) != hashes[path])
+        removed = []
+        if self.delete:
+            removed = sorted(path for path in old_hashes if path not in hashes)
+        _logging.info("Uploading {0} new/changed of {1} files, removing {2}...".format(len(changed), len(hashes), len(removed)))
+
+        # One transfer manager runs all uploads and their parts side by
+        # side, sharing this process's share of the bandwidth caps
+        config = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            max_concurrency=self.threads,
+        )
+        bwlimit = bandwidth_share()
+        if bwlimit > 0:
+            config.max_bandwidth = bwlimit * 1024
+        subscribers = [ThrottleSubscriber(self.throttle)] if self.throttle is not None else None
+        with create_transfer_manager(self.client, config) as manager:
+            futures = [manager.upload(os.path.join(root, path), self.bucket, self._key(prefix, path),
+                extra_args=self._extra_args(path, hashes[path]), subscribers=subscribers) for path in changed]
+            for future in futures:
+                future.result()
+
+        for i in range(0, len(removed), 1000):
+            objects = [{'Key': self._key(prefix, path)} for path in removed[i:i + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+        # Only once everything is in place, record what now is (including
+        # files gone from the build but left in the bucket)
+        manifest = {} if self.delete else dict(old_hashes)
+        manifest.update(hashes)
+        self.write_manifest(prefix, manifest)
+
+        stats = {
+            'driver': str(self),
+            'files': len(hashes),
+            'changed': len(changed),
+            'deleted': len(removed),
+            'bytes': sum(sizes[path] for path in changed),
+            'seconds': round(time.monotonic() - start, 3),
+        }
+        if bwlimit > 0:
+            stats['bwlimit_kbps'] = bwlimit
+        return stats
+
+    def diff_site(self):
+        _logging.info("Working out what deploying branch '{0}' to 's3://{1}/{2}' would change (job id: {3})...".format(self.git_branch, self.bucket, self.prefix, self.job_id))
+
+        # Compare with the manifest of the last deploy, rather than listing the bucket
+        hashes, sizes = self.hash_tree(self.get_site_build_dir(), self.excludes)
+        old_hashes = self.read_manifest(self.prefix)
+        diff = self.new_diff()
+        for (path, sha256) in hashes.items():
+            if path not in old_hashes:
+                diff.add('added', path, sizes[path])
+            elif old_hashes[path] != sha256:
+                diff.add('changed', path, sizes[path])
+            else:
+                diff.add('unchanged', path, sizes[path])
+        if self.delete:
+            for path in old_hashes:
+                if path not in hashes:
+                    diff.add('deleted', path)
+        return diff
+
+    def _deploy_module(self, type):
+
+        # Figure out where best to deploy it
+        if type == 'plugin':
+            path = self.wp_plugin_dir
+        elif type == 'mu-plugin':
+            path = self.wp_content_dir + "/mu-plugins"
+        elif type == 'theme':
+            path = self.wp_content_dir + "/themes"
+
+        module_id = self.get_module_name()
+        prefix = self._key(self.prefix, "{0}/{1}".format(path.strip("/"), module_id))
+        _logging.info("Deploying '{0}' {1} branch '{2}' to 's3://{3}/{4}' (job id: {5})...".format(module_id, type, self.git_branch, self.bucket, prefix, self.job_id))
+
+        # Extract module from build artefact
+        tmp_dir = unpack_artefact(self.workspace)
+        if not isinstance(tmp_dir, str):
+            return tmp_dir
+        self.statistics['transfer'] = self.sync_tree("{0}/{1}".format(tmp_dir, module_id), prefix, [])
+
+        # Done
+        _logging.info("Deployment of '{0}' {1} branch '{2}' to 's3://{3}/{4}' successful (job id: {5})...".format(module_id, type, self.git_branch, self.bucket, prefix, self.job_id))
+        return 0
+
+    def deploy_site(self):
+        _logging.info("Deploying branch '{0}' to 's3://{1}/{2}' (job id: {3})...".format(self.git_branch, self.bucket, self.prefix, self.job_id))
+
+        # Sync new site into place, leaving config/content (which should
+        # never be uploaded to a bucket) out of it
+        self.statistics['transfer'] = self.sync_tree(self.get_site_build_dir(), self.prefix, self.excludes)
+
+        # Done
+        _logging.info("Deployment of branch '{0}' to 's3://{1}/{2}' successful (job id: {3})...".format(self.git_branch, self.bucket, self.prefix, self.job_id))
+        return 0
@@ -0,0 +1,300 @@
+# A pool of pre-provisioned transient test sites ('slots') for the test
+# stage, so test jobs needn't wait for a host, DNS entry and certificate to
+# be set up (and torn down again) every time.
+#
+# Slots are shared by all test jobs on a runner, with their state kept in
+# a JSON file under a lock. A test job leases a ready slot, deploys just the
+# build and test data to it, and hands it back when done. Returned slots
+# are then recycled (reset to a clean state) and the pool topped back up to
+# size by a replenisher running in the background, so the next job finds a
+# slot ready. Slots leased by jobs that crashed are reclaimed once their
+# lease times out.
+#
+# To keep a pool warm between runs (e.g. from a scheduled job):
+#
+#   python -m wordpress_cd.drivers.pool replenish|status|drain
+
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from wordpress_cd.cache import get_local_cache_dir
+from wordpress_cd.drivers.base import randomword
+
+STATE_FILE = "slots.json"
+
+# Slot states
+PROVISIONING = "provisioning"   # being set up by a replenisher (or a job)
+READY = "ready"                 # warm, waiting to be leased
+LEASED = "leased"               # in use by a test job
+DIRTY = "dirty"                 # returned (or reclaimed), to be recycled
+RECYCLING = "recycling"         # being reset by a replenisher
+
+
+def pool_enabled():
+    return int(os.getenv("WPCD_TEST_POOL_SIZE", "0")) > 0
+
+def get_pool_dir(platform):
+    try:
+        pool_dir = os.environ['WPCD_TEST_POOL_DIR']
+    except KeyError:
+        pool_dir = os.path.join(get_local_cache_dir(), "test-pool")
+    return os.path.join(pool_dir, platform)
+
+
+class TestSlotPool(object):
+    """Leases warm test sites to test jobs, and keeps the pool topped up."""
+
+    def __init__(self, driver, size = None, pool_dir = None, lease_timeout = None):
+        self.driver = driver
+        self.size = size if size is not None else int(os.getenv("WPCD_TEST_POOL_SIZE", "0"))
+        self.lease_timeout = lease_timeout or float(os.getenv("WPCD_TEST_POOL_LEASE_TIMEOUT", "3600"))
+        self.pool_dir = pool_dir or get_pool_dir(str(driver))
+        if not os.path.isdir(self.pool_dir):
+            os.makedirs(self.pool_dir, exist_ok=True)
+        self.state_file = os.path.join(self.pool_dir, STATE_FILE)
+
+    def new_driver(self):
+        # Each slot is worked on by its own driver instance
+        return type(self.driver)(self.driver.args)
+
+    @contextlib.contextmanager
+    def _slots(self):
+        """Lock, read and (on success) write back the state of the pool's slots."""
+        with open(self.state_file + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                slots = {}
+                if os.path.isfile(self.state_file):
+                    with open(self.state_file, 'r') as f:
+                        slots = json.load(f)
+                self._reclaim(slots)
+                yield slots
+                with open(self.state_file + ".tmp", 'w') as f:
+                    json.dump(slots, f, indent=2, sort_keys=True)
+                os.replace(self.state_file + ".tmp", self.state_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reclaim(self, slots):
+        # Leases (and replenisher work) past their time were abandoned
+        now = time.time()
+        for slot in slots.values():
+            if slot['state'] in [LEASED, PROVISIONING, RECYCLING] and slot.get('expires', now) < now:
+                _logger.warning("Reclaiming test slot '{0}', {1} by '{2}' since {3}.".format(
+                    slot['uid'], slot['state'], slot.get('owner'), time.ctime(slot['since'])))
+                slot['state'] = DIRTY
+                slot['owner'] = None
+
+    def _set_state(self, slot, state, owner = None):
+        slot['state'] = state
+        slot['owner'] = owner
+        slot['since'] = time.time()
+        slot['expires'] = slot['since'] + self.lease_timeout
+
+    def _new_slot(self, owner):
+        slot = {'uid': randomword(10), 'created': time.time(), 'data': {}, 'leases': 0}
+        self._set_state(slot, PROVISIONING, owner)
+        return slot
+
+    def status(self):
+        with self._slots() as slots:
+            return dict(slots)
+
+    def lease(self, owner):
+        """Lease a ready slot, or provision a fresh one if none are ready.
+
+        Returns the slot, and whether it was warm.
+        """
+        with self._slots() as slots:
+            ready = sorted([s for s in slots.values() if s['state'] == READY], key=lambda s: s['since'])
+            if len(ready) > 0:
+                slot = ready[0]
+                self._set_state(slot, LEASED, owner)
+                slot['leases'] += 1
+                _logger.info("Leased warm test slot '{0}' ({1} more ready).".format(slot['uid'], len(ready) - 1))
+                return slot, True
+
+            # Nothing ready, so set one up now (it joins the pool afterwards)
+            slot = self._new_slot(owner)
+            slots[slot['uid']] = slot
+
+        _logger.info("No warm test slots ready, provisioning '{0}'...".format(slot['uid']))
+        try:
+            slot['data'] = self.driver.provision_test_slot(slot['uid'])
+        except Exception:
+            with self._slots() as slots:
+                slots.pop(slot['uid'], None)
+            raise
+        with self._slots() as slots:
+            slots[slot['uid']].update(data=slot['data'])
+            self._set_state(slots[slot['uid']], LEASED, owner)
+            slots[slot['uid']]['leases'] += 1
+            return slots[slot['uid']], False
+
+    def release(self, slot):
+        """Hand a leased slot back, to be recycled."""
+        with self._slots() as slots:
+            current = slots.get(slot['uid'])
+            if current is None or current['state'] != LEASED or current['owner'] != slot['owner']:
+                _logger.warning("Test slot '{0}' was reclaimed before it was released.".format(slot['uid']))
+                return
+            self._set_state(current, DIRTY)
+        _logger.info("Released test slot '{0}'.".format(slot['uid']))
+
+    def replenish(self, threads = None):
+        """Recycle returned slots and provision new ones, until the pool is full."""
+        owner = "replenish-{0}".format(os.getpid())
+        with self._slots() as slots:
+            dirty = [s for s in slots.values() if s['state'] == DIRTY]
+            for slot in dirty:
+                self._set_state(slot, RECYCLING, owner)
+            active = len([s for s in slots.values() if s['state'] != DIRTY])
+
+            # Don't keep more slots than the pool should have
+            excess = []
+            while active > self.size and len(dirty) > 0:
+                excess.append(dirty.pop())
+                active -= 1
+            ready = sorted([s for s in slots.values() if s['state'] == READY], key=lambda s: s['since'])
+            while active > self.size and len(ready) > 0:
+                slot = ready.pop()
+                self._set_state(slot, RECYCLING, owner)
+                excess.append(slot)
+                active -= 1
+
+            new = [self._new_slot(owner) for i in range(max(0, self.size - active))]
+            for slot in new:
+                slots[slot['uid']] = slot
+
+        if len(dirty) + len(new) + len(excess) == 0:
+            return {'recycled': 0, 'provisioned': 0, 'removed': 0}
+        _logger.info("Replenishing test slot pool: recycling {0}, provisioning {1}, removing {2}...".format(
+            len(dirty), len(new), len(excess)))
+
+        tasks = [(self._recycle, slot) for slot in dirty] + [(self._provision, slot) for slot in new]
+        tasks += [(self._remove, slot) for slot in excess]
+        with ThreadPoolExecutor(max_workers=threads or int(os.getenv("WPCD_TEST_POOL_THREADS", "4"))) as executor:
+            outcomes = list(executor.map(lambda task: task[0](task[1]), tasks))
+
+        # Slots that couldn't be recycled or set up are dropped
+        with self._slots() as slots:
+            for (slot, state) in zip([task[1] for task in tasks], outcomes):
+                current = slots.get(slot['uid'])
+                if current is None or current['owner'] != owner:
+                    continue
+                if state is None:
+                    del slots[slot['uid']]
+                else:
+                    current['data'] = slot['data']
+                    self._set_state(current, state)
+        return {
+            'recycled': len([o for (task, o) in zip(tasks, outcomes) if task[0] == self._recycle and o == READY]),
+            'provisioned': len([o for (task, o) in zip(tasks, outcomes) if task[0] == self._provision and o == READY]),
+            'removed': len(excess),
+        }
+
+    def _provision(self, slot):
+        try:
+            slot['data'] = self.new_driver().provision_test_slot(slot['uid'])
+            return READY
+        except Exception as e:
+            _logger.exception("Unable to provision test slot '{0}': {1}".format(slot['uid'], str(e)))
+            self._remove(slot)
+            return None
+
+    def _recycle(self, slot):
+        try:
+            self.new_driver().recycle_test_slot(slot['uid'], slot['data'])
+            return READY
+        except Exception as e:
+            _logger.warning("Unable to recycle test slot '{0}', removing it: {1}".format(slot['uid'], str(e)))
+            self._remove(slot)
+            return None
+
+    def _remove(self, slot):
+        try:
+            self.new_driver().teardown_test_slot(slot['uid'], slot['data'])
+        except Exception as e:
+            _logger.error("Unable to tear down test slot '{0}': {1}".format(slot['uid'], str(e)))
+        return None
+
+    def drain(self):
+        """Tear down every slot that isn't leased."""
+        owner = "drain-{0}".format(os.getpid())
+        with self._slots() as slots:
+            idle = [s for s in slots.values() if s['state'] in [READY, DIRTY]]
+            for slot in idle:
+                self._set_state(slot, RECYCLING, owner)
+        for slot in idle:
+            self._remove(slot)
+        with self._slots() as slots:
+            for slot in idle:
+                slots.pop(slot['uid'], None)
+        return len(idle)
+
+    def replenish_in_background(self):
+        """Start a replenisher in its own process, which outlives this job."""
+        if os.getenv("WPCD_TEST_POOL_REPLENISH", "1") != "1":
+            return None
+        log_file = os.path.join(self.pool_dir, "replenish.log")
+        with open(log_file, 'ab') as log:
+            proc = subprocess.Popen([sys.executable, "-m", "wordpress_cd.drivers.pool", "replenish"],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                start_new_session=True, cwd=self.driver.workspace.root)
+        _logger.debug("Replenishing test slot pool in the background (pid {0}, log '{1}').".format(proc.pid, log_file))
+        return proc
+
+
+class _Args(object):
+    verbose = False
+    debug = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the pool of warm test sites.")
+    parser.add_argument('-v', dest='verbose', action='store_true')
+    parser.add_argument('-d', dest='debug', action='store_true')
+    parser.add_argument('command', choices=['replenish', 'status', 'drain'])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s %(levelname)-8s %(message)s')
+
+    import wordpress_cd.drivers as drivers
+    pool = TestSlotPool(drivers.load_driver(_Args()))
+
+    if args.command == 'status':
+        print(json.dumps(pool.status(), indent=2, sort_keys=True))
+        return 0
+    if args.command == 'drain':
+        _logger.info("Removed {0} idle test slots.".format(pool.drain()))
+        return 0
+
+    # Only one replenisher needs to run at a time, and it keeps going while
+    # there's work (i.e. slots returned while it was busy)
+    with open(os.path.join(pool.pool_dir, "replenish.lock"), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            _logger.info("Another replenisher is running.")
+            return 0
+        while True:
+            stats = pool.replenish()
+            if stats['recycled'] + stats['provisioned'] + stats['removed'] == 0:
+                break
+            _logger.info("Recycled {0}, provisioned {1} and removed {2} test slots.".format(
+                stats['recycled'], stats['provisioned'], stats['removed']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,92 @@
 # Driver superclass to implement rsync-based deployment functions
 
 import os
-import subprocess
+import re
+import time
+import shlex
 import logging
 _logging = logging.getLogger(__name__)
 
 from wordpress_cd.drivers import driver
-from wordpress_cd.drivers.base import BaseDriver
+from wordpress_cd.drivers.base import BaseDriver, SITE_EXCLUDES, randomword
 from wordpress_cd.job import unpack_artefact
+from wordpress_cd import process
+from wordpress_cd.ssh import SshSession
+from wordpress_cd.throttle import bandwidth_share, get_nice_prefix
+
+# Progress lines written by rsync's '--info=progress2' option, e.g.
+#   '    12,345,678  45%   11.77MB/s    0:00:03 (xfr#120, to-chk=80/450)'
+PROGRESS_RE = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d{2}:\d{2})(?:.*xfr#(\d+))?(?:.*to-chk=(\d+)/(\d+))?')
+
+# Changes listed by rsync's '--itemize-changes' option, e.g.
+#   '>f+++++++++ wp-includes/version.php' (a new file)
+ITEMIZE_RE = re.compile(r'^([<>ch.][fdLDS]\S{7,9}) (.+)$')
+
+# Lines written by a dry run with '--out-format=%i %l %n', e.g.
+#   '>f.st...... 1234 wp-includes/version.php' (a changed file)
+#   '*deleting   0 wp-content/plugins/old-plugin/old-plugin.php'
+DRY_RUN_RE = re.compile(r'^(\*deleting|[<>ch.][fdLDS]\S{7,9})\s+(\d+) (.+)$')
+
+_progress2_supported = None
+
+def progress2_supported():
+    """Whether the installed rsync (3.1.0 or later) has '--info=progress2'."""
+    global _progress2_supported
+    if _progress2_supported is None:
+        try:
+            exitcode, output, errors = process.stream(["rsync", "--version"])
+            version = re.search(r'version\s+(\d+)\.(\d+)', output)
+            _progress2_supported = version is not None and (int(version.group(1)), int(version.group(2))) >= (3, 1)
+        except OSError:
+            _progress2_supported = False
+    return _progress2_supported
+
+
+class RsyncProgress(object):
+    """Follows rsync's overall progress, logging it every so often."""
+
+    def __init__(self, interval = None):
+        if interval is None:
+            interval = float(os.getenv("WPCD_PROGRESS_INTERVAL", "10"))
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.bytes = 0
+        self.percent = 0
+        self.rate = None
+        self.files = 0
+        self.checked = None
+        self.total_files = None
+
+    def __call__(self, line):
+        match = PROGRESS_RE.match(line)
+        if match is None:
+            return
+        self.bytes = int(match.group(1).replace(",", ""))
+        self.percent = int(match.group(2))
+        self.rate = match.group(3)
+        if match.group(5) is not None:
+            self.files = int(match.group(5))
+        if match.group(7) is not None:
+            self.total_files = int(match.group(7))
+            self.checked = self.total_files - int(match.group(6))
+
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            _logging.info("rsync: {0} bytes transferred ({1}%) at {2}, {3} files so far, ETA {4}".format(
+                self.bytes, self.percent, self.rate, self.files, match.group(4)))
+
+    def statistics(self):
+        stats = {
+            'driver': "rsync",
+            'bytes': self.bytes,
+            'files': self.files,
+            'seconds': round(time.monotonic() - self.start, 3),
+        }
+        if self.total_files is not None:
+            stats['checked'] = self.total_files
+        return stats
 
 
 @driver('rsync')
@@ -25,18 +104,65 @@ class RsyncDriver(BaseDriver):
         self.ssh_pass = os.getenv('SSH_PASS')
         self.ssh_path = os.getenv('SSH_PATH')
 
+        # What was kept for a rollback (see 'deploy_site')
+        self.rollback_dir = None
+        self.created_list = None
+
+    def ssh_session(self, host = None):
+        """The (shared) ssh session for the target host, or another host of the site."""
+        return SshSession.from_env(self.workspace, host or self.ssh_host)
+
     def _get_rsync_rsh(self):
-        rsync_rsh = "ssh -v -o StrictHostKeyChecking=no"
+        return self.ssh_session().rsh(["-v"])
+
+    def _get_rsync_rsh_args(self):
+        # Local targets need no remote shell
+        if self.ssh_host is None:
+            return []
+        return ["-e", self._get_rsync_rsh()]
 
-        # Is a specific port set?
-        if self.ssh_port is not None:
-            rsync_rsh += " -p {0}".format(self.ssh_port)
+    def _get_shell_args(self, script):
+        # Without an SSH host, work on a local folder (i.e. a mounted docroot)
+        return self.ssh_session().shell_args(script)
 
-        # Should we feed the password in?
-        if self.ssh_pass is not None:
-            rsync_rsh = "sshpass -p {0} {1}".format(self.ssh_pass, rsync_rsh)
+    def _run_rsync(self, deployargs, cwd, on_line = None):
+        """Run rsync in a folder, following its progress and keeping the tail of its output for errors."""
+        progress = RsyncProgress()
+        if progress2_supported():
+            deployargs = deployargs + ["--info=progress2"]
+
+        # Go easy on the target's disks if asked to
+        nice = get_nice_prefix()
+        if len(nice) > 0:
+            if self.ssh_host is None:
+                deployargs = nice + deployargs
+            else:
+                deployargs = deployargs + ["--rsync-path={0} rsync".format(" ".join(nice))]
+
+        def on_progress_and_line(line):
+            on_line(line)
+            progress(line)
+        on_stdout = progress if on_line is None else on_progress_and_line
+        on_start = self.throttle.add if self.throttle is not None else None
+        bwlimit = bandwidth_share()
+        if bwlimit > 0:
+            deployargs = deployargs + ["--bwlimit={0}".format(bwlimit)]
+        exitcode, output, errors = process.stream(deployargs, label="rsync", on_stdout=on_stdout, on_start=on_start,
+            cwd=cwd, env=os.environ.copy())
+        _logging.debug("rsync exitcode: {0}".format(exitcode))
+        if exitcode != 0:
+            _logging.error("rsync failed. Last of its output:\n{0}".format((output + errors).strip()))
+        else:
+            self.statistics['transfer'] = progress.statistics()
+            if bwlimit > 0:
+                self.statistics['transfer']['bwlimit_kbps'] = bwlimit
+        return exitcode
 
-        return rsync_rsh
+    def _get_rsync_target(self, path):
+        # Without an SSH host, deploy to a local folder (i.e. a mounted docroot)
+        if self.ssh_host is None:
+            return path
+        return "{0}@{1}:{2}".format(self.ssh_user, self.ssh_host, path)
 
     def _deploy_module(self, type):
 
@@ -52,57 +178,121 @@ class RsyncDriver(BaseDriver):
         pluginroot = "{0}/{1}/{2}".format(self.ssh_path, path, module_id)
         _logging.info("Deploying '{0}' {1} branch '{2}' to '{3}:{4}' (job id: {5})...".format(module_id, type, self.git_branch, self.ssh_host, pluginroot, self.job_id))
 
-        # Extract module from build artefact ZIP file
-        tmp_dir = unpack_artefact()
-        os.chdir("{0}/{1}".format(tmp_dir, module_id))
+        # Extract module from build artefact
+        tmp_dir = unpack_artefact(self.workspace)
+        if not isinstance(tmp_dir, str):
+            return tmp_dir
 
         # Sync new module into place
         deployargs = [
-            "rsync", "-rO", ".", "{0}@{1}:{2}".format(self.ssh_user, self.ssh_host, pluginroot),
-            "-e", self._get_rsync_rsh(),
+            "rsync", "-rO", ".", self._get_rsync_target(pluginroot),
             "--exclude=.git*",
             "--delete",
-        ]
-        deployenv = os.environ.copy()
-        deployproc = subprocess.Popen(deployargs, stderr=subprocess.PIPE, env=deployenv)
-        deployproc.wait()
-        exitcode = deployproc.returncode
-        _logging.debug("rsync exitcode: {0}".format(exitcode))
+        ] + self._get_rsync_rsh_args()
+        exitcode = self._run_rsync(deployargs, "{0}/{1}".format(tmp_dir, module_id))
         if exitcode != 0:
-            logging.error("Unable to sync new copy of {0} into place. Exit code: {1}".format(type, exitcode))
+            _logging.error("Unable to sync new copy of {0} into place. Exit code: {1}".format(type, exitcode))
             return exitcode
 
         # Done
         _logging.info("Deployment of '{0}' {1} branch '{2}' to '{3}:{4}' successful (job id: {5})...".format(module_id, type, self.git_branch, self.ssh_host, pluginroot, self.job_id))
         return 0
 
-    def deploy_site(self):
-        _logging.info("Deploying branch '{0}' to site '{1}' (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
-
+    def _get_site_rsync_args(self):
         # Sync new site into place, leaving config/content in place
-        work_dir = os.getcwd()
-        os.chdir("build/wordpress")
         deployargs = [
-            "rsync", "-r",
-            "-e", self._get_rsync_rsh(),
-            "--exclude=wp-config.php",
-            "--exclude=wp-salt.php",
-            "--exclude=wp-content/uploads",
+            "rsync", "-r", "--times",
+        ] + ["--exclude={0}".format(path) for path in SITE_EXCLUDES] + [
             "--delete",
             "--protocol=28",
-            ".", "{0}@{1}:{2}".format(self.ssh_user, self.ssh_host, self.ssh_path)
-        ]
-        deployenv = os.environ.copy()
-        deployproc = subprocess.Popen(deployargs, stderr=subprocess.PIPE, env=deployenv)
-        deployproc.wait()
-        exitcode = deployproc.returncode
-        _logging.debug("rsync exitcode: {0}".format(exitcode))
+            ".", self._get_rsync_target(self.ssh_path)
+        ] + self._get_rsync_rsh_args()
+
+        # Any other paths not to deploy (anchored to the document root)
+        extra_excludes = [path for path in self.excludes if path not in SITE_EXCLUDES]
+        if len(extra_excludes) > 0:
+            exclude_file = os.path.join(self.workspace.mkdtemp("rsync-"), "excludes")
+            with open(exclude_file, 'w') as f:
+                f.write("".join("/{0}\n".format(path) for path in extra_excludes))
+            deployargs.append("--exclude-from={0}".format(exclude_file))
+        return deployargs
+
+    def deploy_site(self):
+        _logging.info("Deploying branch '{0}' to site '{1}' (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
+        deployargs = self._get_site_rsync_args()
+
+        # Keep what the deploy replaces or removes, and a list of what it
+        # adds, so it can be undone
+        if self.keep_rollback:
+            if self.ssh_path is None:
+                _logging.error("No target folder given, set 'SSH_PATH'.")
+                raise Exception("Configuration error.")
+            self.rollback_dir = "{0}.wpcd-backup-{1}".format(self.ssh_path.rstrip("/"), randomword(10))
+            self.created_list = os.path.join(self.workspace.mkdtemp("rsync-"), "created")
+            deployargs += ["--backup", "--backup-dir={0}".format(self.rollback_dir), "--itemize-changes"]
+            with open(self.created_list, 'wb') as created:
+                def on_line(line):
+                    match = ITEMIZE_RE.match(line)
+                    if match is not None and match.group(1)[2:].strip("+") == "":
+                        path = match.group(2)
+                        if match.group(1)[1] == "L":
+                            path = path.split(" -> ")[0]
+                        created.write(path.rstrip("/").encode('utf-8') + b"\0")
+                exitcode = self._run_rsync(deployargs, self.get_site_build_dir(), on_line)
+        else:
+            exitcode = self._run_rsync(deployargs, self.get_site_build_dir())
         if exitcode != 0:
-            logging.error("Unable to sync new site into place. Exit code: {0}".format(exitcode))
-            logging.debug(deployproc.stderr.read())
+            _logging.error("Unable to sync new site into place. Exit code: {0}".format(exitcode))
             return exitcode
 
         # Done
         _logging.info("Deployment of branch '{0}' to site '{1}' successful (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
-        os.chdir(work_dir)
         return 0
+
+    def diff_site(self):
+        _logging.info("Working out what deploying branch '{0}' to site '{1}' would change (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
+
+        # Have rsync list what it would do, with the size of each file
+        diff = self.new_diff()
+        deployargs = self._get_site_rsync_args() + ["--dry-run", "--out-format=%i %l %n"]
+        def on_line(line):
+            match = DRY_RUN_RE.match(line)
+            if match is None or match.group(3).endswith("/"):
+                return
+            item, size, path = match.groups()
+            if item == "*deleting":
+                diff.add('deleted', path)
+            elif item[1] == "L":
+                diff.add('added' if item[2:].strip("+") == "" else 'changed', path.split(" -> ")[0])
+            elif item[0] in "<>":
+                diff.add('added' if item[2:].strip("+") == "" else 'changed', path, int(size))
+        exitcode = self._run_rsync(deployargs, self.get_site_build_dir(), on_line)
+        if exitcode != 0:
+            _logging.error("Unable to compare the site with the target. Exit code: {0}".format(exitcode))
+            raise Exception("rsync dry run failed.")
+        return diff
+
+    supports_rollback = True
+
+    def rollback_site(self):
+        _logging.info("Rolling back deployment of branch '{0}' to site '{1}' (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
+
+        # Remove what the deploy added, then put back what it replaced or removed
+        target = shlex.quote(self.ssh_path.rstrip("/"))
+        backup = shlex.quote(self.rollback_dir)
+        script = "\n".join([
+            "set -e",
+            "cd {0}".format(target),
+            "xargs -0 rm -rf --",
+            "if [ -d {0} ]; then cp -pPR {0}/. . && rm -rf {0}; fi".format(backup),
+        ])
+        with open(self.created_list, 'rb') as created:
+            exitcode = process.call(self._get_shell_args(script), label="rollback", stdin=created)
+        if exitcode != 0:
+            _logging.error("Unable to roll back the site. Exit code: {0}".format(exitcode))
+        return exitcode
+
+    def finish_deploy(self):
+        if self.rollback_dir is not None:
+            process.call(self._get_shell_args("rm -rf {0}".format(shlex.quote(self.rollback_dir))))
+            self.rollback_dir = None
@@ -0,0 +1,277 @@
+# Driver streaming site builds to the target as tar archives over ssh.
+#
+# Where rsync works through a large tree file by file, this splits the
+# build into a number of similarly sized compressed tar streams, unpacks
+# them side by side into a fresh copy of the document root on the target,
+# and then swaps that into place. This makes for much faster first deploys
+# of large sites. Plugins and themes are still deployed with rsync.
+
+import os
+import time
+import heapq
+import shlex
+import subprocess
+import logging
+_logging = logging.getLogger(__name__)
+
+from wordpress_cd.drivers import driver
+from wordpress_cd.drivers.base import SITE_EXCLUDES, list_site_files, randomword
+from wordpress_cd.drivers.rsync import RsyncDriver
+from wordpress_cd import process
+from wordpress_cd.dryrun import compare_listings, list_tree
+from wordpress_cd.throttle import get_buckets, get_process_bwlimits, get_nice_prefix, throttled_copy
+
+# Options telling 'tar' how to (de)compress each stream
+COMPRESSORS = {
+    'none': [],
+    'gzip': ["--gzip"],
+    'zstd': ["--zstd"],
+}
+
+# Rough cost of each file in a stream beyond its content (tar headers etc)
+FILE_OVERHEAD = 1024
+
+
+def split_streams(files, streams):
+    """Share (path, size) pairs between a number of similarly sized streams."""
+    heap = [(0, i, []) for i in range(streams)]
+    for (path, size) in sorted(files, key=lambda f: f[1], reverse=True):
+        total, i, paths = heapq.heappop(heap)
+        paths.append(path)
+        heapq.heappush(heap, (total + size + FILE_OVERHEAD, i, paths))
+    return [paths for (total, i, paths) in sorted(heap, key=lambda s: s[1]) if len(paths) > 0]
+
+
+@driver('tarssh')
+class TarSshDriver(RsyncDriver):
+    def __str__(self):
+        return "tarssh"
+
+    def __init__(self, args):
+        _logging.debug("Initialising tar-over-ssh driver")
+        super(TarSshDriver, self).__init__(args)
+
+        self.streams = int(os.getenv("WPCD_TARSSH_STREAMS", "4"))
+
+        # Compression only pays off over the network
+        self.compress = os.getenv("WPCD_TARSSH_COMPRESS", "none" if self.ssh_host is None else "gzip")
+        if self.compress not in COMPRESSORS:
+            _logging.error("Unknown compression '{0}' for tar streams.".format(self.compress))
+            raise Exception("Configuration error.")
+
+    def _resolve_link(self, var, target):
+        # Set a shell variable to the folder a link points at
+        return "{0}=$(readlink {1}); case \"${0}\" in /*) ;; *) {0}=\"$(dirname {1})/${0}\";; esac".format(var, shlex.quote(target))
+
+    def _link_script(self, target, release):
+        # Point the document root at a copy of the site in one step, by
+        # renaming a new link over the old one, so there's always a site there
+        link = "{0}.wpcd-link-{1}".format(target, randomword(10))
+        return [
+            "ln -sfn {0} {1}".format(shlex.quote(os.path.basename(release)), shlex.quote(link)),
+            "mv -T {0} {1}".format(shlex.quote(link), shlex.quote(target)),
+        ]
+
+    def _swap_script(self, target, release, keep_old = False):
+        # Carry over what belongs to the target, then swap the new copy in.
+        # Prints the copy it replaced.
+        quoted = shlex.quote(target)
+        lines = [
+            "set -e",
+            "shared=\"$(cd \"$(dirname {0})\" && pwd)/$(basename {0}).wpcd-shared\"".format(quoted),
+            "old=",
+            "if [ -L {0} ]; then".format(quoted),
+            "  " + self._resolve_link("old", target),
+            "elif [ -d {0} ]; then".format(quoted),
+            # A document root deployed some other way becomes a copy like
+            # any other (the only time the site is briefly missing)
+            "  old={0}".format(shlex.quote("{0}.wpcd-release-{1}".format(target, randomword(10)))),
+            "  mv {0} \"$old\" && ln -s \"$(basename \"$old\")\" {0}".format(quoted),
+            "fi",
+            "if [ -n \"$old\" ]; then",
+        ]
+        for path in SITE_EXCLUDES:
+            src = "\"$old\"/" + shlex.quote(path)
+            dst = shlex.quote("{0}/{1}".format(release, path))
+            shared = "\"$shared\"/" + shlex.quote(path)
+            lines += [
+                # Folders the site writes to (i.e. uploads) are moved out to
+                # a shared folder once, and linked to from every copy, so
+                # nothing written to them during a deploy is lost
+                "  if [ -d {0} ] && [ ! -L {0} ] && [ ! -e {1} ]; then mkdir -p \"$(dirname {1})\"; mv {0} {1}; ln -s {1} {0}; fi".format(src, shared),
+                "  if [ -d {0} ]; then mkdir -p \"$(dirname {1})\"; ln -s {0} {1};".format(shared, dst),
+                "  elif [ -e {0} ]; then cp -pPR {0} {1}; fi".format(src, dst),
+            ]
+        lines.append("fi")
+        lines += self._link_script(target, release)
+        lines.append("echo \"$old\"")
+        if not keep_old:
+            lines.append(self._remove_release_script("$old"))
+        return "\n".join(lines)
+
+    def _remove_release_script(self, var):
+        # Only remove copies of the site made by earlier deploys, not a
+        # folder the document root was linked to some other way
+        return "case \"{0}\" in *.wpcd-release-*) rm -rf \"{0}\";; esac".format(var)
+
+    def stream_files(self, build_dir, streams, staging):
+        """Send each list of files as its own tar stream, all at once. Returns the worst exit code."""
+        compress_args = COMPRESSORS[self.compress]
+        untar = "tar -x -f - --no-same-owner --no-recursion -C {0} {1}".format(shlex.quote(staging), " ".join(compress_args))
+        nice = get_nice_prefix()
+        if len(nice) > 0:
+            untar = " ".join(nice) + " " + untar
+
+        # Capped streams are passed through here, all drawing on the same budget
+        buckets = get_buckets(self.ssh_host)
+        list_dir = self.workspace.mkdtemp("tarssh-")
+        procs = []
+        copies = []
+        try:
+            for (i, paths) in enumerate(streams):
+                list_file = os.path.join(list_dir, "stream{0}".format(i))
+                with open(list_file, 'wb') as f:
+                    f.write(b"\0".join(p.encode('utf-8') for p in paths) + b"\0")
+                tarargs = ["tar", "-c", "-f", "-", "-C", build_dir, "--no-recursion", "--null", "-T", list_file] + compress_args
+                tarproc = process.popen(tarargs, stdout=subprocess.PIPE)
+                if len(buckets) > 0:
+                    untarproc = process.popen(self._get_shell_args(untar), label="untar", stdin=subprocess.PIPE)
+                    copies.append(throttled_copy(tarproc.stdout, untarproc.stdin, buckets))
+                else:
+                    untarproc = process.popen(self._get_shell_args(untar), label="untar", stdin=tarproc.stdout)
+                    tarproc.stdout.close()
+                if self.throttle is not None:
+                    self.throttle.add(tarproc)
+                procs += [tarproc, untarproc]
+            exitcodes = [proc.wait() for proc in procs]
+            for copy in copies:
+                copy.join()
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+        _logging.debug("tar exitcodes: {0}".format(exitcodes))
+        return max(exitcodes)
+
+    def deploy_site(self):
+        _logging.info("Deploying branch '{0}' to site '{1}' (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
+        if self.ssh_path is None:
+            _logging.error("No target folder given, set 'SSH_PATH'.")
+            raise Exception("Configuration error.")
+
+        # Only what belongs to the target is carried over to the new copy,
+        # so anything else left out of the deploy would go missing
+        if len([path for path in self.excludes if path not in SITE_EXCLUDES]) > 0:
+            _logging.error("The tarssh driver replaces the whole site, so can't leave files out of the deploy (i.e. with 'WPCD_OFFLOAD_EXCLUDE').")
+            raise Exception("Configuration error.")
+
+        # The new copy is unpacked next to the current one, then the
+        # document root (a link) is switched over to it
+        build_dir = self.get_site_build_dir()
+        target = self.ssh_path.rstrip("/")
+        staging = "{0}.wpcd-release-{1}".format(target, randomword(10))
+
+        # Folders go first, so empty ones are recreated too
+        files = list_site_files(build_dir, self.excludes, include_dirs=True)
+        dirs = [path for (path, size) in files if os.path.isdir(os.path.join(build_dir, path))]
+        dir_set = set(dirs)
+        files = [(path, size) for (path, size) in files if path not in dir_set]
+        streams = split_streams(files, self.streams)
+        if len(streams) > 0:
+            streams[0] = dirs + streams[0]
+        elif len(dirs) > 0:
+            streams = [dirs]
+        _logging.info("Streaming {0} files in {1} streams ({2} compression)...".format(len(files), len(streams), self.compress))
+
+        start = time.monotonic()
+        exitcode = process.call(self._get_shell_args("mkdir -p {0}".format(shlex.quote(staging))))
+        if exitcode == 0 and len(streams) > 0:
+            exitcode = self.stream_files(build_dir, streams, staging)
+        if exitcode != 0:
+            _logging.error("Unable to stream new site to target. Exit code: {0}".format(exitcode))
+            process.call(self._get_shell_args("rm -rf {0}".format(shlex.quote(staging))))
+            return exitcode
+
+        # Keep the current copy to swap back in, if asked
+        result = process.run(self._get_shell_args(self._swap_script(target, staging, self.keep_rollback)), label="swap", stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            _logging.error("Unable to swap new site into place. Exit code: {0}".format(result.returncode))
+            return result.returncode
+        old = result.stdout.decode('utf-8', 'surrogateescape').strip()
+        if self.keep_rollback and old != "":
+            self.rollback_dir = old
+
+        self.statistics['transfer'] = {
+            'driver': str(self),
+            'files': len(files),
+            'bytes': sum(size for (path, size) in files),
+            'streams': len(streams),
+            'compression': self.compress,
+            'seconds': round(time.monotonic() - start, 3),
+        }
+        per_host, total = get_process_bwlimits()
+        if per_host > 0 or total > 0:
+            self.statistics['transfer']['bwlimit_kbps'] = min(limit for limit in (per_host, total) if limit > 0)
+
+        # Done
+        _logging.info("Deployment of branch '{0}' to site '{1}' successful (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
+        return 0
+
+    def list_target_files(self):
+        """Return the (size, mtime) of each file on the target, as 'dryrun.list_tree' does for local ones."""
+        target = shlex.quote(self.ssh_path.rstrip("/"))
+        prune = " -o ".join("-path {0}".format(shlex.quote("./" + path)) for path in self.excludes)
+        if prune != "":
+            prune = "\\( {0} \\) -prune -o ".format(prune)
+        script = "cd {0} && find . {1}! -type d -printf '%s %T@ %P\\0'".format(target, prune)
+        result = process.run(self._get_shell_args(script), label="list", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            # Nothing deployed yet
+            _logging.warning("Unable to list the files on the target: {0}".format(result.stderr.decode('utf-8', 'replace').strip()))
+            return {}
+        files = {}
+        for record in result.stdout.split(b"\0"):
+            if record != b"":
+                size, mtime, path = record.decode('utf-8', 'surrogateescape').split(" ", 2)
+                files[path] = (int(size), int(float(mtime)))
+        return files
+
+    def diff_site(self):
+        _logging.info("Working out what deploying branch '{0}' to site '{1}' would change (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
+        if self.ssh_path is None:
+            _logging.error("No target folder given, set 'SSH_PATH'.")
+            raise Exception("Configuration error.")
+
+        # Every file is streamed, changed or not
+        local = list_tree(self.get_site_build_dir(), self.excludes)
+        return compare_listings(self.new_diff(), local, self.list_target_files(), transfer_all=True)
+
+    def rollback_site(self):
+        _logging.info("Rolling back deployment of branch '{0}' to site '{1}' (job id: {2})...".format(self.git_branch, self.ssh_host, self.job_id))
+        if self.rollback_dir is None:
+            _logging.error("No previous copy of the site to roll back to.")
+            return 1
+
+        # Switch the document root back to the previous copy, the same way
+        # as to a new one
+        target = self.ssh_path.rstrip("/")
+        previous = self.rollback_dir
+        lines = [
+            "set -e",
+            "if [ ! -d {0} ]; then echo 'No previous copy of the site to roll back to.' >&2; exit 1; fi".format(shlex.quote(previous)),
+            self._resolve_link("failed", target),
+        ]
+        lines += self._link_script(target, previous)
+        lines.append(self._remove_release_script("$failed"))
+        exitcode = process.call(self._get_shell_args("\n".join(lines)), label="rollback")
+        if exitcode != 0:
+            _logging.error("Unable to roll back the site. Exit code: {0}".format(exitcode))
+            return exitcode
+        self.rollback_dir = None
+        return 0
+
+    def finish_deploy(self):
+        # The copy kept may not have been made by a deploy (see '_swap_script')
+        if self.rollback_dir is not None and ".wpcd-release-" not in os.path.basename(self.rollback_dir):
+            self.rollback_dir = None
+        super(TarSshDriver, self).finish_deploy()
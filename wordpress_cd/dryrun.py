@@ -0,0 +1,106 @@
+# Dry runs of site deploys: what a deploy would add to, change on and
+# delete from the target, and how many bytes it would send, broken down by
+# component (core, each plugin, theme and must-use plugin), without changing
+# anything. Drivers work the differences out however is cheapest for them
+# (see 'BaseDriver.diff_site').
+
+import os
+import json
+import collections
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .files import scan_tree
+
+ACTIONS = ['added', 'changed', 'deleted', 'unchanged']
+
+# Reports are printed, unless collected here by a build daemon worker to
+# hand back to the job's client (see 'daemon.py')
+_collected = None
+
+
+def dry_run_enabled():
+    return os.getenv("WPCD_DRY_RUN", "0") == "1"
+
+
+class DeployDiff(object):
+    """The files a site deploy would add, change and delete, by component."""
+
+    def __init__(self, driver, wp_content_dir = "/wp-content", wp_plugin_dir = "/wp-content/plugins"):
+        self.driver = driver
+        self.content_dir = wp_content_dir.strip("/") + "/"
+        self.component_dirs = [
+            (wp_plugin_dir.strip("/") + "/", "plugins"),
+            (self.content_dir + "themes/", "themes"),
+            (self.content_dir + "mu-plugins/", "mu-plugins"),
+        ]
+        self.components = collections.defaultdict(lambda: dict([(action, 0) for action in ACTIONS] + [('bytes', 0)]))
+
+    def component(self, path):
+        """The component a path in the document root belongs to, e.g. 'core' or 'plugins/akismet'."""
+        for (prefix, type) in self.component_dirs:
+            if path.startswith(prefix):
+                return "{0}/{1}".format(type, path[len(prefix):].split("/")[0])
+        if path.startswith(self.content_dir):
+            return "wp-content"
+        return "core"
+
+    def add(self, action, path, size = 0, transfer = None):
+        """Count a file, with the bytes sent for it (by default, its size if added or changed)."""
+        counts = self.components[self.component(path)]
+        counts[action] += 1
+        if transfer is None:
+            transfer = size if action in ['added', 'changed'] else 0
+        counts['bytes'] += transfer
+
+    def report(self):
+        totals = dict([(action, 0) for action in ACTIONS] + [('bytes', 0)])
+        for counts in self.components.values():
+            for (key, value) in counts.items():
+                totals[key] += value
+        return {
+            'driver': self.driver,
+            'components': dict((name, counts) for (name, counts) in sorted(self.components.items())
+                if counts['added'] + counts['changed'] + counts['deleted'] + counts['bytes'] > 0),
+            'totals': totals,
+        }
+
+
+def emit_report(report):
+    """Print a dry run report as JSON, or keep it for the daemon's client."""
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if _collected is not None:
+        _collected.append(text)
+    else:
+        print(text)
+
+
+def list_tree(root, excludes = ()):
+    """Return the (size, whole seconds mtime) of each file (or symlink) under a folder, by relative path."""
+    files = {}
+    for (relpath, entry) in scan_tree(root, excludes):
+        if not entry.is_dir(follow_symlinks=False):
+            stat = entry.stat(follow_symlinks=False)
+            files[relpath] = (stat.st_size, int(stat.st_mtime))
+    return files
+
+
+def compare_listings(diff, local, remote, transfer_all = False):
+    """Add the differences between two listings (as from 'list_tree') to a 'DeployDiff'.
+
+    Files are taken to differ if their size or modification time does (as
+    rsync's quick check has it). With 'transfer_all', every file counts
+    towards the bytes sent, as for drivers that send the whole tree.
+    """
+    for (path, (size, mtime)) in local.items():
+        if path not in remote:
+            diff.add('added', path, size)
+        elif remote[path] != (size, mtime):
+            diff.add('changed', path, size)
+        else:
+            diff.add('unchanged', path, size, size if transfer_all else 0)
+    for path in remote:
+        if path not in local:
+            diff.add('deleted', path)
+    return diff
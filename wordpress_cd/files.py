@@ -0,0 +1,118 @@
+# Streaming helpers for working through large build trees.
+#
+# Trees are scanned depth first with 'os.scandir', one open directory per
+# level, so the memory used doesn't grow with the number of files in a tree
+# (some plugins ship hundreds of thousands). Files are copied in fixed-size
+# chunks within the kernel ('copy_file_range', which can share blocks on
+# filesystems that support it, or 'sendfile'), never through Python buffers.
+
+import os
+import stat
+import errno
+import shutil
+
+import logging
+_logger = logging.getLogger(__name__)
+
+# Largest single kernel copy request
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Errors meaning a kernel copy method isn't available for a pair of files
+# (e.g. across filesystems on older kernels), so the next should be tried
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+def scan_tree(root, excludes = (), _reldir = ""):
+    """Yield the (relative path, 'os.DirEntry') of everything under a folder.
+
+    Folders are yielded before their contents. Symlinks are not followed.
+    Paths (relative to 'root') in 'excludes' are skipped, along with
+    everything beneath them.
+    """
+    with os.scandir(os.path.join(root, _reldir) if _reldir != "" else root) as entries:
+        for entry in entries:
+            relpath = os.path.join(_reldir, entry.name) if _reldir != "" else entry.name
+            if relpath in excludes:
+                continue
+            yield relpath, entry
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_tree(root, excludes, relpath)
+
+
+def first_entry(path, ignore = ()):
+    """Return the (alphabetically) first name in a folder, apart from those ignored."""
+    with os.scandir(path) as entries:
+        return min((entry.name for entry in entries if entry.name not in ignore), default=None)
+
+
+def _kernel_copy(copy, infd, outfd, offset, size):
+    while offset < size:
+        copied = copy(infd, outfd, offset, min(COPY_CHUNK_SIZE, size - offset))
+        if copied == 0:
+            break
+        offset += copied
+    return offset
+
+def _copy_file_range(infd, outfd, offset, count):
+    return os.copy_file_range(infd, outfd, count, offset, offset)
+
+def _sendfile(infd, outfd, offset, count):
+    return os.sendfile(outfd, infd, offset, count)
+
+
+def copy_file(src, dst, mode = None):
+    """Copy a file's content (and permissions) in chunks, within the kernel where possible."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(infd).st_size
+        offset = 0
+        for copy in [_copy_file_range if hasattr(os, "copy_file_range") else None, _sendfile]:
+            if copy is None:
+                continue
+            try:
+                offset = _kernel_copy(copy, infd, outfd, offset, size)
+                break
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                os.lseek(outfd, offset, os.SEEK_SET)
+
+        # Anything left (e.g. a file that grew while copying) is copied as usual
+        os.lseek(infd, offset, os.SEEK_SET)
+        os.lseek(outfd, offset, os.SEEK_SET)
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+    os.chmod(dst, stat.S_IMODE(mode if mode is not None else os.stat(src).st_mode))
+
+
+def copy_tree(src, dst):
+    """Copy a folder tree into 'dst' (merging with what's there), as 'cp -r' does.
+
+    Returns the number of files and bytes copied.
+    """
+    files = 0
+    size = 0
+    os.makedirs(dst, exist_ok=True)
+    for relpath, entry in scan_tree(src):
+        target = os.path.join(dst, relpath)
+        if entry.is_symlink():
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir():
+            if not os.path.isdir(target):
+                os.mkdir(target)
+        else:
+            st = entry.stat()
+            copy_file(entry.path, target, st.st_mode)
+            files += 1
+            size += st.st_size
+    return files, size
+
+
+def reset_permissions(root, dir_mode = 0o755, file_mode = 0o644):
+    """Make everything in a tree readable (leaving symlinks, and what they point to, alone)."""
+    os.chmod(root, dir_mode)
+    for relpath, entry in scan_tree(root):
+        if entry.is_symlink():
+            continue
+        os.chmod(entry.path, dir_mode if entry.is_dir() else file_mode)
@@ -0,0 +1,268 @@
+# Lossless image optimisation for theme/plugin builds, using whichever
+# optimisers are installed locally ('oxipng'/'optipng', 'jpegtran', 'svgo',
+# 'cwebp'), with pure-python fallbacks for PNG and SVG files.
+
+import os
+import re
+import zlib
+import struct
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .cache import load_cache, cache_key, hash_file
+from . import process
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.svg']
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Ancillary PNG chunks that carry no image data
+PNG_DROP_CHUNKS = [b'tEXt', b'zTXt', b'iTXt', b'tIME']
+
+TOOLS = ['oxipng', 'optipng', 'jpegtran', 'svgo', 'cwebp']
+
+# Part of the cache keys, changed whenever the results would differ, so
+# results from earlier versions aren't reused
+CACHE_VERSION = "2"
+
+
+def available_tools():
+    return [tool for tool in TOOLS if shutil.which(tool) is not None]
+
+
+def _png_chunks(data):
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length = struct.unpack(">I", data[pos:pos + 4])[0]
+        type = data[pos + 4:pos + 8]
+        yield type, data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+
+def _png_chunk(type, body):
+    crc = zlib.crc32(type + body) & 0xffffffff
+    return struct.pack(">I", len(body)) + type + body + struct.pack(">I", crc)
+
+
+def optimise_png_data(data):
+    """Recompress PNG image data at maximum zlib compression, dropping text/time chunks."""
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    before = []
+    after = []
+    idat = []
+    for type, body in _png_chunks(data):
+        if type == b'IDAT':
+            idat.append(body)
+        elif type in PNG_DROP_CHUNKS:
+            continue
+        elif len(idat) == 0:
+            before.append((type, body))
+        else:
+            after.append((type, body))
+    if len(idat) == 0:
+        return data
+
+    raw = zlib.decompress(b''.join(idat))
+    best = None
+    for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        compressed = compressor.compress(raw) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+
+    result = PNG_SIGNATURE
+    result += b''.join(_png_chunk(type, body) for (type, body) in before)
+    result += _png_chunk(b'IDAT', best)
+    result += b''.join(_png_chunk(type, body) for (type, body) in after)
+    return result
+
+
+def optimise_svg_data(data):
+    """Strip comments and metadata from SVG markup.
+
+    Whitespace is left alone, as within text elements it is rendered.
+    """
+    text = data.decode('utf-8')
+    text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
+    text = re.sub(r'<metadata\b.*?</metadata>', '', text, flags=re.DOTALL)
+    return text.strip().encode('utf-8')
+
+
+def _run_tool(args, src, dst):
+    exitcode = process.call(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if exitcode != 0 or not os.path.isfile(dst):
+        _logger.debug("Image optimiser '{0}' failed on '{1}'. Exit code: {2}".format(args[0], src, exitcode))
+        return None
+    with open(dst, 'rb') as f:
+        return f.read()
+
+
+def _optimise(filename, data, tools, tmp_dir):
+    ext = os.path.splitext(filename)[1].lower()
+    out_file = os.path.join(tmp_dir, "out" + ext)
+    if ext == '.png':
+        if 'oxipng' in tools:
+            result = _run_tool(["oxipng", "-q", "-o", "4", "--out", out_file, filename], filename, out_file)
+        elif 'optipng' in tools:
+            result = _run_tool(["optipng", "-quiet", "-o2", "-out", out_file, filename], filename, out_file)
+        else:
+            result = optimise_png_data(data)
+    elif ext in ['.jpg', '.jpeg']:
+        if 'jpegtran' not in tools:
+            return None
+        # Colour profiles and orientation change how the image looks, so keep them
+        result = _run_tool(["jpegtran", "-copy", "all", "-optimize", "-progressive",
+            "-outfile", out_file, filename], filename, out_file)
+    elif ext == '.svg':
+        if 'svgo' in tools:
+            result = _run_tool(["svgo", "-q", "-i", filename, "-o", out_file], filename, out_file)
+        else:
+            result = optimise_svg_data(data)
+    else:
+        return None
+    return result
+
+
+def _webp(filename, tools, tmp_dir):
+    out_file = os.path.join(tmp_dir, "out.webp")
+    if 'cwebp' in tools:
+        return _run_tool(["cwebp", "-quiet", "-lossless", filename, "-o", out_file], filename, out_file)
+    if Image is not None:
+        Image.open(filename).save(out_file, "WEBP", lossless=True)
+        with open(out_file, 'rb') as f:
+            return f.read()
+    return None
+
+
+def _init_worker():
+    # Each worker sets up its own build cache (and connections to it)
+    import wordpress_cd.cache
+    wordpress_cd.cache._cache = None
+
+
+def _cached_result(cache, key, cached_file, make, original_size):
+    # Fetch a result from the cache, or make it and cache it, with an empty
+    # marker where it came out no smaller than the original. Returns whether
+    # it was cached.
+    if cache.get(key, cached_file):
+        return True
+    data = make()
+    with open(cached_file, 'wb') as f:
+        if data is not None and 0 < len(data) < original_size:
+            f.write(data)
+    cache.put(key, cached_file)
+    return False
+
+
+def _optimise_file(item):
+    # Runs in a worker process. Optimised results (or an empty marker where
+    # nothing could be saved) are cached under the source content hash.
+    filename, tools, webp = item
+    cache = load_cache()
+    sha256 = hash_file(filename)
+    original_size = os.path.getsize(filename)
+    result = {'file': filename, 'original': original_size, 'optimised': original_size, 'webp': None, 'cached': True}
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        def optimise():
+            with open(filename, 'rb') as f:
+                data = f.read()
+            try:
+                return _optimise(filename, data, tools, tmp_dir)
+            except Exception as e:
+                _logger.debug("Unable to optimise '{0}': {1}".format(filename, str(e)))
+                return None
+        key = cache_key("images", CACHE_VERSION, sha256, ",".join(tools))
+        cached_file = os.path.join(tmp_dir, "cached")
+        if not _cached_result(cache, key, cached_file, optimise, original_size):
+            result['cached'] = False
+        if os.path.getsize(cached_file) > 0:
+            shutil.copyfile(cached_file, filename)
+            result['optimised'] = os.path.getsize(filename)
+
+        # A WebP variant is only worth serving if it's smaller than the image
+        ext = os.path.splitext(filename)[1].lower()
+        if webp and ext in ['.png', '.jpg', '.jpeg']:
+            def convert():
+                try:
+                    return _webp(filename, tools, tmp_dir)
+                except Exception as e:
+                    _logger.debug("Unable to convert '{0}' to WebP: {1}".format(filename, str(e)))
+                    return None
+            key = cache_key("images-webp", CACHE_VERSION, sha256, ",".join(tools))
+            cached_file = os.path.join(tmp_dir, "cached.webp")
+            if not _cached_result(cache, key, cached_file, convert, result['optimised']):
+                result['cached'] = False
+            if 0 < os.path.getsize(cached_file) < result['optimised']:
+                # Named after the whole filename, so 'logo.png' and 'logo.jpg'
+                # (or a 'logo.webp' of the module's own) don't clash
+                webp_file = filename + ".webp"
+                shutil.copyfile(cached_file, webp_file)
+                result['webp'] = os.path.getsize(webp_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return result
+
+
+def optimise_images(root, webp = False, workers = None):
+    """Losslessly optimise the images in a tree in place, returning statistics."""
+    tools = available_tools()
+    _logger.debug("Image optimisers available: {0}".format(", ".join(tools) or "(none)"))
+    if webp and 'cwebp' not in tools and Image is None:
+        _logger.warning("No 'cwebp' command or PIL module available, skipping WebP variants.")
+        webp = False
+
+    filenames = []
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if d != 'node_modules']
+        for name in files:
+            filename = os.path.join(dirpath, name)
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS and not os.path.islink(filename):
+                filenames.append(filename)
+
+    stats = {
+        'files': len(filenames),
+        'optimised_files': 0,
+        'cached': 0,
+        'original_bytes': 0,
+        'optimised_bytes': 0,
+        'saved_bytes': 0,
+        'webp_files': 0,
+        'webp_bytes': 0,
+        'savings': {},
+    }
+    if len(filenames) == 0:
+        return stats
+
+    if workers is None:
+        workers = int(os.getenv("WPCD_IMAGES_WORKERS", "0")) or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        items = [(filename, tools, webp) for filename in filenames]
+        for result in executor.map(_optimise_file, items, chunksize=8):
+            relpath = os.path.relpath(result['file'], root)
+            stats['original_bytes'] += result['original']
+            stats['optimised_bytes'] += result['optimised']
+            if result['cached']:
+                stats['cached'] += 1
+            if result['optimised'] < result['original']:
+                saved = result['original'] - result['optimised']
+                stats['optimised_files'] += 1
+                stats['savings'][relpath] = saved
+                _logger.debug("Optimised '{0}', saving {1} bytes.".format(relpath, saved))
+            if result['webp'] is not None:
+                stats['webp_files'] += 1
+                stats['webp_bytes'] += result['webp']
+    stats['saved_bytes'] = stats['original_bytes'] - stats['optimised_bytes']
+    return stats
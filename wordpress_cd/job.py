@@ -1,10 +1,16 @@
 import os
-import subprocess
-import tempfile
+import json
+import time
+import contextlib
 
 import logging
 _logger = logging.getLogger(__name__)
 
+from .metrics import check_baseline
+from .artefact import ArtefactException, find_artefact, unpack
+from .workspace import Workspace
+from . import process
+
 
 def get_artefact_dir(work_dir):
     # Determine where we're going to place the resulting ZIP file
@@ -13,26 +19,32 @@ def get_artefact_dir(work_dir):
     except KeyError:
         return "{0}/wpcd-artefacts".format(work_dir)
 
-# Used by test/deploy stages to extract zipfiles from build stage
-def unpack_artefact():
+def get_module_id(workspace):
+    return os.getenv("JOB_BASE_NAME", os.path.basename(workspace.root))
+
+# Used by test/deploy stages to extract artefacts from build stage
+def unpack_artefact(workspace = None):
+    """Unpack a module's build artefact into the workspace's scratch folder, returning where.
+
+    The unpacked copy is removed along with the scratch folder.
+    """
     # Determine artefact filename and presence
-    work_dir = os.getcwd()
-    module_id = os.getenv("JOB_BASE_NAME", os.path.basename(os.getcwd()))
-    zip_file = "{0}/{1}.zip".format(get_artefact_dir(work_dir), module_id)
-
-    # Make temporary directory and move to it
-    tmp_dir = tempfile.mkdtemp()
-    os.chdir(tmp_dir)
-
-    # Unpack the artefact
-    _logger.info("Unpacking module build artefact '{0}'...".format(module_id))
-
-    # Sync new site into place, leaving config/content in place
-    unpackargs = [
-        "unzip", zip_file
-    ]
-    exitcode = subprocess.call(unpackargs)
-    _logger.debug("unzip exitcode: {0}".format(exitcode))
+    workspace = workspace or Workspace()
+    module_id = get_module_id(workspace)
+    artefact_file = find_artefact(get_artefact_dir(workspace.root), module_id)
+    if artefact_file is None:
+        _logger.error("Unable to find build artefact for '{0}'.".format(module_id))
+        return 1
+
+    # Unpack the artefact into a temporary folder
+    tmp_dir = workspace.mkdtemp("artefact-")
+    _logger.info("Unpacking module build artefact '{0}'...".format(os.path.basename(artefact_file)))
+    try:
+        exitcode = unpack(artefact_file, tmp_dir)
+    except ArtefactException as e:
+        _logger.error(str(e))
+        return 1
+    _logger.debug("Unpack exitcode: {0}".format(exitcode))
     if exitcode != 0:
         _logger.error("Unable to unpack build artefact. Exit code: {0}".format(exitcode))
         return exitcode
@@ -42,11 +54,17 @@ def unpack_artefact():
 
 # @abstractclass
 class JobHandler:
-    def __init__(self, type, name, args, job_id = None):
+    def __init__(self, type, name, args, job_id = None, workspace = None):
         self.type = type
         self.name = name
         self.args = args
         self.exception_handlers = []
+        self.workspace = workspace or Workspace(name=type)
+        self.work_dir = self.workspace.root
+
+        # Figures gathered while the job runs, for reports and notifications
+        self.statistics = {}
+        process.reset()
 
         self.job_id = os.getenv("CI_JOB_ID", job_id)
 
@@ -64,3 +82,44 @@ class JobHandler:
                 eh.handle_exception(e, self.type, self.name)
             except Exception as e2:
                 _logger.error("Exception handling exception with {0}: {1}".format(str(eh), str(e2)))
+
+    def write_report(self, stage):
+        """Write the statistics gathered during a stage to the artefact folder as JSON.
+
+        The cost of the commands run during the stage is included, and added
+        to the trace file if one is configured.
+        """
+        self.statistics['processes'] = process.summarise()
+        process.write_trace(stage, self.work_dir)
+
+        artefact_dir = get_artefact_dir(self.work_dir)
+        if not os.path.isdir(artefact_dir):
+            os.makedirs(artefact_dir)
+        report_file = "{0}/{1}-report.json".format(artefact_dir, stage)
+        _logger.debug("Writing {0} report to '{1}'".format(stage, report_file))
+        with open(report_file, 'w') as f:
+            json.dump(self.statistics, f, indent=2, sort_keys=True)
+        return report_file
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Add the time the enclosed step takes to the job's timing statistics."""
+        start_time = time.time()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            timings = self.statistics.setdefault('timings', {})
+            timings[name] = round(timings.get(name, 0) + duration, 3)
+            process.record_span(name, start_time, duration)
+
+    def get_project_name(self):
+        return os.getenv("CI_PROJECT_PATH", os.getenv("JOB_NAME", os.path.basename(self.work_dir)))
+
+    def check_baseline(self, stage):
+        """Compare this run's statistics with earlier runs, if enabled."""
+        if os.getenv("WPCD_BASELINE", "0") != "1":
+            return
+        regressions = check_baseline(self.get_project_name(), stage, self.job_id, self.statistics)
+        self.statistics['regressions'] = regressions
@@ -0,0 +1,147 @@
+# Load and latency smoke tests, run against the transient test site to
+# catch performance regressions before they reach production.
+
+import os
+import time
+import random
+import asyncio
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from urllib.parse import urljoin
+except Exception:
+    from urlparse import urljoin
+
+from .warmup import make_session, summarise, fetch_url
+
+DEFAULT_CONFIG = {
+    # Paths to request, with their relative weights
+    'urls': {'/': 1},
+    # Concurrency steps to ramp through, each held for an equal share of the duration
+    'ramp': [1, 4, 8],
+    # Total duration in seconds
+    'duration': 30,
+    'timeout': 30,
+    'verify-ssl': True,
+    # Failure thresholds. Latencies in milliseconds, error rate as a fraction.
+    'thresholds': {
+        'p95': 2000,
+        'error_rate': 0.01,
+    },
+}
+
+THRESHOLD_METRICS = ['p50', 'p90', 'p95', 'p99', 'error_rate']
+
+
+class LoadTestException(Exception):
+    pass
+
+
+def load_config(filename = None, workspace = None):
+    """Read the load test settings, from 'loadtest.yml' by default.
+
+    A relative filename is taken to be in the job's project folder.
+    """
+    config = dict(DEFAULT_CONFIG)
+    config['thresholds'] = dict(DEFAULT_CONFIG['thresholds'])
+    if filename is None:
+        filename = os.getenv("WPCD_LOADTEST_CONFIG", "loadtest.yml")
+    if workspace is not None:
+        filename = workspace.path(filename)
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            settings = yaml.safe_load(f) or {}
+
+        # Thresholds are merged with the defaults one by one (a threshold
+        # set to nothing removing the default), the rest replace them
+        thresholds = settings.pop('thresholds', None) or {}
+        config.update(settings)
+        for (metric, limit) in thresholds.items():
+            if limit is None:
+                config['thresholds'].pop(metric, None)
+            else:
+                config['thresholds'][metric] = limit
+    if isinstance(config['urls'], list):
+        config['urls'] = dict((url, 1) for url in config['urls'])
+    for metric in config['thresholds']:
+        if metric not in THRESHOLD_METRICS:
+            raise LoadTestException("Unknown load test threshold '{0}'.".format(metric))
+    return config
+
+
+async def _run_step(session, urls, weights, concurrency, duration, timeout, executor):
+    # Keep 'concurrency' virtual users busy requesting random URLs until the
+    # step's time is up
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + duration
+    results = []
+
+    async def user():
+        while time.monotonic() < deadline:
+            url = random.choices(urls, weights)[0]
+            results.append(await loop.run_in_executor(executor, fetch_url, session, url, timeout))
+
+    await asyncio.gather(*[user() for i in range(concurrency)])
+    return results
+
+
+async def _run(session, urls, weights, ramp, duration, timeout):
+    executor = ThreadPoolExecutor(max_workers=max(ramp))
+    steps = []
+    try:
+        for concurrency in ramp:
+            start = time.monotonic()
+            results = await _run_step(session, urls, weights, concurrency,
+                float(duration) / len(ramp), timeout, executor)
+            steps.append((concurrency, results, time.monotonic() - start))
+    finally:
+        executor.shutdown(wait=False)
+    return steps
+
+
+def check_thresholds(stats, thresholds):
+    """List the thresholds the statistics exceed."""
+    failures = []
+    for metric, limit in thresholds.items():
+        if metric == 'error_rate':
+            value = stats['error_rate']
+        else:
+            value = stats.get('latency_ms', {}).get(metric)
+        if value is None:
+            continue
+        if value > limit:
+            failures.append("{0} of {1:.3f} exceeds threshold of {2}".format(metric, value, limit))
+    return failures
+
+
+def run_load_test(base_url, config):
+    """Ramp load up against the site, returning statistics overall and per step."""
+    urls = [urljoin(base_url.rstrip("/") + "/", url.lstrip("/")) for url in config['urls'].keys()]
+    weights = list(config['urls'].values())
+    ramp = [int(c) for c in config['ramp']]
+    session = make_session(max(ramp), config['verify-ssl'])
+
+    _logger.info("Running load test against '{0}' for {1}s, ramping through concurrency {2}...".format(
+        base_url, config['duration'], ramp))
+    steps = asyncio.run(_run(session, urls, weights, ramp, config['duration'], config['timeout']))
+
+    all_results = []
+    stats = {'steps': []}
+    for concurrency, results, duration in steps:
+        step = summarise(results, duration)
+        step['concurrency'] = concurrency
+        stats['steps'].append(step)
+        all_results.extend(results)
+    stats.update(summarise(all_results, sum(duration for (c, r, duration) in steps)))
+    stats['thresholds'] = config['thresholds']
+    stats['failures'] = check_thresholds(stats, config['thresholds'])
+    stats['passed'] = len(stats['failures']) == 0
+    return stats
+
+
+def load_test_enabled():
+    return os.getenv("WPCD_LOADTEST", "0") == "1"
@@ -17,12 +17,13 @@ def usage():
     print("  test-wp-site [-v] [-d]  TODO: Run tests using artifacts from build directory.")
     print("  test-wp-plugin [-v] [-d]  TODO: Run tests on plugin found in current directory.")
     print("  test-wp-theme [-v] [-d]  TODO: Run tests on theme found in current directory.")
-    print("  deploy-wp-site [-v] [-d]  Deploy site artifacts to site specified via environment variables.")
+    print("  deploy-wp-site [-v] [-d] [--dry-run]  Deploy site artifacts to site specified via environment variables.")
     print("  deploy-wp-plugin [-v] [-d]  Deploy plugin to site specified via environment variables..")
     print("  deploy-wp-theme [-v] [-d]  Deploy theme to site specified via environment variables.")
     print("Arguments:")
     print("  -v  Be mildly verbose while running.")
     print("  -d  Include debugging output.")
+    print("  --dry-run  Report what a site deploy would change, without changing anything.")
 
 
 def main():
@@ -36,7 +37,12 @@ def main():
     #           help='name of configuration file to use for this run')
     parser.add_argument('-v', dest='verbose', action='store_true')
     parser.add_argument('-d', dest='debug', action='store_true')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true')
     args = parser.parse_args()
+
+    # Passed on in the environment, so it reaches a build daemon too
+    if args.dry_run:
+        os.environ['WPCD_DRY_RUN'] = "1"
     #configfile = args.configfile[0]
 
     # Enable logging if verbosity requested
@@ -50,31 +56,40 @@ def main():
         level=log_level,
         datefmt='%Y-%m-%d %H:%M:%S')
 
+    # Hand the job to a build daemon, if one is configured
+    if os.getenv("WPCD_DAEMON_URL") is not None:
+        import wordpress_cd.daemon
+        return wordpress_cd.daemon.submit(command_run, args)
+
+    return run_command(command_run, args)
+
+
+def run_command(command_run, args, workspace = None):
     # Act according to command run
     if command_run[0:6] == 'build-':
         import wordpress_cd.build
         if command_run == 'build-wp-plugin':
-            return wordpress_cd.build.build_plugin(args)
+            return wordpress_cd.build.build_plugin(args, workspace)
         elif command_run == 'build-wp-theme':
-            return wordpress_cd.build.build_theme(args)
+            return wordpress_cd.build.build_theme(args, workspace)
         elif command_run == 'build-wp-site':
-            return wordpress_cd.build.build_site(args)
+            return wordpress_cd.build.build_site(args, workspace)
     elif command_run[0:5] == 'test-':
         import wordpress_cd.test
         if command_run == 'test-wp-plugin':
-            return wordpress_cd.test.test_plugin(args)
+            return wordpress_cd.test.test_plugin(args, workspace)
         elif command_run == 'test-wp-theme':
-            return wordpress_cd.test.test_theme(args)
+            return wordpress_cd.test.test_theme(args, workspace)
         elif command_run == 'test-wp-site':
-            return wordpress_cd.test.test_site(args)
+            return wordpress_cd.test.test_site(args, workspace)
     elif command_run[0:7] == 'deploy-':
         import wordpress_cd.deploy
         if command_run == 'deploy-wp-plugin':
-            return wordpress_cd.deploy.deploy_plugin(args)
+            return wordpress_cd.deploy.deploy_plugin(args, workspace)
         elif command_run == 'deploy-wp-theme':
-            return wordpress_cd.deploy.deploy_theme(args)
+            return wordpress_cd.deploy.deploy_theme(args, workspace)
         elif command_run == 'deploy-wp-site':
-            return wordpress_cd.deploy.deploy_site(args)
+            return wordpress_cd.deploy.deploy_site(args, workspace)
 
     return usage()
 
@@ -0,0 +1,160 @@
+# Per-build metrics history, and comparison of each run with a rolling
+# baseline of earlier runs to flag performance regressions.
+
+import os
+import json
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .cache import get_local_cache_dir
+from .files import scan_tree
+
+# Statistics not worth tracking over time (i.e. per-file detail)
+IGNORED_KEYS = ['savings', 'steps', 'thresholds']
+
+# Metrics where a higher value is an improvement. Anything else that grows
+# (timings, sizes, latencies, error rates) is treated as a regression.
+HIGHER_IS_BETTER = ['saved_bytes', 'requests_per_second', 'cached']
+
+
+class RegressionException(Exception):
+    pass
+
+
+def flatten(statistics, prefix = ""):
+    """Reduce nested statistics to a flat dict of numeric metrics with dotted names."""
+    metrics = {}
+    for key, value in statistics.items():
+        if key in IGNORED_KEYS:
+            continue
+        name = "{0}{1}".format(prefix, key)
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, float)):
+            metrics[name] = value
+        elif isinstance(value, dict):
+            metrics.update(flatten(value, name + "."))
+    return metrics
+
+
+def component_metrics(root):
+    """Count the files and bytes of the core and each theme/plugin in a build tree."""
+    components = {}
+
+    def add(component, size):
+        entry = components.setdefault(component, {'files': 0, 'bytes': 0})
+        entry['files'] += 1
+        entry['bytes'] += size
+
+    for relpath, entry in scan_tree(root):
+        if entry.is_symlink() or entry.is_dir():
+            continue
+        parts = relpath.split(os.sep)
+        if len(parts) >= 4 and parts[0] == 'wp-content' and parts[1] in ['plugins', 'themes', 'mu-plugins']:
+            component = "{0}/{1}".format(parts[1], parts[2])
+        else:
+            component = "core"
+        add(component, entry.stat().st_size)
+    return components
+
+
+def get_history_file(project, stage):
+    try:
+        history_dir = os.environ['WPCD_METRICS_DIR']
+    except KeyError:
+        history_dir = os.path.join(get_local_cache_dir(), "metrics")
+    if not os.path.isdir(history_dir):
+        os.makedirs(history_dir, exist_ok=True)
+    return os.path.join(history_dir, "{0}-{1}.jsonl".format(project.replace("/", "_"), stage))
+
+
+def read_history(history_file, window):
+    if not os.path.isfile(history_file):
+        return []
+    with open(history_file, 'r') as f:
+        runs = [json.loads(line) for line in f if line.strip() != ""]
+    return runs[-window:]
+
+
+def record_run(history_file, job_id, metrics):
+    with open(history_file, 'a') as f:
+        f.write(json.dumps({
+            'timestamp': time.time(),
+            'job_id': job_id,
+            'metrics': metrics,
+        }, sort_keys=True) + "\n")
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def parse_thresholds(value):
+    # i.e. "timings.build=0.5,loadtest.latency_ms.p95=0.1"
+    thresholds = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            metric, threshold = item.split("=", 1)
+            thresholds[metric.strip()] = float(threshold)
+    return thresholds
+
+
+def compare(metrics, history, threshold = 0.2, thresholds = {}, min_runs = 3):
+    """Compare metrics with the median of earlier runs, listing any regressions.
+
+    A metric regresses when it is worse than its baseline by more than the
+    threshold (a fraction of the baseline), which can be set per metric.
+    Metrics are only compared once there are 'min_runs' earlier values.
+    """
+    regressions = []
+    for name, value in sorted(metrics.items()):
+        previous = [run['metrics'][name] for run in history if name in run.get('metrics', {})]
+        if len(previous) < min_runs:
+            continue
+        baseline = _median(previous)
+        if baseline == 0:
+            continue
+        change = (value - baseline) / float(abs(baseline))
+        if any(name.endswith(suffix) for suffix in HIGHER_IS_BETTER):
+            change = -change
+        limit = thresholds.get(name, threshold)
+        if change > limit:
+            regressions.append({
+                'metric': name,
+                'value': value,
+                'baseline': baseline,
+                'change': change,
+                'threshold': limit,
+            })
+    return regressions
+
+
+def check_baseline(project, stage, job_id, statistics):
+    """Record this run's metrics and compare them with the rolling baseline.
+
+    Configured with the 'WPCD_BASELINE_*' and 'WPCD_REGRESSION_*'
+    environment variables. Raises RegressionException if a regression is
+    found and 'WPCD_REGRESSION_FAIL' is set.
+    """
+    metrics = flatten(statistics)
+    history_file = get_history_file(project, stage)
+    history = read_history(history_file, int(os.getenv("WPCD_BASELINE_WINDOW", "10")))
+    regressions = compare(metrics, history,
+        threshold=float(os.getenv("WPCD_REGRESSION_THRESHOLD", "0.2")),
+        thresholds=parse_thresholds(os.getenv("WPCD_REGRESSION_THRESHOLDS")),
+        min_runs=int(os.getenv("WPCD_BASELINE_MIN_RUNS", "3")))
+    record_run(history_file, job_id, metrics)
+
+    for r in regressions:
+        _logger.warning("Performance regression in {0}: {1:.3f} vs baseline {2:.3f} ({3:+.0%}).".format(
+            r['metric'], r['value'], r['baseline'], r['change']))
+    if len(regressions) > 0 and os.getenv("WPCD_REGRESSION_FAIL", "0") == "1":
+        raise RegressionException("{0} metrics regressed beyond threshold: {1}".format(
+            len(regressions), ", ".join(r['metric'] for r in regressions)))
+    return regressions
@@ -0,0 +1,280 @@
+# Offloads the static assets of themes and plugins to an S3-compatible
+# bucket (i.e. a CDN origin) at deploy time, so they needn't be shipped to
+# every web server.
+#
+# Each asset is stored once under a name derived from its content (its
+# SHA-256 hash plus extension), so objects never change once uploaded and
+# can be cached forever. Relative references within stylesheets are
+# rewritten to the content-hashed names of the assets they point to, or to
+# the site itself for files that aren't offloaded. A
+# generated must-use plugin then points WordPress at the offloaded copies.
+
+import os
+import io
+import re
+import time
+import hashlib
+import mimetypes
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .cache import hash_file
+from .s3 import get_s3_client, parse_s3_url
+
+STATIC_EXTENSIONS = [
+    'css', 'js', 'map', 'png', 'jpg', 'jpeg', 'gif', 'webp', 'avif', 'svg', 'ico',
+    'woff', 'woff2', 'ttf', 'otf', 'eot',
+]
+
+# Folders within the document root containing theme/plugin assets
+ASSET_DIRS = ['wp-content/themes', 'wp-content/plugins', 'wp-content/mu-plugins']
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Relative references to other files within stylesheets
+CSS_REF_RE = re.compile(r'''(url\(\s*['"]?|@import\s+['"])([^'")\s]+)''')
+
+MU_PLUGIN = """<?php
+/**
+ * Points WordPress at offloaded copies of static theme/plugin assets.
+ *
+ * Only URLs passing through the filters below are changed; anything else
+ * still loads the copies on the web servers.
+ *
+ * Generated by wordpress-cd at deploy time.
+ */
+function wpcd_offload_url($url) {
+    static $map = null;
+    static $content_path = null;
+    if ($map === null) {
+        $map = require __DIR__ . '/wpcd-offload-map.php';
+        $content_path = preg_replace('#^https?:#', '', content_url('/'));
+    }
+    $path = preg_replace('#^https?:#', '', strtok($url, '?#'));
+    if (strpos($path, $content_path) !== 0) {
+        return $url;
+    }
+    $relpath = substr($path, strlen($content_path));
+    return isset($map[$relpath]) ? $map[$relpath] : $url;
+}
+
+foreach (array('style_loader_src', 'script_loader_src', 'plugins_url', 'theme_file_uri', 'parent_theme_file_uri') as $filter) {
+    add_filter($filter, 'wpcd_offload_url');
+}
+"""
+
+
+class OffloadException(Exception):
+    pass
+
+
+def offload_enabled():
+    return os.getenv("WPCD_OFFLOAD_URL") is not None
+
+def get_extensions():
+    extensions = os.getenv("WPCD_OFFLOAD_EXTENSIONS")
+    if extensions is None:
+        return STATIC_EXTENSIONS
+    return [e.strip().lstrip(".").lower() for e in extensions.split(",") if e.strip() != ""]
+
+
+def find_static_assets(root, extensions = STATIC_EXTENSIONS):
+    """Return the paths (relative to the document root) of theme/plugin static assets."""
+    assets = []
+    for asset_dir in ASSET_DIRS:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, asset_dir)):
+            reldir = os.path.relpath(dirpath, root)
+            for filename in filenames:
+                if filename.rsplit(".", 1)[-1].lower() in extensions:
+                    assets.append(posixpath.join(reldir, filename))
+    return sorted(assets)
+
+
+def object_name(sha256, path):
+    return "{0}{1}".format(sha256, posixpath.splitext(path)[1].lower())
+
+
+class AssetPlan(object):
+    """Works out the content-hashed object name (and content) of each asset."""
+
+    def __init__(self, root, assets, origin_url = None):
+        self.root = root
+        self.assets = set(assets)
+        self.origin_url = origin_url.rstrip("/") if origin_url else None
+        self.names = {}
+        self.rewritten = {}
+        self._resolving = set()
+
+    def resolve(self, path):
+        """Return the object name for an asset, rewriting stylesheets first."""
+        if path in self.names:
+            return self.names[path]
+        filename = os.path.join(self.root, path)
+        if not path.lower().endswith(".css"):
+            self.names[path] = object_name(hash_file(filename), path)
+            return self.names[path]
+
+        # Stylesheets are named after their content once rewritten, so the
+        # assets they refer to are named first
+        self._resolving.add(path)
+        with open(filename, 'rb') as f:
+            data = f.read().decode('utf-8', errors='surrogateescape')
+        data = CSS_REF_RE.sub(lambda m: m.group(1) + self._rewrite_ref(path, m.group(2)), data)
+        data = data.encode('utf-8', errors='surrogateescape')
+        self._resolving.discard(path)
+        self.rewritten[path] = data
+        self.names[path] = object_name(hashlib.sha256(data).hexdigest(), path)
+        return self.names[path]
+
+    def _rewrite_ref(self, css_path, ref):
+        # Leave absolute, data and fragment-only references alone
+        if ref.startswith(("/", "#", "data:")) or "://" in ref:
+            return ref
+        split = re.search(r'[?#]', ref)
+        target, suffix = (ref[:split.start()], ref[split.start():]) if split else (ref, "")
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(css_path), target))
+        if target in self.assets and target not in self._resolving:
+            return self.resolve(target) + suffix
+
+        # The stylesheet is served from the CDN, so anything else it refers
+        # to is fetched from the site itself
+        if target.startswith("../"):
+            return ref
+        if self.origin_url is None:
+            raise OffloadException("'{0}' refers to '{1}', which isn't offloaded. Set 'WPCD_OFFLOAD_ORIGIN_URL' (or 'WPCD_SITE_URL') so it can be fetched from the site.".format(css_path, ref))
+        return "{0}/{1}{2}".format(self.origin_url, target, suffix)
+
+    def plan(self, threads = None):
+        # Hash everything but stylesheets in parallel first
+        others = [path for path in self.assets if not path.lower().endswith(".css")]
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+            for (path, sha256) in zip(others, executor.map(hash_file, [os.path.join(self.root, p) for p in others])):
+                self.names[path] = object_name(sha256, path)
+        for path in sorted(self.assets):
+            self.resolve(path)
+        return self.names
+
+
+class AssetOffloader(object):
+    """Uploads static assets once each, by content hash, to an S3-compatible bucket."""
+
+    def __init__(self, url, base_url, threads = None, origin_url = None):
+        if not url.startswith("s3://"):
+            raise OffloadException("Offload URL must be an 's3://bucket/prefix' URL, not '{0}'.".format(url))
+        self.bucket, self.prefix = parse_s3_url(url)
+        self.prefix = self.prefix.strip("/")
+        self.base_url = base_url.rstrip("/")
+        self.origin_url = origin_url
+        self.threads = threads or int(os.getenv("WPCD_OFFLOAD_THREADS", "16"))
+        self.client = get_s3_client(max_pool_connections=self.threads)
+
+    def _key(self, name):
+        if self.prefix == "":
+            return name
+        return "{0}/{1}".format(self.prefix, name)
+
+    def exists(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return False
+            raise
+
+    def upload(self, root, plan):
+        """Upload whichever planned objects aren't in the bucket already."""
+        from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+        # The same content may appear under several paths
+        objects = {}
+        for (path, name) in plan.names.items():
+            objects.setdefault(name, path)
+
+        names = sorted(objects.keys())
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            missing = [name for (name, exists) in zip(names, executor.map(self.exists, names)) if not exists]
+
+        config = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            max_concurrency=self.threads,
+        )
+        uploaded_bytes = 0
+        with create_transfer_manager(self.client, config) as manager:
+            futures = []
+            for name in missing:
+                path = objects[name]
+                extra_args = {'CacheControl': CACHE_CONTROL}
+                content_type = guess_content_type(path)
+                if content_type is not None:
+                    extra_args['ContentType'] = content_type
+                if path in plan.rewritten:
+                    source = io.BytesIO(plan.rewritten[path])
+                    uploaded_bytes += len(plan.rewritten[path])
+                else:
+                    source = os.path.join(root, path)
+                    uploaded_bytes += os.path.getsize(source)
+                futures.append(manager.upload(source, self.bucket, self._key(name), extra_args=extra_args))
+            for future in futures:
+                future.result()
+
+        return {
+            'objects': len(names),
+            'uploaded': len(missing),
+            'present': len(names) - len(missing),
+            'uploaded_bytes': uploaded_bytes,
+        }
+
+    def write_mu_plugin(self, root, plan):
+        """Write the must-use plugin (and map) pointing WordPress at the offloaded assets."""
+        mu_plugins_dir = os.path.join(root, "wp-content", "mu-plugins")
+        if not os.path.isdir(mu_plugins_dir):
+            os.makedirs(mu_plugins_dir)
+        with open(os.path.join(mu_plugins_dir, "wpcd-offload-map.php"), 'w') as f:
+            f.write("<?php\n// Generated by wordpress-cd at deploy time.\nreturn array(\n")
+            for (path, name) in sorted(plan.names.items()):
+                relpath = path[len("wp-content/"):]
+                f.write("    {0} => {1},\n".format(php_string(relpath), php_string("{0}/{1}".format(self.base_url, name))))
+            f.write(");\n")
+        with open(os.path.join(mu_plugins_dir, "wpcd-offload.php"), 'w') as f:
+            f.write(MU_PLUGIN)
+
+    def offload(self, root, extensions = STATIC_EXTENSIONS):
+        """Offload the static assets in a site build. Returns statistics and the paths offloaded."""
+        start = time.monotonic()
+        assets = find_static_assets(root, extensions)
+        _logger.info("Offloading {0} static assets to 's3://{1}/{2}'...".format(len(assets), self.bucket, self.prefix))
+        plan = AssetPlan(root, assets, self.origin_url)
+        plan.plan()
+        stats = self.upload(root, plan)
+        self.write_mu_plugin(root, plan)
+        stats['files'] = len(assets)
+        stats['rewritten'] = len(plan.rewritten)
+        stats['seconds'] = round(time.monotonic() - start, 3)
+        _logger.info("Offloaded {0} static assets as {1} objects ({2} uploaded, {3} already present).".format(
+            stats['files'], stats['objects'], stats['uploaded'], stats['present']))
+        return stats, assets
+
+
+def guess_content_type(path):
+    content_type, encoding = mimetypes.guess_type(path)
+    if encoding is not None:
+        return None
+    return content_type
+
+def php_string(value):
+    return "'{0}'".format(value.replace("\\", "\\\\").replace("'", "\\'"))
+
+
+def offload_from_env(root):
+    """Offload a site build's static assets as configured by environment variables."""
+    base_url = os.getenv("WPCD_OFFLOAD_BASE_URL")
+    if base_url is None:
+        raise OffloadException("Set 'WPCD_OFFLOAD_BASE_URL' to the public URL of the offloaded assets.")
+    origin_url = os.getenv("WPCD_OFFLOAD_ORIGIN_URL", os.getenv("WPCD_SITE_URL"))
+    offloader = AssetOffloader(os.environ['WPCD_OFFLOAD_URL'], base_url, origin_url=origin_url)
+    return offloader.offload(root, get_extensions())
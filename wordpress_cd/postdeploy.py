@@ -0,0 +1,239 @@
+# Post-deploy hooks: actions run once a deploy is in place, such as
+# resetting PHP's opcache, purging page caches and checking the site is
+# healthy. Each hook runs on all of the site's web servers at once (over the
+# job's shared ssh connections), and the hooks run one after another, in
+# the order given. Should the site fail its health check, the deploy stage
+# rolls it back, where the driver is able to.
+
+import os
+import time
+import shlex
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from . import process
+from .ssh import SshSession
+from .warmup import make_session, fetch_url, summarise
+
+hooks = {}
+
+
+def hook(name):
+    """Register a post-deploy hook class under a name."""
+    def decorator(cls):
+        cls.name = name
+        hooks[name] = cls
+        return cls
+    return decorator
+
+
+class HookException(Exception):
+    pass
+
+
+class Hook(object):
+    """An action run on each of the site's hosts after a deploy."""
+
+    # Whether failing this hook means the new site is unhealthy (and so
+    # should be rolled back)
+    checks_health = False
+
+    def __init__(self, driver, timeout):
+        self.driver = driver
+        self.timeout = timeout
+
+    def hosts(self, hosts):
+        """Which of the site's hosts to run on ('None' meaning once, for the whole site)."""
+        return hosts
+
+    def run(self, host):
+        """Run on a host, returning statistics, or raising 'HookException' on failure."""
+        raise NotImplementedError()
+
+    def run_command(self, host, command):
+        """Run a shell command in the document root of a host (locally without one)."""
+        path = os.getenv("SSH_PATH")
+        if path is not None:
+            command = "cd {0} && {1}".format(shlex.quote(path), command)
+        session = SshSession.from_env(self.driver.workspace, host)
+        proc = process.popen(session.shell_args(command), label=self.name,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        try:
+            output, _ = proc.communicate(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            # Take anything the command started down with it
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            raise HookException("timed out after {0}s".format(self.timeout))
+        output = output.decode('utf-8', 'replace').strip()
+        if proc.returncode != 0:
+            raise HookException("exit code {0}: {1}".format(proc.returncode, output[-1000:]))
+        if output != "":
+            _logger.debug("{0} on '{1}': {2}".format(self.name, session, output))
+        return output
+
+
+@hook('opcache')
+class OpcacheResetHook(Hook):
+    """Reset PHP's opcache, so the new code is compiled and served straight away."""
+
+    def run(self, host):
+        self.run_command(host, os.getenv("WPCD_OPCACHE_RESET_COMMAND", "cachetool opcache:reset"))
+        return {}
+
+
+@hook('purge')
+class PageCachePurgeHook(Hook):
+    """Empty the page cache (WP Super Cache's, unless told otherwise)."""
+
+    def run(self, host):
+        command = os.getenv("WPCD_PURGE_COMMAND")
+        if command is None:
+            cache_dir = shlex.quote(".{0}/cache/supercache".format(self.driver.wp_content_dir))
+            command = "[ ! -d {0} ] || find {0} -mindepth 1 -delete".format(cache_dir)
+        self.run_command(host, command)
+        return {}
+
+
+@hook('cdn-purge')
+class CdnPurgeHook(Hook):
+    """Ask the CDN (or a caching proxy) to purge the site, by HTTP request."""
+
+    def __init__(self, driver, timeout):
+        super(CdnPurgeHook, self).__init__(driver, timeout)
+        self.urls = [url.strip() for url in os.getenv("WPCD_PURGE_URLS", "").split(",") if url.strip() != ""]
+        self.method = os.getenv("WPCD_PURGE_METHOD", "PURGE")
+        if len(self.urls) == 0:
+            _logger.error("No URLs to purge given, set 'WPCD_PURGE_URLS'.")
+            raise Exception("Configuration error.")
+
+    def hosts(self, hosts):
+        return [None]
+
+    def run(self, host):
+        session = make_session(1)
+        for url in self.urls:
+            try:
+                r = session.request(self.method, url, timeout=self.timeout)
+            except Exception as e:
+                raise HookException("{0} {1} failed: {2}".format(self.method, url, str(e)))
+            if r.status_code >= 400:
+                raise HookException("{0} {1} failed: {2}".format(self.method, url, r.status_code))
+        return {'urls': len(self.urls)}
+
+
+@hook('health')
+class HealthCheckHook(Hook):
+    """Fetch a page a few times, failing if it errors or is slower than the latency budget."""
+
+    checks_health = True
+
+    def __init__(self, driver, timeout):
+        super(HealthCheckHook, self).__init__(driver, timeout)
+        self.url = os.getenv("WPCD_HEALTH_URL", os.getenv("WPCD_SITE_URL"))
+        if self.url is None:
+            _logger.error("No URL to check the site's health with, set 'WPCD_HEALTH_URL' or 'WPCD_SITE_URL'.")
+            raise Exception("Configuration error.")
+        self.requests = int(os.getenv("WPCD_HEALTH_REQUESTS", "5"))
+        self.prime = int(os.getenv("WPCD_HEALTH_PRIME", "1"))
+        self.p95_ms = float(os.getenv("WPCD_HEALTH_P95_MS", "2000"))
+        self.max_error_rate = float(os.getenv("WPCD_HEALTH_MAX_ERROR_RATE", "0"))
+        self.verify = os.getenv("WPCD_HEALTH_VERIFY_SSL", "1") == "1"
+
+    def hosts(self, hosts):
+        # Check each host directly if the URL says how, otherwise the site as a whole
+        if "{host}" in self.url:
+            return hosts
+        return [None]
+
+    def run(self, host):
+        url = self.url.replace("{host}", host or "localhost")
+        session = make_session(1, self.verify)
+
+        # The first requests after a purge fill the caches, so don't count
+        for i in range(self.prime):
+            fetch_url(session, url, self.timeout)
+        stats = summarise([fetch_url(session, url, self.timeout) for i in range(self.requests)])
+        stats['url'] = url
+
+        if stats['error_rate'] > self.max_error_rate:
+            raise HookException("{0} of {1} requests for '{2}' failed".format(stats['errors'], stats['requests'], url), stats)
+        p95 = stats.get('latency_ms', {}).get('p95')
+        if p95 is not None and p95 > self.p95_ms:
+            raise HookException("p95 latency of '{0}' is {1:.0f}ms, over the budget of {2:.0f}ms".format(url, p95, self.p95_ms), stats)
+        return stats
+
+
+def get_hook_names():
+    return [name.strip() for name in os.getenv("WPCD_POSTDEPLOY_HOOKS", "").split(",") if name.strip() != ""]
+
+def get_hosts():
+    """The site's web servers, or just the deploy target ('None' when local)."""
+    hosts = [host.strip() for host in os.getenv("WPCD_HOOK_HOSTS", "").split(",") if host.strip() != ""]
+    if len(hosts) == 0:
+        hosts = [os.getenv("SSH_HOST")]
+    return hosts
+
+
+def _run_on_host(instance, host):
+    start = time.monotonic()
+    try:
+        result = {'ok': True, 'stats': instance.run(host)}
+    except HookException as e:
+        result = {'ok': False, 'error': str(e.args[0])}
+        if len(e.args) > 1:
+            result['stats'] = e.args[1]
+    except Exception as e:
+        _logger.exception(str(e))
+        result = {'ok': False, 'error': str(e)}
+    result['seconds'] = round(time.monotonic() - start, 3)
+    return result
+
+
+def load_hooks(driver, names = None, timeout = None):
+    """Set up the hooks configured by 'WPCD_POSTDEPLOY_HOOKS' (or named), checking their settings."""
+    if names is None:
+        names = get_hook_names()
+    if timeout is None:
+        timeout = float(os.getenv("WPCD_HOOK_TIMEOUT", "60"))
+    for name in names:
+        if name not in hooks:
+            _logger.error("Unknown post-deploy hook '{0}' (expected one of: {1}).".format(name, ", ".join(sorted(hooks.keys()))))
+            raise Exception("Configuration error.")
+    return [hooks[name](driver, timeout) for name in names]
+
+
+def run_hooks(instances, hosts = None):
+    """Run hooks in turn, each on all hosts at once, stopping at the first to fail.
+
+    Returns statistics, including the failures (if any) and whether the
+    site is 'healthy' (i.e. has passed every health check run).
+    """
+    if hosts is None:
+        hosts = get_hosts()
+    stats = {'hosts': [host or "localhost" for host in hosts], 'hooks': {}, 'failures': [], 'healthy': True}
+    start = time.monotonic()
+    for instance in instances:
+        targets = instance.hosts(hosts)
+        _logger.info("Running post-deploy hook '{0}' on {1} host(s)...".format(instance.name, len(targets)))
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            results = list(executor.map(lambda host: _run_on_host(instance, host), targets))
+
+        stats['hooks'][instance.name] = {}
+        for (host, result) in zip(targets, results):
+            # Hooks run once for the whole site are recorded against it
+            where = host if host is not None else ("localhost" if targets is hosts else "site")
+            stats['hooks'][instance.name][where] = result
+            if not result['ok']:
+                _logger.error("Post-deploy hook '{0}' failed on '{1}': {2}".format(instance.name, where, result['error']))
+                stats['failures'].append("{0} ({1}): {2}".format(instance.name, where, result['error']))
+                if instance.checks_health:
+                    stats['healthy'] = False
+        if len(stats['failures']) > 0:
+            break
+    stats['seconds'] = round(time.monotonic() - start, 3)
+    return stats
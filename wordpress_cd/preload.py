@@ -0,0 +1,205 @@
+# Generates an opcache preload script ('preload.php') for a build, listing
+# the PHP files most likely to be needed by every request first.
+
+import os
+import re
+import collections
+
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from urllib.parse import urlparse
+except Exception:
+    from urlparse import urlparse
+
+# The files WordPress itself starts from on a typical request
+CORE_ENTRY_POINTS = [
+    'index.php', 'wp-blog-header.php', 'wp-load.php', 'wp-config.php', 'wp-settings.php',
+]
+
+# Folders never worth preloading
+SKIP_DIRS = ['uploads', 'cache', 'node_modules', 'tests', 'test', '.git']
+
+# Matches include/require statements built from a string literal, optionally
+# prefixed with one of the usual base path expressions
+INCLUDE_RE = re.compile(
+    r"\b(?:require|include)(?:_once)?\s*\(?\s*"
+    r"((?:(?:ABSPATH|WPINC|__DIR__|dirname\s*\(\s*__FILE__\s*\)|WP_CONTENT_DIR|WP_PLUGIN_DIR)\s*\.\s*)*)"
+    r"['\"]([^'\"]+\.php)['\"]")
+
+# Extracts the request path from a common/combined format access log line
+ACCESS_LOG_RE = re.compile(r'"(?:GET|POST|HEAD) (\S+) HTTP/[0-9.]+"')
+
+PRELOAD_TEMPLATE = """<?php
+/**
+ * Opcache preload script, generated by wordpress-cd at build time.
+ *
+ * Enable with 'opcache.preload' in php.ini. Keep this file outside the
+ * document root, which is taken to be the 'wordpress' folder next to it
+ * unless the 'WPCD_PRELOAD_ROOT' environment variable says otherwise.
+ * Files are compiled but not executed, so the order only matters if the
+ * list is cut short.
+ */
+
+$root = getenv('WPCD_PRELOAD_ROOT') ?: __DIR__ . '/wordpress';
+$files = [
+{0}
+];
+
+foreach ($files as $file) {{
+    if (file_exists($root . '/' . $file)) {{
+        @opcache_compile_file($root . '/' . $file);
+    }}
+}}
+"""
+
+
+def find_php_files(root):
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(files):
+            if name.endswith(".php"):
+                yield os.path.relpath(os.path.join(dirpath, name), root)
+
+
+def _resolve_include(root, relpath, prefix, path):
+    # Work out which file an include statement refers to, if we can
+    prefix = re.sub(r'\s', '', prefix)
+    if 'WPINC' in prefix:
+        candidate = os.path.join('wp-includes', path.lstrip('/'))
+    elif 'ABSPATH' in prefix:
+        candidate = path.lstrip('/')
+    elif 'WP_PLUGIN_DIR' in prefix:
+        candidate = os.path.join('wp-content/plugins', path.lstrip('/'))
+    elif 'WP_CONTENT_DIR' in prefix:
+        candidate = os.path.join('wp-content', path.lstrip('/'))
+    else:
+        candidate = os.path.join(os.path.dirname(relpath), path.lstrip('/'))
+    candidate = os.path.normpath(candidate)
+    if os.path.isfile(os.path.join(root, candidate)):
+        return candidate
+    return None
+
+
+def include_graph(root):
+    """Map each PHP file in a build to the files it (statically) includes."""
+    graph = {}
+    for relpath in find_php_files(root):
+        includes = []
+        try:
+            with open(os.path.join(root, relpath), 'r', errors='replace') as f:
+                source = f.read()
+        except IOError:
+            continue
+        for prefix, path in INCLUDE_RE.findall(source):
+            target = _resolve_include(root, relpath, prefix, path)
+            if target is not None and target != relpath:
+                includes.append(target)
+        graph[relpath] = includes
+    return graph
+
+
+def _plugin_entry_points(root, graph):
+    # Main plugin files are those in a plugin folder named after the folder,
+    # or carrying a 'Plugin Name:' header
+    entries = []
+    for relpath in graph:
+        parts = relpath.split(os.sep)
+        if len(parts) == 3 and parts[0:2] == ['wp-content', 'mu-plugins']:
+            entries.append(relpath)
+        elif len(parts) == 4 and parts[0:2] == ['wp-content', 'plugins']:
+            if parts[3] == parts[2] + ".php":
+                entries.append(relpath)
+    return entries
+
+
+def _request_entry_point(path):
+    # Map a requested URL path to the PHP script that would serve it
+    path = urlparse(path).path
+    if path.endswith(".php"):
+        return path.lstrip('/')
+    if path.startswith("/wp-admin"):
+        return "wp-admin/index.php"
+    if path.startswith("/wp-content/") or path.startswith("/wp-includes/"):
+        # Static assets
+        return None
+    return "index.php"
+
+
+def read_access_log(filename):
+    """Count the requests for each PHP entry point in an access log."""
+    counts = collections.Counter()
+    with open(filename, 'r', errors='replace') as f:
+        for line in f:
+            match = ACCESS_LOG_RE.search(line)
+            if match is None:
+                continue
+            entry = _request_entry_point(match.group(1))
+            if entry is not None:
+                counts[entry] += 1
+    return counts
+
+
+def rank_files(root, access_log = None):
+    """Rank the PHP files in a build by how likely each request is to need them.
+
+    Files are scored by walking the static include graph from the entry
+    points. With an access log, each entry point is weighted by how often it
+    was requested, otherwise the core and plugin entry points are weighted
+    equally. Files reachable in fewer steps from the entry points rank
+    higher among files with the same score.
+    """
+    graph = include_graph(root)
+    if access_log is not None:
+        weights = read_access_log(access_log)
+        # Plugins are loaded on every request routed through WordPress
+        wp_requests = sum(count for (entry, count) in weights.items() if entry not in CORE_ENTRY_POINTS[1:])
+        for entry in _plugin_entry_points(root, graph):
+            weights[entry] += wp_requests
+    else:
+        weights = collections.Counter()
+        for entry in CORE_ENTRY_POINTS + _plugin_entry_points(root, graph):
+            weights[entry] = 1
+
+    scores = collections.Counter()
+    depths = {}
+    for entry, weight in weights.items():
+        if entry not in graph:
+            continue
+        # Breadth-first walk from this entry point
+        seen = set([entry])
+        queue = collections.deque([(entry, 0)])
+        while queue:
+            relpath, depth = queue.popleft()
+            scores[relpath] += weight
+            depths[relpath] = min(depth, depths.get(relpath, depth))
+            for target in graph.get(relpath, []):
+                if target not in seen:
+                    seen.add(target)
+                    queue.append((target, depth + 1))
+
+    # 'wp-config.php' must never be compiled ahead of time as it has side effects
+    ranked = [f for f in scores if f != 'wp-config.php']
+    ranked.sort(key=lambda f: (-scores[f], depths[f], f))
+    return ranked
+
+
+def write_preload(filename, files):
+    lines = ",\n".join("    '{0}'".format(f.replace("'", "\\'")) for f in files)
+    with open(filename, 'w') as f:
+        f.write(PRELOAD_TEMPLATE.format(lines))
+
+
+def generate_preload(root, limit = 1000, access_log = None, filename = None):
+    """Write a preload script for the build in 'root', returning the number of files listed.
+
+    The script is written next to 'root' ('preload.php' in its parent
+    folder) unless told otherwise, since it has no business being served.
+    """
+    if filename is None:
+        filename = os.path.join(os.path.dirname(os.path.abspath(root)), "preload.php")
+    files = rank_files(root, access_log)[:limit]
+    write_preload(filename, files)
+    _logger.debug("Listed {0} files in preload script '{1}'.".format(len(files), filename))
+    return len(files)
@@ -0,0 +1,310 @@
+# Runs the external commands (tar, unzip, rsync, npm etc) that do most of
+# the work, recording what each one cost: how long it took, its exit code,
+# the user/system CPU time it used and its peak memory use (via 'wait4').
+#
+# The records are summarised in each stage's report and, with
+# 'WPCD_TRACE_FILE' set, written out along with the timed steps of each job
+# as Chrome trace events, which can be opened in a profiler UI (such as
+# https://ui.perfetto.dev or chrome://tracing) to see where a pipeline run
+# spends its time.
+#
+# Long-running commands (i.e. rsync) can have their output pumped into the
+# log as it arrives, rather than left to fill a pipe, keeping only the tail
+# of it for error reports.
+
+import os
+import re
+import json
+import time
+import threading
+import subprocess
+import collections
+
+import logging
+_logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_records = []
+_spans = []
+
+# Read size for output pipes
+PIPE_CHUNK_SIZE = 65536
+
+# Lines end with a newline, or a carriage return for progress updates
+LINE_END_RE = re.compile(b'[\r\n]')
+
+
+class Process(subprocess.Popen):
+    """A 'subprocess.Popen' that records the cost of the command once it exits."""
+
+    def __init__(self, args, label = None, **kwargs):
+        self.label = label or os.path.basename(args[0])
+        self.rusage = None
+        self.recorded = False
+        self.start_time = time.time()
+        self.start_monotonic = time.monotonic()
+        _logger.debug("Running '{0}'".format(" ".join(args)))
+        super(Process, self).__init__(args, **kwargs)
+
+    def _try_wait(self, wait_flags):
+        # As 'Popen', but collecting the resources the command used as well
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+    def wait(self, timeout = None):
+        exitcode = super(Process, self).wait(timeout)
+        if not self.recorded:
+            self.recorded = True
+            record(self)
+        return exitcode
+
+
+def record(proc):
+    duration = time.monotonic() - proc.start_monotonic
+    entry = {
+        'name': proc.label,
+        'args': list(proc.args),
+        'start': proc.start_time,
+        'duration': round(duration, 3),
+        'exitcode': proc.returncode,
+        'pid': os.getpid(),
+        'tid': threading.get_native_id(),
+    }
+    if proc.rusage is not None:
+        # The peak memory use of a forked command is never less than that
+        # of this process when it was started
+        entry['user'] = round(proc.rusage.ru_utime, 3)
+        entry['system'] = round(proc.rusage.ru_stime, 3)
+        entry['max_rss_kb'] = proc.rusage.ru_maxrss
+        _logger.debug("'{0}' exited with {1} after {2:.3f}s (user {3:.3f}s, system {4:.3f}s, max RSS {5} KB)".format(
+            proc.label, proc.returncode, duration, entry['user'], entry['system'], entry['max_rss_kb']))
+    else:
+        _logger.debug("'{0}' exited with {1} after {2:.3f}s".format(proc.label, proc.returncode, duration))
+    with _lock:
+        _records.append(entry)
+
+
+def popen(args, label = None, **kwargs):
+    """Start a command, as 'subprocess.Popen' does."""
+    return Process(args, label, **kwargs)
+
+def call(args, label = None, **kwargs):
+    """Run a command and return its exit code, as 'subprocess.call' does."""
+    with Process(args, label, **kwargs) as proc:
+        try:
+            return proc.wait()
+        except:
+            proc.kill()
+            raise
+
+def run(args, input = None, check = False, label = None, **kwargs):
+    """Run a command and collect its output, as 'subprocess.run' does."""
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    with Process(args, label, **kwargs) as proc:
+        try:
+            stdout, stderr = proc.communicate(input)
+        except:
+            proc.kill()
+            raise
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, stdout, stderr)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+class RingBuffer(object):
+    """Keeps the last 'size' bytes written to it."""
+
+    def __init__(self, size):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+        self.total = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        self.total += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        return b"".join(self.chunks)[-self.size:]
+
+
+class OutputPump(threading.Thread):
+    """Reads a command's output as it arrives, passing on each line and keeping the tail."""
+
+    def __init__(self, pipe, name, on_line = None, buffer_size = 65536, logger = None):
+        super(OutputPump, self).__init__(name="wpcd-pump-{0}".format(name), daemon=True)
+        self.pipe = pipe
+        self.on_line = on_line
+        self.buffer = RingBuffer(buffer_size)
+        self.logger = logger or _logger
+        self.prefix = name
+
+    def run(self):
+        fd = self.pipe.fileno()
+        partial = b""
+        try:
+            while True:
+                data = os.read(fd, PIPE_CHUNK_SIZE)
+                if not data:
+                    break
+                self.buffer.write(data)
+                lines = LINE_END_RE.split(partial + data)
+                partial = lines.pop()
+                for line in lines:
+                    self._line(line)
+
+                # Don't let a line without end grow without bound
+                if len(partial) > self.buffer.size:
+                    self._line(partial)
+                    partial = b""
+            self._line(partial)
+        finally:
+            self.pipe.close()
+
+    def _line(self, line):
+        if line.strip() == b"":
+            return
+        text = line.decode('utf-8', errors='replace').rstrip()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("{0}: {1}".format(self.prefix, text))
+        if self.on_line is not None:
+            try:
+                self.on_line(text)
+            except Exception as e:
+                _logger.warning("Unable to handle output from {0}: {1}".format(self.prefix, str(e)))
+
+    def tail(self):
+        return self.buffer.getvalue().decode('utf-8', errors='replace')
+
+
+def stream(args, label = None, on_stdout = None, on_stderr = None, buffer_size = None, logger = None, on_start = None, **kwargs):
+    """Run a command, pumping its output into the log as it arrives.
+
+    The process is passed to 'on_start' once started, if given. Each line
+    of output is passed to 'on_stdout'/'on_stderr' if given. Only
+    the last 'buffer_size' bytes of each are kept, and returned along with
+    the exit code as '(exitcode, stdout tail, stderr tail)'.
+    """
+    if buffer_size is None:
+        buffer_size = int(os.getenv("WPCD_OUTPUT_BUFFER_KB", "64")) * 1024
+    with Process(args, label, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs) as proc:
+        pumps = [
+            OutputPump(proc.stdout, "{0} stdout".format(proc.label), on_stdout, buffer_size, logger),
+            OutputPump(proc.stderr, "{0} stderr".format(proc.label), on_stderr, buffer_size, logger),
+        ]
+        # The pumps close the pipes once done with them
+        proc.stdout = proc.stderr = None
+        for pump in pumps:
+            pump.start()
+        try:
+            if on_start is not None:
+                on_start(proc)
+            exitcode = proc.wait()
+        except:
+            proc.kill()
+            raise
+        finally:
+            for pump in pumps:
+                pump.join()
+    return exitcode, pumps[0].tail(), pumps[1].tail()
+
+
+def record_span(name, start, duration):
+    """Note a timed step of a job, for the trace."""
+    with _lock:
+        _spans.append({
+            'name': name,
+            'start': start,
+            'duration': duration,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+        })
+
+def reset():
+    with _lock:
+        del _records[:]
+        del _spans[:]
+
+def get_records():
+    with _lock:
+        return list(_records)
+
+
+def summarise():
+    """Total up the cost of the commands run so far, by command."""
+    summary = {}
+    for entry in get_records():
+        totals = summary.setdefault(entry['name'], {
+            'count': 0, 'seconds': 0.0, 'user': 0.0, 'system': 0.0, 'max_rss_kb': 0, 'failures': 0,
+        })
+        totals['count'] += 1
+        totals['seconds'] += entry['duration']
+        totals['user'] += entry.get('user', 0.0)
+        totals['system'] += entry.get('system', 0.0)
+        totals['max_rss_kb'] = max(totals['max_rss_kb'], entry.get('max_rss_kb', 0))
+        if entry['exitcode'] != 0:
+            totals['failures'] += 1
+    for totals in summary.values():
+        for name in ['seconds', 'user', 'system']:
+            totals[name] = round(totals[name], 3)
+    return summary
+
+
+def trace_events(stage):
+    """Return the steps and commands recorded so far as Chrome trace events."""
+    pid = os.getpid()
+    events = [{
+        'name': "process_name", 'ph': "M", 'pid': pid, 'tid': 0,
+        'args': {'name': "wordpress-cd {0}".format(stage)},
+    }]
+    with _lock:
+        for span in _spans:
+            events.append({
+                'name': span['name'], 'cat': "step", 'ph': "X",
+                'ts': int(span['start'] * 1000000), 'dur': int(span['duration'] * 1000000),
+                'pid': span['pid'], 'tid': span['tid'],
+            })
+        for entry in _records:
+            args = dict((k, entry[k]) for k in ['args', 'exitcode', 'user', 'system', 'max_rss_kb'] if k in entry)
+            args['args'] = " ".join(args['args'])
+            events.append({
+                'name': entry['name'], 'cat': "process", 'ph': "X",
+                'ts': int(entry['start'] * 1000000), 'dur': int(entry['duration'] * 1000000),
+                'pid': entry['pid'], 'tid': entry['tid'], 'args': args,
+            })
+    return events
+
+def write_trace(stage, work_dir):
+    """Add this stage's trace events to the trace file, if one is configured."""
+    trace_file = os.getenv("WPCD_TRACE_FILE")
+    if trace_file is None:
+        return None
+    trace_file = os.path.join(work_dir, trace_file)
+
+    # Stages run as separate jobs add to the same trace
+    trace = {'traceEvents': [], 'displayTimeUnit': "ms"}
+    if os.path.isfile(trace_file):
+        try:
+            with open(trace_file, 'r') as f:
+                trace = json.load(f)
+        except ValueError as e:
+            _logger.warning("Replacing unreadable trace file '{0}': {1}".format(trace_file, str(e)))
+    trace['traceEvents'].extend(trace_events(stage))
+
+    trace_dir = os.path.dirname(trace_file)
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    with open(trace_file + ".tmp", 'w') as f:
+        json.dump(trace, f)
+    os.replace(trace_file + ".tmp", trace_file)
+    _logger.debug("Wrote {0} trace to '{1}'".format(stage, trace_file))
+    return trace_file
@@ -0,0 +1,26 @@
+# Helpers shared by the components that talk to S3-compatible storage
+
+import os
+
+try:
+    from urllib.parse import urlparse
+except Exception:
+    from urlparse import urlparse
+
+
+def parse_s3_url(url):
+    """Split an 's3://bucket/prefix' URL into bucket and prefix."""
+    urlbits = urlparse(url)
+    return urlbits.netloc, urlbits.path[1:]
+
+
+def get_s3_client(max_pool_connections = None):
+    # Allows a local S3 stand-in (i.e. minio) or other S3-compatible
+    # service to be used instead of AWS.
+    import boto3
+    from botocore.config import Config
+    endpoint_url = os.getenv("WPCD_S3_ENDPOINT_URL")
+    config = None
+    if max_pool_connections is not None:
+        config = Config(max_pool_connections=max_pool_connections)
+    return boto3.client('s3', endpoint_url=endpoint_url, config=config)
@@ -0,0 +1,98 @@
+# Shared ssh connections to the hosts a job works on.
+#
+# Every ssh command run for a job (rsync transfers, tar streams, post-deploy
+# hooks etc) goes through one master connection per host, which is set up
+# by the first command and reused by the rest ('ControlMaster'), so each
+# host is only connected to and authenticated with once per job. Connections
+# are closed when the job is done, or soon after ('ControlPersist') if a job
+# doesn't get that far.
+
+import os
+import shlex
+import threading
+import subprocess
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from . import process
+
+# The sessions opened for each workspace, to be closed with the job
+_sessions = {}
+_lock = threading.Lock()
+
+
+class SshSession(object):
+    """Runs commands on a host (or, without one, locally) over a shared ssh connection."""
+
+    def __init__(self, host, user = None, port = None, password = None, control_dir = None):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.password = password
+        self.control_dir = control_dir
+
+    @classmethod
+    def from_env(cls, workspace, host = None):
+        """A session with the 'SSH_*' settings, for 'host' (or 'SSH_HOST'), shared within the workspace."""
+        host = host or os.getenv('SSH_HOST')
+        if host is None:
+            return cls(None)
+        session = cls(host, os.getenv('SSH_USER'), os.getenv('SSH_PORT'), os.getenv('SSH_PASS'), workspace.scratch("ssh"))
+        with _lock:
+            _sessions.setdefault(workspace, {})[session.destination] = session
+        return session
+
+    def __str__(self):
+        return self.host or "localhost"
+
+    @property
+    def destination(self):
+        if self.user is None:
+            return self.host
+        return "{0}@{1}".format(self.user, self.host)
+
+    def ssh_command(self, options = []):
+        """The ssh command (without the destination), as for rsync's '-e'."""
+        args = ["ssh"] + options + ["-o", "StrictHostKeyChecking=no"]
+        if self.control_dir is not None and os.getenv("WPCD_SSH_MULTIPLEX", "1") == "1":
+            args += [
+                "-o", "ControlMaster=auto",
+                "-o", "ControlPath={0}/%C".format(self.control_dir),
+                "-o", "ControlPersist={0}".format(os.getenv("WPCD_SSH_PERSIST", "60")),
+            ]
+
+        # Is a specific port set?
+        if self.port is not None:
+            args += ["-p", str(self.port)]
+
+        # Should we feed the password in?
+        if self.password is not None:
+            args = ["sshpass", "-p", self.password] + args
+        return args
+
+    def rsh(self, options = []):
+        return " ".join(shlex.quote(arg) for arg in self.ssh_command(options))
+
+    def shell_args(self, script):
+        """The command running a shell script on the host."""
+        # Without a host, work on local folders (i.e. a mounted docroot)
+        if self.host is None:
+            return ["sh", "-c", script]
+        return self.ssh_command() + [self.destination, script]
+
+    def close(self):
+        if self.host is None or self.control_dir is None:
+            return
+        process.call(self.ssh_command() + ["-O", "exit", self.destination],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def close_sessions(workspace):
+    """Close the shared connections opened for a workspace."""
+    with _lock:
+        sessions = _sessions.pop(workspace, {})
+    for session in sessions.values():
+        if os.path.exists(session.control_dir):
+            _logger.debug("Closing ssh connection to '{0}'".format(session))
+            session.close()
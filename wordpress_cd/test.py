@@ -15,24 +15,30 @@ class TestJobHandler(JobHandler):
     def _test_handling_exceptions(self):
         try:
             notify_start("test")
-            self.test()
-            notify_success("test")
+            with self.timed("test"):
+                self.test()
+            self.check_baseline("test")
+            self.write_report("test")
+            notify_success("test", self.statistics)
             return 0
         except Exception as e:
             _logger.exception(str(e))
             self._handle_exception(e)
-            notify_failure("test", str(e))
+            self.write_report("test")
+            notify_failure("test", str(e), self.statistics)
             return 1
+        finally:
+            self.workspace.cleanup()
 
 
 class TestSiteJobHandler(TestJobHandler):
-    def __init__(self, args):
-        super(TestSiteJobHandler, self).__init__("site", None, args)
+    def __init__(self, args, workspace = None):
+        super(TestSiteJobHandler, self).__init__("site", None, args, workspace=workspace)
 
     # Defines a default workflow for a 'test' stage, which assumes we will
     # fire up a new site, run tests then tear the test site down...
     def test(self):
-        driver = drivers.load_driver(self.args)
+        driver = drivers.load_driver(self.args, self.workspace)
         _logger.info("Deploying transient copy of site using {0} driver...".format(driver))
 
         try:
@@ -45,10 +51,11 @@ class TestSiteJobHandler(TestJobHandler):
         finally:
             # Garbage collect the transient site copy
             driver.test_site_teardown()
+            self.statistics.update(driver.statistics)
 
 
-def test_site(args):
-    job = TestSiteJobHandler(args)
+def test_site(args, workspace = None):
+    job = TestSiteJobHandler(args, workspace)
     return job._test_handling_exceptions()
 
 
@@ -58,11 +65,11 @@ def test_site(args):
 # that site and test suites triggered. Something like that.
 #
 
-def _test_module(args, type):
+def _test_module(args, type, workspace = None):
     raise NotImplementedError()
 
-def test_plugin(args):
-    _test_module(args, "plugin")
+def test_plugin(args, workspace = None):
+    _test_module(args, "plugin", workspace)
 
-def test_theme(args):
-    _test_module(args, "theme")
+def test_theme(args, workspace = None):
+    _test_module(args, "theme", workspace)
@@ -0,0 +1,275 @@
+# Keeping deploys from slowing down the sites they deploy to. Transfers can
+# be capped in bandwidth, both to each host and for all of a job's (or the
+# daemon's) transfers together; the commands writing files on the target can be run
+# at a lower I/O and CPU priority; and in adaptive mode, transfers are
+# paused whenever the site responds slowly, until it recovers.
+
+import os
+import time
+import signal
+import threading
+import collections
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .warmup import make_session, fetch_url, percentile
+
+# 'ionice' scheduling classes, by name
+IONICE_CLASSES = {
+    'best-effort': "2",
+    'idle': "3",
+}
+
+PIPE_CHUNK_SIZE = 65536
+
+_lock = threading.Lock()
+_buckets = {}
+
+# The number of processes sharing the caps, i.e. the daemon's workers, each
+# of which may be running a deploy at the same time as the others
+_processes = 1
+
+
+class TokenBucket(object):
+    """Limits the rate bytes pass through, shared by any number of threads."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.burst = max(self.rate / 10, PIPE_CHUNK_SIZE)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        # Take what's needed straight away, going into debt if need be, and
+        # then wait until the debt is paid off
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_bwlimits():
+    """The bandwidth caps for each host and for all transfers together, in KB/s (0 for none)."""
+    try:
+        return int(os.getenv("WPCD_BWLIMIT", "0")), int(os.getenv("WPCD_BWLIMIT_TOTAL", "0"))
+    except ValueError as e:
+        _logger.error("Invalid bandwidth cap: {0}".format(str(e)))
+        raise Exception("Configuration error.")
+
+
+def set_processes(processes):
+    """Share the caps between this many processes transferring at once."""
+    global _processes
+    _processes = max(1, processes)
+
+
+def get_process_bwlimits():
+    """This process's share of the bandwidth caps for each host and overall, in KB/s (0 for none)."""
+    return tuple(max(1, limit // _processes) if limit > 0 else 0 for limit in get_bwlimits())
+
+
+def get_buckets(host):
+    """The token buckets a stream to 'host' should draw on (its host's and the overall one)."""
+    per_host, total = get_process_bwlimits()
+    keys = []
+    if per_host > 0:
+        keys.append(('host', host, per_host))
+    if total > 0:
+        keys.append(('total', None, total))
+    with _lock:
+        return [_buckets.setdefault(key, TokenBucket(key[2] * 1024)) for key in keys]
+
+
+def bandwidth_share():
+    """The cap for a command (such as rsync) that can only be given a fixed one, in KB/s (0 for none).
+
+    A job runs its transfers of this kind one at a time, so this is the
+    lower of this process's shares of the caps.
+    """
+    limits = [limit for limit in get_process_bwlimits() if limit > 0]
+    return min(limits) if len(limits) > 0 else 0
+
+
+def throttled_copy(src, dst, buckets):
+    """Copy one pipe into another in a thread, drawing on the buckets as it goes."""
+    def copy():
+        try:
+            while True:
+                data = os.read(src.fileno(), PIPE_CHUNK_SIZE)
+                if not data:
+                    break
+                for bucket in buckets:
+                    bucket.consume(len(data))
+                dst.write(data)
+        except (BrokenPipeError, OSError) as e:
+            _logger.debug("Throttled copy stopped: {0}".format(str(e)))
+        finally:
+            src.close()
+            try:
+                dst.close()
+            except BrokenPipeError:
+                pass
+    thread = threading.Thread(target=copy, name="wpcd-throttle", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_nice_prefix():
+    """The words of a command running another at the configured I/O and CPU priority (if any)."""
+    words = []
+    ionice = os.getenv("WPCD_REMOTE_IONICE")
+    if ionice:
+        name, _, level = ionice.partition(":")
+        if name not in IONICE_CLASSES or (level != "" and not level.isdigit()):
+            _logger.error("Unknown I/O priority '{0}' (expected 'idle', 'best-effort' or 'best-effort:<0-7>').".format(ionice))
+            raise Exception("Configuration error.")
+        words += ["ionice", "-c", IONICE_CLASSES[name]] + (["-n", level] if level != "" else [])
+    nice = os.getenv("WPCD_REMOTE_NICE")
+    if nice:
+        if not nice.lstrip("-").isdigit():
+            _logger.error("Invalid niceness '{0}'.".format(nice))
+            raise Exception("Configuration error.")
+        words += ["nice", "-n", nice]
+    return words
+
+
+class AdaptiveThrottle(object):
+    """Pauses processes (i.e. transfers) while a URL responds slower than a threshold.
+
+    The URL is fetched every 'interval' seconds, and the transfers are
+    stopped while the median latency of the last 'window' requests (failed
+    ones counting as slow) is over the threshold. They are let go again once
+    it drops back, or after 'max_pause' seconds regardless, so the deploy
+    always makes progress.
+    """
+
+    def __init__(self, url, threshold_ms, interval = 1.0, window = 3, max_pause = 60, timeout = 10, verify = True):
+        self.url = url
+        self.threshold_ms = threshold_ms
+        self.interval = interval
+        self.window = collections.deque(maxlen=window)
+        self.max_pause = max_pause
+        self.timeout = timeout
+        self.session = make_session(1, verify)
+        self.lock = threading.Lock()
+        self.procs = []
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.paused_since = None
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.latencies = []
+        self.errors = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def add(self, proc):
+        """Have a process paused along with the rest."""
+        with self.lock:
+            self.procs.append(proc)
+            if self.paused_since is not None:
+                self._signal([proc], signal.SIGSTOP)
+
+    def wait(self):
+        """Hold up a thread transferring data in this process (i.e. an upload) while transfers are paused."""
+        self.resumed.wait()
+
+    def _signal(self, procs, sig):
+        for proc in procs:
+            if proc.returncode is None:
+                try:
+                    os.kill(proc.pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    def _pause(self):
+        with self.lock:
+            self.paused_since = time.monotonic()
+            self.pauses += 1
+            self.resumed.clear()
+            self._signal(self.procs, signal.SIGSTOP)
+
+    def _resume(self):
+        with self.lock:
+            self.paused_seconds += time.monotonic() - self.paused_since
+            self.paused_since = None
+            self.resumed.set()
+            self._signal(self.procs, signal.SIGCONT)
+
+    def sample(self):
+        """Time a request for the URL, returning its latency in ms (or None if it failed)."""
+        url, status, latency, error = fetch_url(self.session, self.url, self.timeout)
+        if error is not None or status is None or status >= 500:
+            self.errors += 1
+            return None
+        self.latencies.append(latency * 1000.0)
+        return latency * 1000.0
+
+    def check(self):
+        latency = self.sample()
+        self.window.append(latency if latency is not None else float('inf'))
+        median = sorted(self.window)[len(self.window) // 2]
+        slow = median > self.threshold_ms
+        if self.paused_since is None:
+            if slow:
+                _logger.info("Site responding slowly (median {0:.0f}ms), pausing the transfer...".format(median))
+                self._pause()
+        elif not slow:
+            _logger.info("Site recovered (median {0:.0f}ms), resuming the transfer...".format(median))
+            self._resume()
+        elif time.monotonic() - self.paused_since >= self.max_pause:
+            _logger.info("Transfer paused for {0}s, resuming it regardless...".format(self.max_pause))
+            self._resume()
+            self.window.clear()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                _logger.warning("Unable to check the site's latency: {0}".format(str(e)))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="wpcd-adaptive-throttle", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.paused_since is not None:
+            self._resume()
+
+    def statistics(self):
+        latencies = sorted(self.latencies)
+        stats = {
+            'url': self.url,
+            'threshold_ms': self.threshold_ms,
+            'samples': len(latencies) + self.errors,
+            'errors': self.errors,
+            'pauses': self.pauses,
+            'paused_seconds': round(self.paused_seconds, 3),
+        }
+        if len(latencies) > 0:
+            stats['latency_ms'] = {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'max': latencies[-1]}
+        return stats
+
+
+def adaptive_throttle_from_env():
+    """An 'AdaptiveThrottle' configured by the 'WPCD_THROTTLE_*' environment variables, if enabled."""
+    url = os.getenv("WPCD_THROTTLE_URL")
+    if url is None:
+        return None
+    return AdaptiveThrottle(url,
+        threshold_ms=float(os.getenv("WPCD_THROTTLE_LATENCY_MS", "1000")),
+        interval=float(os.getenv("WPCD_THROTTLE_INTERVAL", "1")),
+        window=int(os.getenv("WPCD_THROTTLE_WINDOW", "3")),
+        max_pause=float(os.getenv("WPCD_THROTTLE_MAX_PAUSE", "60")),
+        timeout=float(os.getenv("WPCD_THROTTLE_TIMEOUT", "10")),
+        verify=os.getenv("WPCD_THROTTLE_VERIFY_SSL", "1") == "1")
@@ -0,0 +1,224 @@
+# Cache warm-up crawler, used after a site is deployed (or a test site set
+# up) so the first real visitors don't hit cold page caches.
+
+import os
+import time
+import math
+import asyncio
+import requests
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from urllib.parse import urlparse, urlunparse, urljoin
+except Exception:
+    from urlparse import urlparse, urlunparse, urljoin
+
+SITEMAP_NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+
+# Tried in order, the latter being the sitemap WordPress 5.5+ generates
+SITEMAP_PATHS = ["sitemap.xml", "wp-sitemap.xml"]
+
+
+def make_session(concurrency, verify = True):
+    """Create a HTTP session with a connection pool sized for the concurrency."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.verify = verify
+    session.headers['User-Agent'] = "wordpress-cd"
+    return session
+
+
+def rebase_url(url, base_url):
+    """Point a URL at the host of 'base_url' (i.e. a test site), keeping its path."""
+    bits = urlparse(url)
+    base = urlparse(base_url)
+    return urlunparse((base.scheme, base.netloc, bits.path, bits.params, bits.query, ''))
+
+
+def fetch_sitemap_urls(base_url, session, limit = None, timeout = 30):
+    """Collect page URLs from the site's sitemap, following sitemap indexes."""
+    candidates = [urljoin(base_url.rstrip("/") + "/", path) for path in SITEMAP_PATHS]
+    pending = list(candidates)
+    first = True
+    seen = set()
+    urls = []
+    while len(pending) > 0 and (limit is None or len(urls) < limit):
+        sitemap_url = pending.pop(0)
+        if sitemap_url in seen:
+            continue
+        seen.add(sitemap_url)
+        try:
+            r = session.get(sitemap_url, timeout=timeout)
+            r.raise_for_status()
+            root = ElementTree.fromstring(r.content)
+        except (requests.exceptions.RequestException, ElementTree.ParseError) as e:
+            _logger.debug("Unable to read sitemap '{0}': {1}".format(sitemap_url, str(e)))
+            continue
+        if first:
+            # Found a sitemap, so don't try the alternatives (compared as
+            # full URLs, as the site may live under a subpath)
+            pending = [p for p in pending if p not in candidates]
+            first = False
+        for loc in root.iter(SITEMAP_NS + "loc"):
+            if loc.text is None or loc.text.strip() == "":
+                continue
+            url = rebase_url(loc.text.strip(), base_url)
+            if root.tag == SITEMAP_NS + "sitemapindex":
+                pending.append(url)
+            else:
+                urls.append(url)
+    if limit is not None:
+        urls = urls[:limit]
+    return urls
+
+
+def percentile(values, p):
+    """Percentile of a sorted list of values, interpolating between ranks."""
+    if len(values) == 0:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    lower = int(math.floor(rank))
+    upper = int(math.ceil(rank))
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarise(results, duration = None):
+    """Summarise (url, status, latency, error) results as latency percentiles (in ms) and error rate."""
+    latencies = sorted(r[2] * 1000.0 for r in results if r[2] is not None)
+    errors = [r for r in results if r[3] is not None or r[1] is None or r[1] >= 400]
+    stats = {
+        'requests': len(results),
+        'errors': len(errors),
+        'error_rate': float(len(errors)) / len(results) if len(results) > 0 else 0.0,
+    }
+    if len(latencies) > 0:
+        stats['latency_ms'] = {
+            'min': latencies[0],
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1],
+        }
+    if duration is not None:
+        stats['duration'] = duration
+        stats['requests_per_second'] = len(results) / duration if duration > 0 else 0.0
+    return stats
+
+
+class RateLimiter(object):
+    """Token bucket limiting the rate requests are started at."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+def fetch_url(session, url, timeout):
+    start = time.monotonic()
+    try:
+        r = session.get(url, timeout=timeout)
+        # Read the whole response, as a visitor's browser would
+        r.content
+        return url, r.status_code, time.monotonic() - start, None
+    except requests.exceptions.RequestException as e:
+        return url, None, None, str(e)
+
+
+async def crawl(urls, session, concurrency = 8, rate = None, timeout = 30):
+    """Fetch the URLs with at most 'concurrency' requests in flight, started at up to 'rate' per second."""
+    loop = asyncio.get_running_loop()
+    limiter = RateLimiter(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def fetch(url):
+        async with semaphore:
+            await limiter.acquire()
+            return await loop.run_in_executor(executor, fetch_url, session, url, timeout)
+
+    try:
+        return await asyncio.gather(*[fetch(url) for url in urls])
+    finally:
+        executor.shutdown(wait=False)
+
+
+def read_url_list(value):
+    # Either a file with one URL per line, or a comma-separated list
+    if os.path.isfile(value):
+        with open(value, 'r') as f:
+            return [line.strip() for line in f if line.strip() != "" and not line.startswith("#")]
+    return [url.strip() for url in value.split(",") if url.strip() != ""]
+
+
+def warm_up(base_url, urls = None, concurrency = 8, rate = None, limit = 500, timeout = 30, verify = True):
+    """Fetch the site's pages once each, returning latency and error statistics.
+
+    Pages are taken from 'urls' (paths or URLs, rebased onto 'base_url') if
+    given, otherwise from the site's sitemap. The home page is always
+    included.
+    """
+    session = make_session(concurrency, verify)
+    if urls is None:
+        urls = fetch_sitemap_urls(base_url, session, limit, timeout)
+    else:
+        urls = [rebase_url(urljoin(base_url.rstrip("/") + "/", url.lstrip("/")), base_url) for url in urls]
+    home = base_url.rstrip("/") + "/"
+    if home not in urls:
+        urls.insert(0, home)
+    if limit is not None:
+        urls = urls[:limit]
+
+    _logger.info("Warming up {0} URLs on '{1}' ({2} at a time)...".format(len(urls), base_url, concurrency))
+    start = time.monotonic()
+    results = asyncio.run(crawl(urls, session, concurrency, rate, timeout))
+    stats = summarise(results, time.monotonic() - start)
+    for url, status, latency, error in results:
+        if error is not None or status is None or status >= 400:
+            _logger.warning("Warm-up request for '{0}' failed: {1}".format(url, error or status))
+    return stats
+
+
+def warm_up_from_env(base_url):
+    """Run a warm-up configured by the 'WPCD_WARMUP_*' environment variables."""
+    urls = None
+    if os.getenv("WPCD_WARMUP_URLS") is not None:
+        urls = read_url_list(os.environ["WPCD_WARMUP_URLS"])
+    rate = float(os.getenv("WPCD_WARMUP_RATE", "0")) or None
+    stats = warm_up(base_url, urls,
+        concurrency=int(os.getenv("WPCD_WARMUP_CONCURRENCY", "8")),
+        rate=rate,
+        limit=int(os.getenv("WPCD_WARMUP_LIMIT", "500")),
+        timeout=float(os.getenv("WPCD_WARMUP_TIMEOUT", "30")),
+        verify=os.getenv("WPCD_WARMUP_VERIFY_SSL", "1") == "1")
+    if 'latency_ms' in stats:
+        _logger.info("Warm-up done: {0} requests, {1} errors, p50 {2:.0f}ms, p95 {3:.0f}ms, p99 {4:.0f}ms.".format(
+            stats['requests'], stats['errors'], stats['latency_ms']['p50'],
+            stats['latency_ms']['p95'], stats['latency_ms']['p99']))
+    return stats
+
+
+def warm_up_enabled():
+    return os.getenv("WPCD_WARMUP", "0") == "1"
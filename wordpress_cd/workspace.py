@@ -0,0 +1,71 @@
+# The folders a job works in: the project folder it was started in (holding
+# the sources, 'build.yml', the build and the artefacts) and a scratch
+# folder of its own for downloads and other temporary files.
+#
+# Jobs refer to everything by absolute path from their workspace, and run
+# commands in whichever folder they need rather than changing the current
+# directory, so several jobs can run on one host (or in one process) at
+# once without treading on each other.
+
+import os
+import shutil
+import tempfile
+import threading
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class Workspace(object):
+    def __init__(self, root = None, name = "job"):
+        self.root = os.path.abspath(root or os.getcwd())
+        self.name = name
+        self._scratch_dir = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return self.root
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def path(self, *parts):
+        """Return the absolute path of something in the project folder."""
+        return os.path.join(self.root, *parts)
+
+    @property
+    def scratch_dir(self):
+        """This job's own temporary folder, created when first needed."""
+        with self._lock:
+            if self._scratch_dir is None:
+                parent = os.getenv("WPCD_SCRATCH_DIR")
+                if parent is not None and not os.path.isdir(parent):
+                    os.makedirs(parent, exist_ok=True)
+                self._scratch_dir = tempfile.mkdtemp(prefix="wpcd-{0}-".format(self.name), dir=parent)
+                _logger.debug("Using scratch folder '{0}'".format(self._scratch_dir))
+            return self._scratch_dir
+
+    def scratch(self, *parts):
+        """Return the path of a folder within the scratch folder, creating it if need be."""
+        path = os.path.join(self.scratch_dir, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def mkdtemp(self, prefix = "tmp-"):
+        """Make a new, uniquely named folder within the scratch folder."""
+        return tempfile.mkdtemp(prefix=prefix, dir=self.scratch_dir)
+
+    def cleanup(self):
+        """Remove the scratch folder and everything in it."""
+        with self._lock:
+            scratch_dir, self._scratch_dir = self._scratch_dir, None
+        if scratch_dir is None:
+            return
+        if os.getenv("WPCD_KEEP_SCRATCH", "0") == "1":
+            _logger.info("Keeping scratch folder '{0}'".format(scratch_dir))
+            return
+        _logger.debug("Removing scratch folder '{0}'".format(scratch_dir))
+        shutil.rmtree(scratch_dir, ignore_errors=True)
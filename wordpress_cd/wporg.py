@@ -0,0 +1,474 @@
+# Resolves WordPress.org plugin and theme references in 'build.yml' (given
+# as 'slug@constraint', e.g. 'akismet@^5.0') to exact, versioned download
+# URLs, so versions can be pinned and bumped without editing URLs and every
+# download is of a specific release (and so cacheable).
+#
+# Plugin/theme details are looked up with the WordPress.org info APIs, many
+# slugs per request, and kept in an on-disk metadata cache for a while
+# ('WPCD_WPORG_TTL') and revalidated with the ETag of the response after.
+# Resolutions are recorded in a lockfile ('build.lock') next to 'build.yml'
+# along with the checksum of each download once fetched, and reused by later
+# builds until the reference changes or an update is asked for.
+#
+# To (re)resolve references without building:
+#
+#   resolve-wp-site [--update] [slug ...]
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import logging
+_logger = logging.getLogger(__name__)
+
+from .cache import get_local_cache_dir
+
+API_URL = "https://api.wordpress.org"
+API_PATHS = {
+    'plugin': ("plugins/info/1.2/", "plugin_information"),
+    'theme': ("themes/info/1.2/", "theme_information"),
+}
+LOCKFILE = "build.lock"
+LOCKFILE_VERSION = 1
+
+# Which kind of component each list in a layer holds
+COMPONENT_TYPES = {'themes': 'theme', 'plugins': 'plugin', 'mu-plugins': 'plugin'}
+
+REFERENCE_RE = re.compile(r'^([a-z0-9][a-z0-9_.-]*)(?:@(.+))?$')
+VERSION_RE = re.compile(r'^\d+(\.\d+)*$')
+CLAUSE_RE = re.compile(r'^(\^|~|>=|<=|>|<|==|=|!=)?\s*v?(\d+(?:\.\d+)*)((?:\.[*x])*)$')
+
+
+class ResolveException(Exception):
+    pass
+
+
+def is_reference(entry):
+    """Whether a component entry is a WordPress.org reference rather than a URL."""
+    return isinstance(entry, str) and REFERENCE_RE.match(entry.strip()) is not None
+
+def parse_reference(ref):
+    """Split a 'slug@constraint' reference into the slug and constraint."""
+    m = REFERENCE_RE.match(ref.strip())
+    if m is None:
+        raise ResolveException("Invalid WordPress.org reference '{0}'.".format(ref))
+    return m.group(1), (m.group(2) or "*").strip()
+
+
+def parse_version(version):
+    """Return a comparable tuple for a stable (all numeric) version, or None."""
+    version = str(version)
+    if VERSION_RE.match(version) is None:
+        return None
+    return tuple(int(part) for part in version.split("."))
+
+def _compare(a, b):
+    # Missing parts count as zero, so '5.3' == '5.3.0'
+    size = max(len(a), len(b))
+    a = a + (0,) * (size - len(a))
+    b = b + (0,) * (size - len(b))
+    return (a > b) - (a < b)
+
+def _bump(version, index):
+    # The smallest version above every version starting with 'version[:index + 1]'
+    return version[:index] + (version[index] + 1,)
+
+
+class Constraint(object):
+    """A set of version requirements, e.g. '^5.0', '~1.2.3', '>=2.0, <3', '4.9.*' or '5.3.1'.
+
+    '^' allows anything up to the next major version (or the next minor
+    version, for '0.x'), and '~' anything up to the next minor version.
+    A bare version must match exactly, unless it ends in a '.*' wildcard.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.exact = None
+        self.clauses = []
+        if spec in ["*", "", "latest"]:
+            return
+        for clause in re.split(r'[\s,]+(?=[\^~<>=!v\d])', spec.strip()):
+            self._parse_clause(clause.strip().rstrip(","))
+
+    def _parse_clause(self, clause):
+        m = CLAUSE_RE.match(clause)
+        if m is None:
+            # A non-numeric version (e.g. '2.0-beta1') can only be asked for exactly
+            if len(self.clauses) == 0 and re.search(r'[\s,<>^~*]', self.spec) is None:
+                self.exact = self.spec.lstrip("=")
+                return
+            raise ResolveException("Invalid version constraint '{0}'.".format(self.spec))
+        op, version, wildcard = m.group(1) or "=", parse_version(m.group(2)), m.group(3)
+        if wildcard:
+            if op not in ["=", "=="]:
+                raise ResolveException("Invalid version constraint '{0}'.".format(self.spec))
+            self.clauses += [(">=", version), ("<", _bump(version, len(version) - 1))]
+        elif op == "^":
+            # Up to the next change of the first non-zero part
+            index = next((i for (i, part) in enumerate(version) if part != 0), len(version) - 1)
+            self.clauses += [(">=", version), ("<", _bump(version, index))]
+        elif op == "~":
+            self.clauses += [(">=", version), ("<", _bump(version, 1 if len(version) > 1 else 0))]
+        else:
+            self.clauses.append(("=" if op == "==" else op, version))
+
+    def __str__(self):
+        return self.spec
+
+    @property
+    def any(self):
+        return self.exact is None and len(self.clauses) == 0
+
+    def matches(self, version):
+        if self.exact is not None:
+            return str(version) == self.exact
+        parsed = parse_version(version)
+        if parsed is None:
+            return False
+        for (op, wanted) in self.clauses:
+            c = _compare(parsed, wanted)
+            if not {"=": c == 0, "!=": c != 0, ">": c > 0, ">=": c >= 0, "<": c < 0, "<=": c <= 0}[op]:
+                return False
+        return True
+
+    def select(self, versions):
+        """Return the highest of the given versions satisfying the constraint, if any."""
+        matching = [v for v in versions if self.matches(v)]
+        if self.exact is not None:
+            return matching[0] if len(matching) > 0 else None
+        return max(matching, key=parse_version, default=None)
+
+
+class MetadataCache(object):
+    """Plugin/theme details from the WordPress.org APIs, kept on disk for a while."""
+
+    def __init__(self, cache_dir = None, ttl = None):
+        self.cache_dir = cache_dir or os.path.join(get_local_cache_dir(), "wporg")
+        self.ttl = ttl if ttl is not None else float(os.getenv("WPCD_WPORG_TTL", "3600"))
+
+    def _path(self, *parts):
+        path = os.path.join(self.cache_dir, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        # Written aside and moved into place, as other jobs may be reading
+        tmp_file = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, path)
+
+    def get(self, type, slug):
+        """Return the cached details of a plugin/theme, and whether they're still fresh."""
+        entry = self._read(self._path(type, slug + ".json"))
+        if entry is None:
+            return None, False
+        return entry['info'], time.time() - entry['fetched'] < self.ttl
+
+    def put(self, type, slug, info):
+        self._write(self._path(type, slug + ".json"), {'fetched': time.time(), 'info': info})
+
+    def touch(self, type, slug):
+        info, fresh = self.get(type, slug)
+        if info is not None:
+            self.put(type, slug, info)
+
+    def _batch_path(self, type, slugs):
+        key = hashlib.sha256("\n".join([type] + sorted(slugs)).encode('utf-8')).hexdigest()
+        return self._path("batches", key + ".json")
+
+    def get_etag(self, type, slugs):
+        """Return the ETag of the last response for exactly this set of slugs."""
+        entry = self._read(self._batch_path(type, slugs))
+        return entry['etag'] if entry is not None else None
+
+    def put_etag(self, type, slugs, etag):
+        if etag is not None:
+            self._write(self._batch_path(type, slugs), {'etag': etag, 'slugs': sorted(slugs)})
+
+
+class Resolver(object):
+    """Resolves references to download URLs, looking up many slugs per API request."""
+
+    def __init__(self, api_url = None, cache = None, batch_size = None, threads = None, session = None):
+        self.api_url = (api_url or os.getenv("WPCD_WPORG_API_URL", API_URL)).rstrip("/")
+        self.cache = cache or MetadataCache()
+        self.batch_size = batch_size or int(os.getenv("WPCD_WPORG_BATCH_SIZE", "50"))
+        self.threads = threads or int(os.getenv("WPCD_DOWNLOAD_THREADS", "4"))
+        self.session = session or requests.Session()
+        self.stats = {'requests': 0, 'not_modified': 0, 'cached': 0}
+        self._lock = threading.Lock()
+
+    def _query(self, type, slugs, etag):
+        path, action = API_PATHS[type]
+        params = {
+            'action': action,
+            'request[slugs]': ",".join(slugs),
+            'request[fields][versions]': 1,
+        }
+        # Leave out the bulky fields we've no use for
+        for field in ['sections', 'description', 'reviews', 'ratings', 'screenshots', 'banners', 'icons', 'contributors', 'tags']:
+            params['request[fields][{0}]'.format(field)] = 0
+        headers = {'If-None-Match': etag} if etag is not None else {}
+        _logger.debug("Looking up {0} {1}s on WordPress.org...".format(len(slugs), type))
+        try:
+            r = self.session.get("{0}/{1}".format(self.api_url, path), params=params, headers=headers, timeout=60)
+            with self._lock:
+                self.stats['requests'] += 1
+            if r.status_code == 304:
+                return None, etag
+            r.raise_for_status()
+            return r.json(), r.headers.get('ETag')
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise ResolveException("Unable to look up {0}s on WordPress.org: {1}".format(type, str(e)))
+
+    def _fetch_batch(self, type, slugs):
+        # Details we still have can be revalidated in bulk with the batch's ETag
+        etag = None
+        if all(self.cache.get(type, slug)[0] is not None for slug in slugs):
+            etag = self.cache.get_etag(type, slugs)
+        results, etag = self._query(type, slugs, etag)
+        if results is None:
+            with self._lock:
+                self.stats['not_modified'] += 1
+            for slug in slugs:
+                self.cache.touch(type, slug)
+            return
+
+        # Single lookups return the details alone, batches a mapping of slug to details
+        if len(slugs) == 1 and isinstance(results, dict) and results.get('slug') == slugs[0]:
+            results = {slugs[0]: results}
+        if not isinstance(results, dict):
+            raise ResolveException("Unexpected response looking up {0}s on WordPress.org.".format(type))
+        for slug in slugs:
+            info = results.get(slug)
+            if isinstance(info, dict) and 'error' not in info:
+                self.cache.put(type, slug, info)
+        self.cache.put_etag(type, slugs, etag)
+
+    def lookup(self, type, slugs):
+        """Return the details of each of the given plugins/themes, from the cache where fresh."""
+        slugs = sorted(set(slugs))
+        stale = [slug for slug in slugs if not self.cache.get(type, slug)[1]]
+        with self._lock:
+            self.stats['cached'] += len(slugs) - len(stale)
+        batches = [stale[i:i + self.batch_size] for i in range(0, len(stale), self.batch_size)]
+        if len(batches) > 0:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                list(executor.map(lambda batch: self._fetch_batch(type, batch), batches))
+
+        details = {}
+        for slug in slugs:
+            info, fresh = self.cache.get(type, slug)
+            if info is None:
+                raise ResolveException("Unable to find {0} '{1}' on WordPress.org.".format(type, slug))
+            details[slug] = info
+        return details
+
+    def resolve(self, references):
+        """Resolve (type, reference) pairs to their version and download URL."""
+        wanted = {}
+        for (type, ref) in references:
+            slug, constraint = parse_reference(ref)
+            wanted.setdefault(type, set()).add(slug)
+        details = dict((type, self.lookup(type, slugs)) for (type, slugs) in wanted.items())
+
+        resolved = {}
+        for (type, ref) in references:
+            slug, spec = parse_reference(ref)
+            info = details[type][slug]
+            constraint = Constraint(spec)
+            versions = dict(info.get('versions') or {})
+            versions.pop('trunk', None)
+            if constraint.any and info.get('download_link'):
+                version, url = info['version'], info['download_link']
+            else:
+                version = constraint.select(versions.keys())
+                if version is None:
+                    raise ResolveException("No release of {0} '{1}' satisfies '{2}' (latest is {3}).".format(
+                        type, slug, spec, info.get('version')))
+                url = versions[version]
+            resolved[(type, ref)] = {'slug': slug, 'version': str(version), 'url': url}
+        return resolved
+
+
+class Lockfile(object):
+    """The resolution of each reference in a 'build.yml', and each download's checksum."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'r') as f:
+                    data = json.load(f)
+            except ValueError as e:
+                raise ResolveException("Unable to read lockfile '{0}': {1}".format(filename, str(e)))
+            self.entries = data.get('components', {})
+
+    @staticmethod
+    def key(type, ref):
+        return "{0}:{1}".format(type, ref.strip())
+
+    def get(self, type, ref):
+        return self.entries.get(self.key(type, ref))
+
+    def set(self, type, ref, resolution):
+        entry = dict(resolution)
+        current = self.get(type, ref)
+        # A checksum is only worth keeping for the same download
+        if current is not None and current.get('url') == entry['url'] and 'sha256' in current:
+            entry.setdefault('sha256', current['sha256'])
+        if current != entry:
+            self.entries[self.key(type, ref)] = entry
+            self.changed = True
+
+    def retain(self, references):
+        """Forget references no longer used."""
+        keys = set(self.key(type, ref) for (type, ref) in references)
+        for key in [k for k in self.entries.keys() if k not in keys]:
+            del self.entries[key]
+            self.changed = True
+
+    def record_checksum(self, url, sha256):
+        for entry in self.entries.values():
+            if entry['url'] == url and entry.get('sha256') != sha256:
+                if entry.get('sha256') is not None:
+                    # A pinned download that changed would have failed already
+                    continue
+                entry['sha256'] = sha256
+                self.changed = True
+
+    def apply(self, config):
+        """Replace references in a config with the locked download (and checksum) where known."""
+        for (layer, list_name, index, type, ref) in iter_references(config):
+            entry = self.get(type, ref)
+            if entry is not None:
+                layer[list_name][index] = component_entry(entry)
+
+    def save(self):
+        if not self.changed:
+            return False
+        data = {'version': LOCKFILE_VERSION, 'components': self.entries}
+        tmp_file = self.filename + ".tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(json.dumps(data, indent=2, sort_keys=True) + "\n")
+        os.replace(tmp_file, self.filename)
+        self.changed = False
+        return True
+
+
+def iter_references(config):
+    """Yield (layer, list name, index, type, reference) for each reference in a config."""
+    for layer in (config.get('layers') or {}).values():
+        for (list_name, type) in COMPONENT_TYPES.items():
+            for (index, entry) in enumerate(layer.get(list_name) or []):
+                if is_reference(entry):
+                    yield layer, list_name, index, type, entry.strip()
+
+def component_entry(resolution):
+    """The 'build.yml' component entry for a resolved reference."""
+    entry = {'url': resolution['url']}
+    if resolution.get('sha256') is not None:
+        entry['sha256'] = resolution['sha256']
+    return entry
+
+
+def resolve_config(config, lockfile = None, update = None, frozen = None, resolver = None):
+    """Replace the references in a build config with download entries, in place.
+
+    References found in the lockfile (if given) are used as locked, unless
+    they're to be updated: 'update' is True for all, or a list of slugs.
+    Returns the resolution of each (type, reference).
+    """
+    if update is None:
+        update = os.getenv("WPCD_WPORG_UPDATE", "0") == "1"
+    if frozen is None:
+        frozen = os.getenv("WPCD_LOCKFILE_FROZEN", "0") == "1"
+    found = list(iter_references(config))
+    references = sorted(set((type, ref) for (layer, list_name, index, type, ref) in found))
+    if len(references) == 0:
+        return {}
+
+    def updating(ref):
+        return update is True or (update and parse_reference(ref)[0] in update)
+
+    resolved = {}
+    pending = []
+    for (type, ref) in references:
+        entry = lockfile.get(type, ref) if lockfile is not None else None
+        if entry is not None and not updating(ref):
+            resolved[(type, ref)] = entry
+        else:
+            pending.append((type, ref))
+    if len(pending) > 0 and frozen:
+        raise ResolveException("Lockfile is out of date for: {0}".format(", ".join(ref for (type, ref) in pending)))
+
+    if len(pending) > 0:
+        resolver = resolver or Resolver()
+        start = time.monotonic()
+        resolved.update(resolver.resolve(pending))
+        _logger.info("Resolved {0} WordPress.org references in {1:.2f}s ({2} API requests, {3} revalidated, {4} from cache).".format(
+            len(pending), time.monotonic() - start, resolver.stats['requests'], resolver.stats['not_modified'], resolver.stats['cached']))
+    for (type, ref) in references:
+        _logger.debug("Using {0} '{1}' version {2} for '{3}'.".format(
+            type, resolved[(type, ref)]['slug'], resolved[(type, ref)]['version'], ref))
+
+    for (layer, list_name, index, type, ref) in found:
+        layer[list_name][index] = component_entry(resolved[(type, ref)])
+    if lockfile is not None:
+        for (type, ref) in references:
+            lockfile.set(type, ref, resolved[(type, ref)])
+        lockfile.retain(references)
+    return resolved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resolve the WordPress.org plugins and themes in 'build.yml', updating '{0}'.".format(LOCKFILE))
+    parser.add_argument('-v', dest='verbose', action='store_true')
+    parser.add_argument('-d', dest='debug', action='store_true')
+    parser.add_argument('--update', action='store_true', help="re-resolve references already in the lockfile")
+    parser.add_argument('slugs', nargs='*', help="only re-resolve these plugins/themes (implies --update)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    from .build import read_build_config
+    from .config import ConfigException
+    try:
+        config = read_build_config("build.yml")
+        lockfile = Lockfile(LOCKFILE)
+        # Updates are checked against the latest details, however fresh the cache
+        update = args.slugs or args.update
+        resolver = Resolver(cache=MetadataCache(ttl=0)) if update else None
+        resolved = resolve_config(config, lockfile, update=update, frozen=False, resolver=resolver)
+    except (ConfigException, ResolveException) as e:
+        _logger.error(str(e))
+        return 1
+    for ((type, ref), resolution) in sorted(resolved.items()):
+        print("{0} {1} -> {2}".format(type, ref, resolution['version']))
+    if lockfile.save():
+        print("Updated '{0}'.".format(LOCKFILE))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())